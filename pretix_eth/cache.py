@@ -0,0 +1,18 @@
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+
+# Stands in for the default cache in each process, see get_cache
+local_cache = LocMemCache("pretix_eth", {"OPTIONS": {"MAX_ENTRIES": 10000}})
+
+
+def get_cache():
+    """
+    Django's default cache, unless it is a dummy cache - pretix's default when neither
+    redis nor memcached is configured. Then an in-process cache is returned instead, so
+    that values are at least shared by the threads of one process.
+    """
+    default = caches["default"]
+    if isinstance(default, DummyCache):
+        return local_cache
+    return default
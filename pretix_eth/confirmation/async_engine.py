@@ -0,0 +1,195 @@
+import asyncio
+import logging
+import queue
+import threading
+from collections import OrderedDict
+
+from pretix_eth.confirmation.engine import save_transaction_cache
+from pretix_eth.confirmation.transaction_cache import TransactionCache
+from pretix_eth.exceptions import TransactionProviderError
+from pretix_eth.network.rpc import (
+    DEFAULT_HEAD_MAX_AGE,
+    ChainHeadCache,
+    async_request,
+    batch_request,
+    get_web3,
+    is_http_url,
+    make_async_provider,
+)
+from pretix_eth.verification import (
+    SKIP,
+    Verdict,
+    is_eligible_receipt,
+    verdict_from_state,
+    verify_transfer,
+)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ASYNC_CONCURRENCY = 32
+
+
+class AsyncReceiptEngine(object):
+    """
+    Verifies pending transfers like ReceiptEngine, and comes to the same verdicts, but
+    makes one JSON-RPC request per lookup on an asyncio event loop, so that hundreds of
+    them can be in flight at once across all networks. At most ``concurrency``
+    requests are in flight per RPC URL.
+
+    The event loop runs on a thread of its own until ``close`` is called. Pending
+    transfers come in with everything verification needs, so nothing on the loop
+    touches the database; verdicts are handed back to the thread that iterates over
+    ``verify``, which is the only one that should write to the database. The same
+    goes for the TransactionCache of finalized receipts and transactions, which is
+    loaded before and saved after the lookups.
+    """
+
+    def __init__(self, concurrency=DEFAULT_ASYNC_CONCURRENCY,
+                 head_max_age=DEFAULT_HEAD_MAX_AGE, finality_depth=None):
+        self.concurrency = concurrency
+        self.finality_depth = finality_depth
+        self.heads = ChainHeadCache(max_age=head_max_age)
+        self._loop = None
+        self._thread = None
+        # Only used on the event loop
+        self._providers = {}
+        self._sessions = []
+        self._semaphores = {}
+
+    def _get_loop(self):
+        if self._loop is None:
+            self._loop = asyncio.new_event_loop()
+            self._thread = threading.Thread(
+                target=self._loop.run_forever, name="pretix-eth-async-engine", daemon=True
+            )
+            self._thread.start()
+        return self._loop
+
+    def close(self):
+        """Close all connections and stop the event loop."""
+        if self._loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(self._close_sessions(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+        self._loop = self._thread = None
+
+    async def _close_sessions(self):
+        for session in self._sessions:
+            await session.close()
+        self._sessions.clear()
+        self._providers.clear()
+        self._semaphores.clear()
+
+    def verify(self, pending_transfers):
+        """Yield a ``(pending, verdict)`` pair for each of ``pending_transfers``."""
+        pending_transfers = list(pending_transfers)
+        cache = TransactionCache.for_transfers(pending_transfers, self.finality_depth)
+        results = queue.Queue()
+        done = object()
+
+        async def run():
+            try:
+                await self._verify_all(pending_transfers, cache, results.put)
+            finally:
+                results.put(done)
+
+        future = asyncio.run_coroutine_threadsafe(run(), self._get_loop())
+        try:
+            while True:
+                result = results.get()
+                if result is done:
+                    break
+                yield result
+            future.result()
+        finally:
+            save_transaction_cache(cache)
+
+    async def _verify_all(self, pending_transfers, cache, put):
+        groups = OrderedDict()
+        for pending in pending_transfers:
+            key = (pending.token.NETWORK_IDENTIFIER, pending.rpc_url)
+            groups.setdefault(key, []).append(pending)
+
+        for _, rpc_url in groups:
+            if rpc_url not in self._semaphores:
+                self._semaphores[rpc_url] = asyncio.Semaphore(self.concurrency)
+            if isinstance(rpc_url, str) and is_http_url(rpc_url) and (
+                rpc_url not in self._providers
+            ):
+                provider, session = await make_async_provider(rpc_url, self.concurrency)
+                self._providers[rpc_url] = provider
+                self._sessions.append(session)
+
+        await asyncio.gather(*(
+            self._verify_group(network_id, rpc_url, transfers, cache, put)
+            for (network_id, rpc_url), transfers in groups.items()
+        ))
+
+    async def _request(self, network_id, rpc_url, method, params):
+        async with self._semaphores[rpc_url]:
+            provider = self._providers.get(rpc_url)
+            if provider is None:
+                # There is no async provider for IPC or WebSocket URLs, or for several
+                # endpoints with failover, so those get the synchronous client on a
+                # worker thread.
+                results = await asyncio.get_running_loop().run_in_executor(
+                    None, batch_request, get_web3(rpc_url), [(method, params)], 1, network_id
+                )
+                return results[0]
+            return await async_request(provider, method, params, network_id)
+
+    async def _verify_group(self, network_id, rpc_url, transfers, cache, put):
+        chain_id = transfers[0].token.CHAIN_ID
+        head = self.heads.peek(rpc_url)
+        if head is None:
+            head = await self._request(network_id, rpc_url, "eth_blockNumber", [])
+            if isinstance(head, TransactionProviderError):
+                logger.warning(f"Could not get the block height from {rpc_url}: {head}")
+                for pending in transfers:
+                    put((pending, Verdict(SKIP, "rpc_error")))
+                return
+            self.heads.set(rpc_url, head)
+
+        # Signed messages that share a transaction hash share its lookups
+        lookups = {}
+
+        async def request(method, transaction_hash):
+            if method == "eth_getTransactionReceipt":
+                result = cache.receipt(chain_id, transaction_hash)
+            else:
+                result = cache.transaction(chain_id, transaction_hash)
+            if result is None:
+                result = await self._request(network_id, rpc_url, method, [transaction_hash])
+            return result
+
+        def lookup(method, transaction_hash):
+            key = (method, transaction_hash)
+            if key not in lookups:
+                lookups[key] = asyncio.ensure_future(request(method, transaction_hash))
+            return lookups[key]
+
+        async def verify(pending):
+            verdict = verdict_from_state(pending, head)
+            if verdict is None:
+                receipt = await lookup("eth_getTransactionReceipt", pending.transaction_hash)
+                transaction = None
+                # Only fetch transactions that can actually confirm a payment
+                if pending.needs_transaction and is_eligible_receipt(
+                    receipt, pending.safety_block_count, head
+                ):
+                    transaction = await lookup(
+                        "eth_getTransactionByHash", pending.transaction_hash
+                    )
+                cache.add(chain_id, pending.transaction_hash, receipt, transaction, head)
+                verdict = verify_transfer(pending, receipt, transaction, head)
+            put((pending, verdict))
+
+        results = await asyncio.gather(
+            *(verify(pending) for pending in transfers), return_exceptions=True
+        )
+        for pending, result in zip(transfers, results):
+            if isinstance(result, Exception):
+                logger.warning(f"Verifying {pending.transaction_hash} failed: {result}")
+                put((pending, Verdict(SKIP, "rpc_error")))
@@ -0,0 +1,64 @@
+import time
+
+from django.utils import timezone
+
+from pretix_eth.metrics import metrics
+
+
+class RunBudget(object):
+    """
+    Limits on the wall-clock time and the number of JSON-RPC calls one confirm_payments
+    run may spend, counted from when the budget is created. Either limit may be None.
+
+    JSON-RPC calls are counted through the ``pretix_eth_rpc_calls_total`` metric, so
+    every call made through ``batch_request`` or ``async_request`` counts, no matter
+    which engine or thread made it.
+    """
+
+    def __init__(self, max_runtime=None, max_rpc_calls=None, clock=time.monotonic):
+        self.max_runtime = max_runtime
+        self.max_rpc_calls = max_rpc_calls
+        self.clock = clock
+        self.started_at = clock()
+        self._rpc_calls_at_start = metrics.total("pretix_eth_rpc_calls_total")
+
+    @property
+    def is_limited(self):
+        return self.max_runtime is not None or self.max_rpc_calls is not None
+
+    @property
+    def rpc_calls(self):
+        return metrics.total("pretix_eth_rpc_calls_total") - self._rpc_calls_at_start
+
+    @property
+    def remaining_rpc_calls(self):
+        if self.max_rpc_calls is None:
+            return None
+        return max(int(self.max_rpc_calls - self.rpc_calls), 0)
+
+    @property
+    def exhausted(self):
+        if self.max_runtime is not None and self.clock() - self.started_at >= self.max_runtime:
+            return True
+        return self.remaining_rpc_calls == 0
+
+
+def priority_key(pending, now=None):
+    """
+    Sort key that puts the pending transfers most worth checking first: submissions
+    within their retry timeout on orders that haven't expired before stale ones, and
+    among those the orders that expire soonest, and then the youngest submissions.
+    """
+    now = now or timezone.now()
+    expires = pending.order_payment.order.expires
+    is_stale = pending.is_expired or (expires is not None and expires < now)
+    if is_stale or expires is None:
+        time_left = 0
+    else:
+        time_left = (expires - now).total_seconds()
+    return is_stale, time_left, pending.signed_message.age
+
+
+def prioritize(pending_transfers, now=None):
+    now = now or timezone.now()
+    return sorted(pending_transfers, key=lambda pending: priority_key(pending, now))
@@ -0,0 +1,226 @@
+import logging
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from pretix_eth.confirmation.transaction_cache import TransactionCache
+from pretix_eth.exceptions import TransactionProviderError
+from pretix_eth.network.rpc import (
+    DEFAULT_BATCH_SIZE,
+    DEFAULT_HEAD_MAX_AGE,
+    ChainHeadCache,
+    batch_request,
+    get_web3,
+)
+from pretix_eth.verification import (
+    SKIP,
+    Verdict,
+    is_eligible_receipt,
+    verdict_from_state,
+    verify_transfer,
+)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_NETWORK_CONCURRENCY = 2
+
+
+class ReceiptEngine(object):
+    """
+    Verifies pending transfers by looking up their receipts (and, for native transfers,
+    their transactions) with batched JSON-RPC requests.
+
+    With ``workers`` > 0, the lookups run on a thread pool, with at most
+    ``network_concurrency`` batches in flight per network so that one slow RPC
+    provider can't hold up the others. Verdicts are always yielded back to the calling
+    thread, which is the only one that should write to the database.
+
+    Block heights come from ``heads``, so that they are looked up once per RPC URL
+    rather than once per batch, and are shared with engines built on top of this one.
+
+    Transfers whose verification state shows that a re-check can't change anything
+    at the current block height get the earlier verdict without any lookups, and
+    receipts and transactions past ``finality_depth`` come from a TransactionCache.
+    """
+
+    def __init__(self, batch_size=DEFAULT_BATCH_SIZE, workers=0,
+                 network_concurrency=DEFAULT_NETWORK_CONCURRENCY,
+                 head_max_age=DEFAULT_HEAD_MAX_AGE, finality_depth=None):
+        self.batch_size = batch_size
+        self.workers = workers
+        self.network_concurrency = network_concurrency
+        self.finality_depth = finality_depth
+        self.heads = ChainHeadCache(max_age=head_max_age)
+
+    def close(self):
+        pass
+
+    def _chunks(self, pending_transfers):
+        """Split pending transfers into ``(network_id, rpc_url, transfers)`` chunks."""
+        groups = OrderedDict()
+        for pending in pending_transfers:
+            key = (pending.token.NETWORK_IDENTIFIER, pending.rpc_url)
+            groups.setdefault(key, []).append(pending)
+
+        for (network_id, rpc_url), transfers in groups.items():
+            for start in range(0, len(transfers), self.batch_size):
+                yield network_id, rpc_url, transfers[start:start + self.batch_size]
+
+    def verify(self, pending_transfers):
+        """Yield a ``(pending, verdict)`` pair for each of ``pending_transfers``."""
+        pending_transfers = list(pending_transfers)
+        cache = TransactionCache.for_transfers(pending_transfers, self.finality_depth)
+        try:
+            yield from self._verify(pending_transfers, cache)
+        finally:
+            save_transaction_cache(cache)
+
+    def _verify(self, pending_transfers, cache):
+        chunks = list(self._chunks(pending_transfers))
+
+        if not self.workers:
+            for network_id, rpc_url, transfers in chunks:
+                yield from self._verify_chunk(rpc_url, transfers, cache)
+            return
+
+        queues = OrderedDict()
+        for network_id, rpc_url, transfers in chunks:
+            queues.setdefault(network_id, deque()).append((rpc_url, transfers))
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {}
+
+            def submit_next(network_id):
+                rpc_url, transfers = queues[network_id].popleft()
+                future = executor.submit(self._verify_chunk_list, rpc_url, transfers, cache)
+                futures[future] = network_id, transfers
+
+            # Only ever submit ``network_concurrency`` chunks per network, so that the
+            # queued chunks of a slow network can't tie up every worker
+            for network_id, queue in queues.items():
+                for _ in range(min(self.network_concurrency, len(queue))):
+                    submit_next(network_id)
+
+            while futures:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    network_id, transfers = futures.pop(future)
+                    if queues[network_id]:
+                        submit_next(network_id)
+                    try:
+                        results = future.result()
+                    except Exception as e:
+                        logger.warning(f"Verifying a batch of transfers failed: {e}")
+                        results = [(pending, Verdict(SKIP, "rpc_error")) for pending in transfers]
+                    yield from results
+
+    def _verify_chunk_list(self, rpc_url, transfers, cache):
+        return list(self._verify_chunk(rpc_url, transfers, cache))
+
+    def _verify_chunk(self, rpc_url, transfers, cache):
+        network_id = transfers[0].token.NETWORK_IDENTIFIER
+        chain_id = transfers[0].token.CHAIN_ID
+        head = self.heads.peek(rpc_url)
+        if head is None and any(pending.state is not None for pending in transfers):
+            try:
+                head = self.heads.get(rpc_url, network_id)
+            except Exception as e:
+                logger.warning(f"Could not get the block height from {rpc_url}: {e}")
+                for pending in transfers:
+                    yield pending, Verdict(SKIP, "rpc_error")
+                return
+
+        if head is not None:
+            remaining = []
+            for pending in transfers:
+                verdict = verdict_from_state(pending, head)
+                if verdict is None:
+                    remaining.append(pending)
+                else:
+                    yield pending, verdict
+            transfers = remaining
+            if not transfers:
+                return
+
+        w3 = get_web3(rpc_url)
+        transaction_hashes = list(OrderedDict.fromkeys(
+            pending.transaction_hash for pending in transfers
+        ))
+
+        receipts = {
+            transaction_hash: cache.receipt(chain_id, transaction_hash)
+            for transaction_hash in transaction_hashes
+        }
+        uncached = [
+            transaction_hash for transaction_hash in transaction_hashes
+            if receipts[transaction_hash] is None
+        ]
+
+        calls = [
+            ("eth_getTransactionReceipt", [transaction_hash]) for transaction_hash in uncached
+        ]
+        # Piggyback on the receipts batch to refresh the block height if it is stale
+        if head is None:
+            calls.insert(0, ("eth_blockNumber", []))
+
+        results = batch_request(w3, calls, self.batch_size, network_id)
+
+        if head is None:
+            head = results.pop(0)
+            if isinstance(head, TransactionProviderError):
+                logger.warning(f"Could not get the block height from {rpc_url}: {head}")
+                for pending in transfers:
+                    yield pending, Verdict(SKIP, "rpc_error")
+                return
+            self.heads.set(rpc_url, head)
+
+        receipts.update(zip(uncached, results))
+
+        # Only fetch transactions that can actually confirm a payment
+        transactions = {}
+        needed_transaction_hashes = []
+        for pending in transfers:
+            transaction_hash = pending.transaction_hash
+            if transaction_hash in transactions or not (
+                pending.needs_transaction
+                and is_eligible_receipt(
+                    receipts[transaction_hash], pending.safety_block_count, head
+                )
+            ):
+                continue
+            transactions[transaction_hash] = cache.transaction(chain_id, transaction_hash)
+            if transactions[transaction_hash] is None:
+                needed_transaction_hashes.append(transaction_hash)
+        transactions.update(zip(
+            needed_transaction_hashes,
+            batch_request(
+                w3,
+                [
+                    ("eth_getTransactionByHash", [transaction_hash])
+                    for transaction_hash in needed_transaction_hashes
+                ],
+                self.batch_size,
+                network_id,
+            ),
+        ))
+
+        for transaction_hash in transaction_hashes:
+            cache.add(
+                chain_id, transaction_hash, receipts[transaction_hash],
+                transactions.get(transaction_hash), head,
+            )
+
+        for pending in transfers:
+            yield pending, verify_transfer(
+                pending,
+                receipts[pending.transaction_hash],
+                transactions.get(pending.transaction_hash),
+                head,
+            )
+
+
+def save_transaction_cache(cache):
+    """Save what ``cache`` learned, without letting a failure get in the way of a run."""
+    try:
+        cache.save()
+    except Exception as e:
+        logger.warning(f"Could not save finalized transactions: {e}")
@@ -0,0 +1,85 @@
+import datetime
+import os
+import socket
+
+from django.db.models import Q
+from django.utils import timezone
+
+from pretix_eth.models import ConfirmationLease
+
+DEFAULT_LEASE_SECONDS = 300
+
+# Leases are created expired, so that claiming them is always an update
+UNCLAIMED = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def default_worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def claim_order_payments(order_payment_ids, worker_id, lease_seconds=DEFAULT_LEASE_SECONDS,
+                         limit=None):
+    """
+    Claim the order payments in ``order_payment_ids`` for ``worker_id`` for the next
+    ``lease_seconds`` seconds, and return the ids of the ones it holds a lease on.
+
+    Payments that are leased by another worker are left alone until that lease
+    expires; leases already held by ``worker_id`` are renewed. With ``limit``, at
+    most that many payments that ``worker_id`` didn't hold yet are taken on, lowest
+    ids first. Claiming is a single conditional UPDATE, so two workers can never hold
+    the same payment at once.
+    """
+    order_payment_ids = list(order_payment_ids)
+    if not order_payment_ids:
+        return set()
+
+    ConfirmationLease.objects.bulk_create(
+        [
+            ConfirmationLease(order_payment_id=pk, expires_at=UNCLAIMED)
+            for pk in order_payment_ids
+        ],
+        ignore_conflicts=True,
+    )
+
+    now = timezone.now()
+    leases = ConfirmationLease.objects.filter(order_payment_id__in=order_payment_ids)
+    claimable = Q(expires_at__lte=now) | Q(worker_id=worker_id)
+    if limit is not None:
+        free = leases.filter(expires_at__lte=now).exclude(worker_id=worker_id).order_by(
+            "order_payment_id"
+        ).values_list("order_payment_id", flat=True)
+        claimable = Q(worker_id=worker_id) | Q(
+            expires_at__lte=now, order_payment_id__in=list(free[:max(limit, 0)])
+        )
+    leases.filter(claimable).update(
+        worker_id=worker_id,
+        expires_at=now + datetime.timedelta(seconds=lease_seconds),
+    )
+    return set(
+        leases.filter(worker_id=worker_id, expires_at__gt=now)
+        .values_list("order_payment_id", flat=True)
+    )
+
+
+def held_order_payments(worker_id, order_payments=None):
+    """
+    Ids of the order payments that ``worker_id`` holds a lease on, out of the
+    ``order_payments`` queryset if given.
+    """
+    leases = ConfirmationLease.objects.filter(worker_id=worker_id, expires_at__gt=timezone.now())
+    if order_payments is not None:
+        leases = leases.filter(order_payment__in=order_payments)
+    return set(leases.values_list("order_payment_id", flat=True))
+
+
+def holds_lease(order_payment_id, worker_id):
+    return ConfirmationLease.objects.filter(
+        order_payment_id=order_payment_id,
+        worker_id=worker_id,
+        expires_at__gt=timezone.now(),
+    ).exists()
+
+
+def release_order_payments(worker_id):
+    """Give up all leases of ``worker_id``, so that other workers can pick them up."""
+    ConfirmationLease.objects.filter(worker_id=worker_id).update(expires_at=UNCLAIMED)
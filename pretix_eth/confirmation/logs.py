@@ -0,0 +1,197 @@
+import logging
+from collections import OrderedDict
+
+from eth_utils import event_abi_to_log_topic
+from web3 import Web3
+from web3.datastructures import AttributeDict
+
+from pretix_eth.confirmation.engine import ReceiptEngine
+from pretix_eth.exceptions import TransactionProviderError
+from pretix_eth.models import PENDING_PAYMENT_STATES, NetworkCheckpoint, SignedMessage
+from pretix_eth.network.rpc import batch_request, get_web3
+from pretix_eth.network.tokens import TOKEN_ABI
+from pretix_eth.verification import verify_transfer
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LOOKBACK_BLOCKS = 5000
+DEFAULT_MAX_BLOCK_RANGE = 2000
+
+TRANSFER_TOPIC = Web3.to_hex(event_abi_to_log_topic(next(
+    item for item in TOKEN_ABI
+    if item["type"] == "event" and item["name"] == "Transfer"
+)))
+
+
+def address_to_topic(address):
+    return "0x" + address.lower()[2:].rjust(64, "0")
+
+
+def topic_to_address(topic):
+    return "0x" + Web3.to_hex(topic)[-40:]
+
+
+class LogScanEngine(object):
+    """
+    Verifies ERC-20 transfers by scanning ``Transfer`` logs to the receiver address
+    instead of fetching one receipt per signed message.
+
+    Every run scans the blocks between the last checkpoint of a (network, receiver)
+    pair and the newest block that has enough confirmations for all pending transfers,
+    with one ``eth_getLogs`` call per token contract and block range, but never more
+    than ``lookback_blocks``. Logs are matched to pending transfers through an index on
+    (sender, token, network) and must carry the transaction hash of the signed message.
+
+    The checkpoint only moves when a scan covered every pending signed message to the
+    receiver on that network. Otherwise - when the run is split into budget slices, in
+    daemon passes, or when other workers hold some of the payments - the transfers left
+    out may still need the blocks that were just scanned.
+
+    Native transfers don't emit logs, so they - and any ERC-20 transfer that wasn't
+    matched by the scan - are passed on to ``fallback``, a ReceiptEngine.
+    """
+
+    def __init__(self, fallback: ReceiptEngine, lookback_blocks=DEFAULT_LOOKBACK_BLOCKS,
+                 max_block_range=DEFAULT_MAX_BLOCK_RANGE):
+        self.fallback = fallback
+        self.lookback_blocks = lookback_blocks
+        self.max_block_range = max_block_range
+
+    @property
+    def heads(self):
+        return self.fallback.heads
+
+    def close(self):
+        self.fallback.close()
+
+    def verify(self, pending_transfers):
+        """Yield a ``(pending, verdict)`` pair for each of ``pending_transfers``."""
+        groups = OrderedDict()
+        # (network, receiver) -> every signed message to it in this call, native ones too
+        covered = {}
+        unmatched = []
+        for pending in pending_transfers:
+            key = (
+                pending.token.NETWORK_IDENTIFIER,
+                pending.signed_message.recipient_address.lower(),
+            )
+            covered.setdefault(key, set()).add(pending.signed_message.pk)
+            if pending.token.IS_NATIVE_ASSET:
+                unmatched.append(pending)
+                continue
+            groups.setdefault(key, []).append(pending)
+
+        for (network_id, receiver_address), transfers in groups.items():
+            try:
+                matched = self._scan(
+                    network_id, receiver_address, transfers,
+                    covered[network_id, receiver_address],
+                )
+            except Exception as e:
+                logger.warning(
+                    f"Scanning transfer logs on {network_id} failed, "
+                    f"falling back to receipts: {e}"
+                )
+                matched = {}
+
+            for pending in transfers:
+                if pending in matched:
+                    yield pending, matched[pending]
+                else:
+                    unmatched.append(pending)
+
+        yield from self.fallback.verify(unmatched)
+
+    def _scan(self, network_id, receiver_address, transfers, covered):
+        """
+        Return a verdict for each of ``transfers`` that has a matching log. ``covered``
+        are the primary keys of all signed messages to ``receiver_address`` that are
+        being checked along with them.
+        """
+        rpc_url = transfers[0].rpc_url
+        w3 = get_web3(rpc_url)
+        head = self.heads.get(rpc_url, network_id)
+        to_block = head - max(pending.safety_block_count for pending in transfers)
+
+        checkpoint = NetworkCheckpoint.objects.filter(
+            network_identifier=network_id, receiver_address=receiver_address,
+        ).first()
+        from_block = max(to_block - self.lookback_blocks, 0)
+        if checkpoint is not None:
+            from_block = max(from_block, checkpoint.last_scanned_block + 1)
+
+        if from_block > to_block:
+            return {}
+
+        index = {}
+        for pending in transfers:
+            key = (
+                pending.signed_message.sender_address.lower(),
+                pending.token.ADDRESS.lower(),
+                network_id,
+            )
+            index.setdefault(key, []).append(pending)
+
+        token_addresses = sorted(set(pending.token.ADDRESS for pending in transfers))
+        calls = [
+            ("eth_getLogs", [{
+                "address": token_address,
+                "fromBlock": hex(start),
+                "toBlock": hex(min(start + self.max_block_range - 1, to_block)),
+                "topics": [TRANSFER_TOPIC, None, address_to_topic(receiver_address)],
+            }])
+            for token_address in token_addresses
+            for start in range(from_block, to_block + 1, self.max_block_range)
+        ]
+        results = batch_request(w3, calls, self.fallback.batch_size, network_id)
+
+        matched = {}
+        for result in results:
+            if isinstance(result, TransactionProviderError):
+                # Don't move the checkpoint past blocks we couldn't scan
+                raise result
+            for log in result:
+                sender = topic_to_address(log.topics[1])
+                key = (sender, log.address.lower(), network_id)
+                for pending in index.get(key, []):
+                    if Web3.to_hex(log.transactionHash) != pending.transaction_hash.lower():
+                        continue
+                    matched[pending] = verify_transfer(
+                        pending, self._receipt_from_log(log, sender), None, head
+                    )
+
+        if not self._others_pending(transfers[0].token.CHAIN_ID, receiver_address, covered):
+            NetworkCheckpoint.objects.update_or_create(
+                network_identifier=network_id,
+                receiver_address=receiver_address,
+                defaults={"last_scanned_block": to_block, "head_seen": head},
+            )
+        return matched
+
+    @staticmethod
+    def _others_pending(chain_id, receiver_address, covered):
+        """
+        Whether signed messages to ``receiver_address`` other than ``covered`` are
+        still pending, and might be in the blocks that were just scanned.
+        """
+        return SignedMessage.objects.filter(
+            chain_id=chain_id,
+            recipient_address__iexact=receiver_address,
+            transaction_hash__isnull=False,
+            order_payment__state__in=PENDING_PAYMENT_STATES,
+        ).exclude(pk__in=covered).exists()
+
+    @staticmethod
+    def _receipt_from_log(log, sender):
+        """
+        A stand-in receipt for a transaction that emitted ``log``: only successful
+        transactions keep their logs, and the transfer went to the token contract.
+        """
+        return AttributeDict({
+            "status": 1,
+            "blockNumber": log.blockNumber,
+            "transactionHash": log.transactionHash,
+            "to": log.address,
+            "from": sender,
+            "logs": [log],
+        })
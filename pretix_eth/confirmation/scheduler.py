@@ -0,0 +1,263 @@
+import heapq
+import itertools
+import time
+
+from pretix_eth.verification import CONFIRM, INVALIDATE, SKIP, PendingTransfer, Verdict
+
+DEFAULT_MAX_BACKOFF = 300
+
+# Verdicts that depend on a transaction that wasn't found (yet), and get retried with
+# exponential backoff.
+BACKOFF_REASONS = ("not_found", "safe_not_executed", "safe_error", "rpc_error")
+
+
+class HeightQueue(object):
+    """
+    Keys waiting for the chain behind an RPC URL to reach a block height, ordered by
+    that height so that the ones that became eligible can be taken without looking
+    at the rest.
+    """
+
+    def __init__(self):
+        self._heaps = {}
+        self._counter = itertools.count()
+        self._heights = {}
+
+    def __len__(self):
+        return len(self._heights)
+
+    def __contains__(self, key):
+        return key in self._heights
+
+    def push(self, key, rpc_url, height):
+        self._heights[key] = (rpc_url, height)
+        heapq.heappush(self._heaps.setdefault(rpc_url, []), (height, next(self._counter), key))
+
+    def discard(self, key):
+        self._heights.pop(key, None)
+
+    def rpc_urls(self):
+        return [
+            rpc_url for rpc_url in list(self._heaps)
+            if self.lowest_height(rpc_url) is not None
+        ]
+
+    def lowest_height(self, rpc_url):
+        heap = self._heaps.get(rpc_url, [])
+        while heap:
+            height, _, key = heap[0]
+            if self._heights.get(key) == (rpc_url, height):
+                return height
+            # stale entry left behind by pushing again or discarding
+            heapq.heappop(heap)
+        self._heaps.pop(rpc_url, None)
+        return None
+
+    def pop_ready(self, rpc_url, head):
+        """Remove and return the keys waiting for a height at or below ``head``."""
+        ready = []
+        while True:
+            height = self.lowest_height(rpc_url)
+            if height is None or height > head:
+                return ready
+            _, _, key = heapq.heappop(self._heaps[rpc_url])
+            del self._heights[key]
+            ready.append(key)
+
+
+class ConfirmationScheduler(object):
+    """
+    In-memory schedule of when to check each pending signed message next.
+
+    New signed messages are checked about one block after they were submitted.
+    Transactions that were found but are still too young wait in a height-indexed
+    queue per RPC URL until the chain reaches the block at which they become eligible.
+    The chain head is only looked at when that block is expected, based on the
+    network's block time. Transactions that weren't found are retried with exponential
+    backoff, capped at ``max_backoff`` seconds.
+    """
+
+    def __init__(self, max_backoff=DEFAULT_MAX_BACKOFF, clock=time.time):
+        self.max_backoff = max_backoff
+        self.clock = clock
+        self._heap = []
+        self._counter = itertools.count()
+        self._pending = {}
+        self._due_at = {}
+        self._attempts = {}
+        self.waiting = HeightQueue()
+        # rpc_url -> (time to look at the head again, block time of its network)
+        self._head_checks = {}
+
+    def __len__(self):
+        return len(self._pending)
+
+    def _schedule(self, key, due_at):
+        self._due_at[key] = due_at
+        heapq.heappush(self._heap, (due_at, next(self._counter), key))
+
+    def sync(self, pending_transfers):
+        """
+        Replace the tracked pending transfers with ``pending_transfers``, as freshly
+        collected from the database, keeping the schedule of the ones already known.
+        """
+        now = self.clock()
+        fresh = {pending.signed_message.pk: pending for pending in pending_transfers}
+
+        for key in list(self._pending):
+            if key not in fresh:
+                self.forget(key)
+
+        for key, pending in fresh.items():
+            if key not in self._pending:
+                submitted_at = pending.signed_message.created_at.timestamp()
+                self._schedule(key, max(now, submitted_at + pending.token.BLOCK_TIME))
+            self._pending[key] = pending
+
+    def forget(self, key):
+        self._pending.pop(key, None)
+        self._due_at.pop(key, None)
+        self._attempts.pop(key, None)
+        self.waiting.discard(key)
+
+    def _check_head_at(self, rpc_url, check_at, block_time):
+        current = self._head_checks.get(rpc_url)
+        if current is not None:
+            check_at = min(check_at, current[0])
+        self._head_checks[rpc_url] = (check_at, block_time)
+
+    def next_due_at(self):
+        due_at = None
+        while self._heap:
+            due_at, _, key = self._heap[0]
+            if self._due_at.get(key) == due_at:
+                break
+            # stale entry left behind by rescheduling or forgetting
+            heapq.heappop(self._heap)
+            due_at = None
+
+        for rpc_url in list(self._head_checks):
+            if self.waiting.lowest_height(rpc_url) is None:
+                del self._head_checks[rpc_url]
+                continue
+            check_at = self._head_checks[rpc_url][0]
+            due_at = check_at if due_at is None else min(due_at, check_at)
+        return due_at
+
+    def pop_due(self, heads=None):
+        """
+        Remove and return all pending transfers that are due to be checked.
+
+        ``heads`` returns the current block height for an RPC URL; without it, transfers
+        waiting for a block height are only released by ``reschedule``.
+        """
+        now = self.clock()
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            due_at, _, key = heapq.heappop(self._heap)
+            if self._due_at.get(key) != due_at:
+                continue
+            del self._due_at[key]
+            due.append(self._pending[key])
+
+        if heads is None:
+            return due
+
+        for rpc_url in self.waiting.rpc_urls():
+            check_at, block_time = self._head_checks.get(rpc_url, (now, None))
+            if check_at > now:
+                continue
+            del self._head_checks[rpc_url]
+
+            try:
+                head = heads(rpc_url)
+            except Exception:
+                head = None
+            if head is not None:
+                due.extend(self._pending[key] for key in self.waiting.pop_ready(rpc_url, head))
+
+            lowest_height = self.waiting.lowest_height(rpc_url)
+            if lowest_height is not None and block_time is not None:
+                remaining_blocks = 1 if head is None else max(lowest_height - head, 1)
+                self._check_head_at(
+                    rpc_url, now + min(remaining_blocks * block_time, self.max_backoff),
+                    block_time,
+                )
+        return due
+
+    def pop_ready(self, rpc_url, head):
+        """
+        Remove and return the pending transfers that were waiting for the chain behind
+        ``rpc_url`` to reach a block height at or below ``head``, e.g. when a new block
+        is announced.
+        """
+        return [self._pending[key] for key in self.waiting.pop_ready(rpc_url, head)]
+
+    def pop_transactions(self, transaction_hashes):
+        """
+        Remove and return the scheduled pending transfers for ``transaction_hashes``,
+        e.g. when a matching log is announced. Transfers that are waiting for a block
+        height or are already being checked are left alone.
+        """
+        transaction_hashes = {
+            transaction_hash.lower() for transaction_hash in transaction_hashes
+        }
+        if not transaction_hashes:
+            return []
+
+        due = []
+        for key, pending in self._pending.items():
+            if (
+                key in self._due_at
+                and (pending.transaction_hash or "").lower() in transaction_hashes
+            ):
+                del self._due_at[key]
+                due.append(pending)
+        return due
+
+    def requeue(self, pending_transfers):
+        """
+        Put popped ``pending_transfers`` that never got a verdict back into the
+        schedule, e.g. after checking them failed, to be retried with backoff.
+        Transfers that were rescheduled or forgotten in the meantime are left alone.
+        """
+        for pending in pending_transfers:
+            key = pending.signed_message.pk
+            if key in self._pending and key not in self._due_at and key not in self.waiting:
+                self.reschedule(pending, Verdict(SKIP, "rpc_error"))
+
+    def reschedule(self, pending: PendingTransfer, verdict: Verdict):
+        key = pending.signed_message.pk
+        if key not in self._pending:
+            return
+
+        if verdict.action == CONFIRM or (
+            verdict.action == INVALIDATE and verdict.reason not in BACKOFF_REASONS
+        ):
+            self.forget(key)
+            return
+
+        now = self.clock()
+        block_time = pending.token.BLOCK_TIME
+
+        if verdict.reason == "too_young":
+            self._attempts.pop(key, None)
+            self._due_at.pop(key, None)
+            eligible_at = verdict.block_number + pending.safety_block_count
+            self.waiting.push(key, pending.rpc_url, eligible_at)
+            remaining_blocks = max(eligible_at - verdict.head, 1)
+            self._check_head_at(
+                pending.rpc_url,
+                now + min(remaining_blocks * block_time, self.max_backoff),
+                block_time,
+            )
+        elif verdict.reason in BACKOFF_REASONS:
+            self.waiting.discard(key)
+            attempts = self._attempts.get(key, 0)
+            self._attempts[key] = attempts + 1
+            self._schedule(key, now + min(block_time * 2 ** attempts, self.max_backoff))
+        else:
+            # Sender, recipient or amount don't match - that won't change any time soon,
+            # but keep an eye on it in case the payment gets confirmed elsewhere.
+            self.waiting.discard(key)
+            self._schedule(key, now + self.max_backoff)
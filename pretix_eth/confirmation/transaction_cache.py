@@ -0,0 +1,148 @@
+import threading
+
+from django.db import transaction as db_transaction
+
+from pretix_eth.exceptions import TransactionProviderError
+from pretix_eth.metrics import metrics
+from pretix_eth.models import FinalizedTransaction
+from pretix_eth.network.rpc import decode_result, encode_result, get_finality_depth
+from pretix_eth.verification import is_old_enough
+
+LOAD_CHUNK_SIZE = 500
+
+
+def _key(chain_id, transaction_hash):
+    return int(chain_id), transaction_hash.lower()
+
+
+class TransactionCache(object):
+    """
+    Receipts and transactions that are at least ``finality_depth`` blocks deep, and so
+    can't change anymore, keyed by (chain ID, transaction hash) and kept in the
+    FinalizedTransaction table.
+
+    Entries are loaded in bulk with ``load``. ``receipt``, ``transaction`` and ``add``
+    only touch memory and may be called from any thread; entries added since the last
+    ``save`` are written by it, which has to happen on a thread that may use the
+    database.
+    """
+
+    def __init__(self, finality_depth=None):
+        if finality_depth is None:
+            finality_depth = get_finality_depth()
+        self.finality_depth = finality_depth
+        self._lock = threading.Lock()
+        # (chain ID, transaction hash) -> [receipt, transaction]
+        self._entries = {}
+        self._new = set()
+        self._new_transactions = set()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @classmethod
+    def for_transfers(cls, pending_transfers, finality_depth=None):
+        """A cache with the entries of ``pending_transfers`` loaded."""
+        cache = cls(finality_depth)
+        cache.load(
+            (pending.token.CHAIN_ID, pending.transaction_hash) for pending in pending_transfers
+        )
+        return cache
+
+    def load(self, keys):
+        """Load the cached entries for ``keys``, pairs of chain ID and transaction hash."""
+        missing = {}
+        for chain_id, transaction_hash in keys:
+            if transaction_hash is None:
+                continue
+            chain_id, transaction_hash = _key(chain_id, transaction_hash)
+            if (chain_id, transaction_hash) not in self._entries:
+                missing.setdefault(chain_id, set()).add(transaction_hash)
+
+        for chain_id, transaction_hashes in missing.items():
+            transaction_hashes = sorted(transaction_hashes)
+            for start in range(0, len(transaction_hashes), LOAD_CHUNK_SIZE):
+                rows = FinalizedTransaction.objects.filter(
+                    chain_id=chain_id,
+                    transaction_hash__in=transaction_hashes[start:start + LOAD_CHUNK_SIZE],
+                ).values_list("transaction_hash", "receipt", "transaction")
+                for transaction_hash, receipt, transaction in rows:
+                    entry = [decode_result("eth_getTransactionReceipt", receipt), None]
+                    if transaction is not None:
+                        entry[1] = decode_result("eth_getTransactionByHash", transaction)
+                    with self._lock:
+                        self._entries[(chain_id, transaction_hash)] = entry
+
+    def _get(self, chain_id, transaction_hash, index, method):
+        if transaction_hash is None:
+            return None
+        with self._lock:
+            entry = self._entries.get(_key(chain_id, transaction_hash))
+        if entry is None or entry[index] is None:
+            return None
+        metrics.inc("pretix_eth_transaction_cache_hits_total", method=method)
+        return entry[index]
+
+    def receipt(self, chain_id, transaction_hash):
+        return self._get(chain_id, transaction_hash, 0, "eth_getTransactionReceipt")
+
+    def transaction(self, chain_id, transaction_hash):
+        return self._get(chain_id, transaction_hash, 1, "eth_getTransactionByHash")
+
+    def add(self, chain_id, transaction_hash, receipt, transaction, head):
+        """
+        Cache ``receipt``, and ``transaction`` if given, if the receipt is final at
+        block ``head``. Lookups that failed or found nothing are ignored.
+        """
+        if transaction_hash is None:
+            return
+        if receipt is None or isinstance(receipt, TransactionProviderError):
+            return
+        if not is_old_enough(receipt.blockNumber, self.finality_depth, head):
+            return
+        if isinstance(transaction, TransactionProviderError):
+            transaction = None
+
+        key = _key(chain_id, transaction_hash)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._entries[key] = [receipt, transaction]
+                self._new.add(key)
+            elif entry[1] is None and transaction is not None:
+                entry[1] = transaction
+                if key not in self._new:
+                    self._new_transactions.add(key)
+
+    def save(self):
+        """Write the entries that were added since the last call."""
+        with self._lock:
+            new, self._new = self._new, set()
+            new_transactions, self._new_transactions = self._new_transactions, set()
+            entries = {key: list(self._entries[key]) for key in new | new_transactions}
+
+        if not entries:
+            return
+
+        created = []
+        for chain_id, transaction_hash in sorted(new):
+            receipt, transaction = entries[chain_id, transaction_hash]
+            created.append(FinalizedTransaction(
+                chain_id=chain_id,
+                transaction_hash=transaction_hash,
+                block_number=receipt.blockNumber,
+                receipt=encode_result(receipt),
+                transaction=_encode_transaction(transaction),
+            ))
+
+        with db_transaction.atomic():
+            # Entries are immutable, so whoever stored one first wins
+            FinalizedTransaction.objects.bulk_create(created, ignore_conflicts=True)
+            for chain_id, transaction_hash in sorted(new_transactions):
+                FinalizedTransaction.objects.filter(
+                    chain_id=chain_id, transaction_hash=transaction_hash, transaction=None,
+                ).update(transaction=_encode_transaction(entries[chain_id, transaction_hash][1]))
+
+
+def _encode_transaction(transaction):
+    return None if transaction is None else encode_result(transaction)
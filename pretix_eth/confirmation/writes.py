@@ -0,0 +1,81 @@
+from django.db import transaction
+from django.utils import timezone
+
+from pretix_eth.models import SignedMessage, VerificationState
+
+DEFAULT_WRITE_CHUNK_SIZE = 500
+
+STATE_FIELDS = (
+    "receipt_found",
+    "block_number",
+    "verified_sender",
+    "verified_amount",
+    "reason",
+    "next_check_block",
+    "updated_at",
+)
+
+
+class WriteBuffer(object):
+    """
+    Database writes that follow from verdicts, collected so that they can be applied
+    in bulk: one UPDATE for all invalidated signed messages, and one bulk insert and
+    one bulk update for verification state. Confirmations aren't buffered, they are
+    written along with the order payment's confirmation.
+
+    Changes are applied to the in-memory objects right away. ``flush`` writes them
+    in a single transaction; callers flush whenever ``is_full``, so that no
+    transaction covers more than about ``chunk_size`` rows.
+    """
+
+    def __init__(self, chunk_size=DEFAULT_WRITE_CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        self.invalidated = set()
+        # signed message pk -> VerificationState
+        self.states = {}
+
+    def __len__(self):
+        return len(self.invalidated) + len(self.states)
+
+    @property
+    def is_full(self):
+        return len(self) >= self.chunk_size
+
+    def invalidate(self, signed_message: SignedMessage):
+        if not signed_message.invalid:
+            signed_message.invalid = True
+            self.invalidated.add(signed_message.pk)
+
+    def save_state(self, state: VerificationState):
+        # bulk_update() doesn't fill in auto_now fields
+        state.updated_at = timezone.now()
+        self.states[state.signed_message_id] = state
+
+    def flush(self):
+        if not len(self):
+            return
+
+        invalidated, self.invalidated = self.invalidated, set()
+        states, self.states = list(self.states.values()), {}
+
+        with transaction.atomic():
+            if invalidated:
+                SignedMessage.objects.filter(pk__in=invalidated, invalid=False).update(
+                    invalid=True
+                )
+
+            created = [state for state in states if state.pk is None]
+            updated = [state for state in states if state.pk is not None]
+            if created:
+                # A state that appeared in the meantime keeps its values until the
+                # next check; it is only a cache of what is on chain.
+                VerificationState.objects.bulk_create(created, ignore_conflicts=True)
+                # Rows inserted with ignore_conflicts don't get their primary keys
+                # back, but later writes to the same objects have to be updates.
+                created = {state.signed_message_id: state for state in created}
+                for signed_message_id, pk in VerificationState.objects.filter(
+                    signed_message_id__in=created
+                ).values_list("signed_message_id", "pk"):
+                    created[signed_message_id].pk = pk
+            if updated:
+                VerificationState.objects.bulk_update(updated, STATE_FIELDS)
@@ -1,6 +1,7 @@
 from collections import OrderedDict
 
 from django import forms
+from django.db.models import Max, Min
 
 from pretix.base.exporter import ListExporter
 from pretix.base.models import (
@@ -10,7 +11,9 @@ from pretix.base.models import (
 
 from web3 import Web3
 
+from pretix_eth.confirmation.transaction_cache import TransactionCache
 from pretix_eth.models import SignedMessage
+from pretix_eth.network.price_history import PriceHistoryWindow, get_price_sample_at
 from pretix_eth.network.tokens import IToken, \
     all_token_and_network_ids_to_tokens
 
@@ -21,7 +24,7 @@ def date_to_string(time_zone, date):
     return date.astimezone(time_zone).date().strftime('%Y-%m-%d')
 
 
-def payment_to_row(payment):
+def payment_to_row(payment, transaction_cache=None, price_history=None):
     time_zone = pytz.timezone(payment.order.event.settings.timezone)
     if payment.payment_date:
         completion_date = date_to_string(time_zone, payment.payment_date)
@@ -56,6 +59,27 @@ def payment_to_row(payment):
         recipient_address = None
         transaction_hash = None
 
+    # Market rates from the price history, exports don't ask the price oracles
+    rate_at_creation = None
+    rate_at_completion = None
+    if token is not None:
+        sample_at = get_price_sample_at if price_history is None else price_history.sample_at
+        currency = payment.order.event.currency
+        sample = sample_at(token.TOKEN_SYMBOL, currency, payment.created)
+        if sample is not None:
+            rate_at_creation = sample.price
+        if payment.payment_date:
+            sample = sample_at(token.TOKEN_SYMBOL, currency, payment.payment_date)
+            if sample is not None:
+                rate_at_completion = sample.price
+
+    # Only what is cached already, exports make no RPC calls
+    block_number = None
+    if transaction_cache is not None and token is not None and transaction_hash:
+        receipt = transaction_cache.receipt(chain_id, transaction_hash)
+        if receipt is not None:
+            block_number = receipt.blockNumber
+
     row = [
         "Payment",
         payment.order.event.slug,
@@ -73,6 +97,9 @@ def payment_to_row(payment):
         chain_id,
         token_address,
         token_rate,
+        block_number,
+        rate_at_creation,
+        rate_at_completion,
     ]
 
     return row
@@ -87,7 +114,8 @@ class EthereumOrdersExporter(ListExporter):
         'Completion date', 'Status', 'Fiat Amount', 'Token Amount', 'Token',
         'ETH or DAI sender address', 'ETH or DAI receiver address',
         'Transaction Hash', 'Chain ID', 'DAI contract address',
-        'Token Rate at time of order',
+        'Token Rate at time of order', 'Block number',
+        'Market rate at creation', 'Market rate at completion',
     )
 
     @property
@@ -125,9 +153,25 @@ class EthereumOrdersExporter(ListExporter):
         yield self.headers
 
         yield self.ProgressSetTotal(total=payments.count())
+        transaction_cache = TransactionCache()
+        # The receipts of all exported payments at once, rather than a query per row
+        transaction_cache.load(
+            SignedMessage.objects.filter(
+                order_payment__in=payments, transaction_hash__isnull=False,
+            ).values_list('chain_id', 'transaction_hash')
+        )
+        # The price history of the whole export is loaded once per pair
+        window = payments.aggregate(
+            start=Min('created'), created=Max('created'), completed=Max('payment_date'),
+        )
+        price_history = None
+        if window['start'] is not None:
+            price_history = PriceHistoryWindow(
+                window['start'], max(window['created'], window['completed'] or window['created'])
+            )
         for obj in payments:
             if isinstance(obj, OrderPayment):
-                row = payment_to_row(obj)
+                row = payment_to_row(obj, transaction_cache, price_history)
             else:
                 raise Exception(
                     'Invariant:Expected OrderPayment, found {0}'.format((obj))
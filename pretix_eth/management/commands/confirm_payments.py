@@ -1,27 +1,77 @@
+import contextlib
+import datetime
+import itertools
 import logging
-import json
+import signal
+import threading
+import time
+from collections import defaultdict
 
 from django.core.management.base import (
     BaseCommand,
+    CommandError,
 )
+from django.db import close_old_connections, connection, transaction
+from django.db.models import Exists, OuterRef, prefetch_related_objects
+from django.utils import timezone
 from django_scopes import scope
 
-from web3 import Web3
-from web3.providers.auto import load_provider_from_uri
-from web3.exceptions import TransactionNotFound
-
-from pretix.base.models import OrderPayment
-from pretix.base.models.event import Event
-import requests
-
+from pretix.base.models import Event, OrderPayment
+
+from pretix_eth.confirmation.async_engine import DEFAULT_ASYNC_CONCURRENCY, AsyncReceiptEngine
+from pretix_eth.confirmation.budget import RunBudget, prioritize
+from pretix_eth.confirmation.engine import DEFAULT_NETWORK_CONCURRENCY, ReceiptEngine
+from pretix_eth.confirmation.leases import (
+    DEFAULT_LEASE_SECONDS,
+    claim_order_payments,
+    default_worker_id,
+    held_order_payments,
+    holds_lease,
+    release_order_payments,
+)
+from pretix_eth.confirmation.logs import (
+    DEFAULT_LOOKBACK_BLOCKS,
+    DEFAULT_MAX_BLOCK_RANGE,
+    TRANSFER_TOPIC,
+    LogScanEngine,
+    address_to_topic,
+)
+from pretix_eth.confirmation.scheduler import DEFAULT_MAX_BACKOFF, ConfirmationScheduler
+from pretix_eth.confirmation.writes import WriteBuffer
+from pretix_eth.metrics import metrics, serve
+from pretix_eth.models import PENDING_PAYMENT_STATES, SignedMessage, VerificationState
+from pretix_eth.network.rpc import DEFAULT_BATCH_SIZE, DEFAULT_HEAD_MAX_AGE
+from pretix_eth.network.safe import get_safe_transaction_service
+from pretix_eth.network.subscriptions import HeadSubscriptions, SubscriptionTarget
 from pretix_eth.network.tokens import (
     IToken,
     all_token_and_network_ids_to_tokens,
-    TOKEN_ABI,
+)
+from pretix_eth.provider_settings import get_provider_settings
+from pretix_eth.verification import (
+    CONFIRM,
+    INVALIDATE,
+    PendingTransfer,
+    SKIP,
+    Verdict,
+    not_found_verdict,
 )
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_RESCAN_INTERVAL = 60
+# seconds to wait after a failed pass, doubled on every failure in a row
+DEFAULT_ERROR_BACKOFF = 5
+DEFAULT_CHUNK_SIZE = 500
+
+# Verdicts that say nothing about the transaction itself
+STATELESS_REASONS = ("rpc_error", "safe_error", "safe_not_executed", "no_transaction_hash")
+
+
+def count_queries(execute, sql, params, many, context):
+    metrics.inc("pretix_eth_db_queries_total")
+    return execute(sql, params, many, context)
+
 
 class Command(BaseCommand):
     help = (
@@ -35,257 +85,837 @@ class Command(BaseCommand):
             help="Modify database records to confirm payments.",
             action="store_true",
         )
+        parser.add_argument(
+            "--batch-size",
+            help="Maximum number of calls sent in one JSON-RPC batch request.",
+            type=int,
+            default=DEFAULT_BATCH_SIZE,
+        )
+        parser.add_argument(
+            "--engine",
+            help="How to find transactions: look up the receipt of every signed message "
+                 "in batches ('receipts') or concurrently on an event loop ('async'), "
+                 "or scan ERC-20 Transfer logs to the receiver address and only look up "
+                 "receipts for the rest ('logs').",
+            choices=("receipts", "async", "logs"),
+            default="receipts",
+        )
+        parser.add_argument(
+            "--log-lookback-blocks",
+            help="With --engine=logs, how many blocks to scan on a network "
+                 "that has no checkpoint yet.",
+            type=int,
+            default=DEFAULT_LOOKBACK_BLOCKS,
+        )
+        parser.add_argument(
+            "--log-max-block-range",
+            help="With --engine=logs, maximum number of blocks per eth_getLogs call.",
+            type=int,
+            default=DEFAULT_MAX_BLOCK_RANGE,
+        )
+        parser.add_argument(
+            "--head-max-age",
+            help="Seconds a network's block height is reused before it is looked up again.",
+            type=float,
+            default=DEFAULT_HEAD_MAX_AGE,
+        )
+        parser.add_argument(
+            "--workers",
+            help="Verify transactions on this many threads. Runs serially by default.",
+            type=int,
+            default=0,
+        )
+        parser.add_argument(
+            "--max-runtime",
+            help="Stop checking transfers after this many seconds and leave the rest "
+                 "for the next run. Transfers are checked by priority: recent "
+                 "submissions on orders that expire soon come first.",
+            type=float,
+            default=None,
+        )
+        parser.add_argument(
+            "--max-rpc-calls",
+            help="Stop checking transfers after about this many JSON-RPC calls and "
+                 "leave the rest for the next run, checking by priority as with "
+                 "--max-runtime.",
+            type=int,
+            default=None,
+        )
+        parser.add_argument(
+            "--daemon",
+            help="Keep running and check each pending payment on its own schedule "
+                 "until SIGTERM is received.",
+            action="store_true",
+        )
+        parser.add_argument(
+            "--rescan-interval",
+            help="In daemon mode, seconds between looking for new signed messages.",
+            type=float,
+            default=DEFAULT_RESCAN_INTERVAL,
+        )
+        parser.add_argument(
+            "--max-backoff",
+            help="In daemon mode, maximum number of seconds between two checks "
+                 "of the same transaction.",
+            type=float,
+            default=DEFAULT_MAX_BACKOFF,
+        )
+        parser.add_argument(
+            "--subscribe",
+            help="In daemon mode, follow new blocks over WebSocket on the networks that "
+                 "have a {NETWORK_IDENTIFIER}_WS_URL, and check transfers as soon as "
+                 "they have enough confirmations. Falls back to polling over HTTP "
+                 "while disconnected.",
+            action="store_true",
+        )
+        parser.add_argument(
+            "--subscribe-logs",
+            help="With --subscribe, also follow ERC-20 Transfer logs to the receiver "
+                 "addresses, and check a transfer as soon as its log shows up.",
+            action="store_true",
+        )
+        parser.add_argument(
+            "--network-concurrency",
+            help="Maximum number of concurrent batch requests per network "
+                 "when running with --workers.",
+            type=int,
+            default=DEFAULT_NETWORK_CONCURRENCY,
+        )
+        parser.add_argument(
+            "--async-concurrency",
+            help="With --engine=async, maximum number of JSON-RPC requests in flight "
+                 "per RPC URL.",
+            type=int,
+            default=DEFAULT_ASYNC_CONCURRENCY,
+        )
+        parser.add_argument(
+            "--worker-id",
+            help="Name of this worker when several of them split the pending payments. "
+                 "Defaults to the host name and process ID.",
+            default=None,
+        )
+        parser.add_argument(
+            "--max-claims",
+            help="Maximum number of pending payments this worker leases at a time, so "
+                 "that several workers split the backlog between them. Unlimited by "
+                 "default.",
+            type=int,
+            default=None,
+        )
+        parser.add_argument(
+            "--lease-seconds",
+            help="How long a worker keeps the payments it claimed before other workers "
+                 "may take them over. In daemon mode, leases are renewed on every rescan.",
+            type=float,
+            default=DEFAULT_LEASE_SECONDS,
+        )
+
+        parser.add_argument(
+            "--metrics-file",
+            help="Write metrics in the Prometheus text format to this file after every "
+                 "pass, e.g. for the node exporter's textfile collector.",
+            default=None,
+        )
+        parser.add_argument(
+            "--metrics-port",
+            help="Serve metrics in the Prometheus text format on "
+                 "http://127.0.0.1:<port>/metrics while running.",
+            type=int,
+            default=None,
+        )
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.worker_id = default_worker_id()
+        self.lease_seconds = DEFAULT_LEASE_SECONDS
+        self.max_claims = None
+        self.metrics_file = None
+        self.writes = WriteBuffer()
 
     def handle(self, *args, **options):
         no_dry_run = options["no_dry_run"]
         log_verbosity = int(options.get("verbosity", 0))
-
-        with scope(organizer=None):
-            # todo change to events where pending payments are expected only?
-            events = Event.objects.all()
-
-        for event in events:
-            self.confirm_payments_for_event(event, no_dry_run, log_verbosity)
-
-    def confirm_payments_for_event(self, event: Event, no_dry_run, log_verbosity=0):
-        logger.info(f"Event name - {event.name}")
-
-        with scope(organizer=event.organizer):
-            unconfirmed_order_payments = OrderPayment.objects.filter(
-                order__event=event,
-                state__in=(
-                    OrderPayment.PAYMENT_STATE_CREATED,
-                    OrderPayment.PAYMENT_STATE_PENDING,
-                    OrderPayment.PAYMENT_STATE_CANCELED,
-                ),
+        if options["worker_id"]:
+            self.worker_id = options["worker_id"]
+        self.lease_seconds = options["lease_seconds"]
+        self.max_claims = options["max_claims"]
+        if options["daemon"] and self.lease_seconds <= options["rescan_interval"]:
+            raise CommandError("--lease-seconds must be longer than --rescan-interval.")
+        if options["subscribe"] and not options["daemon"]:
+            raise CommandError("--subscribe only works with --daemon.")
+        budget = RunBudget(options["max_runtime"], options["max_rpc_calls"])
+        if options["daemon"] and budget.is_limited:
+            raise CommandError("--max-runtime and --max-rpc-calls don't work with --daemon.")
+
+        engine = ReceiptEngine(
+            batch_size=options["batch_size"],
+            workers=options["workers"],
+            network_concurrency=options["network_concurrency"],
+            head_max_age=options["head_max_age"],
+        )
+        if options["engine"] == "async":
+            engine = AsyncReceiptEngine(
+                concurrency=options["async_concurrency"],
+                head_max_age=options["head_max_age"],
             )
-            if log_verbosity > 0:
-                logger.info(
-                    f" * Found {unconfirmed_order_payments.count()} "
-                    f"unconfirmed order payments"
+        elif options["engine"] == "logs":
+            engine = LogScanEngine(
+                fallback=engine,
+                lookback_blocks=options["log_lookback_blocks"],
+                max_block_range=options["log_max_block_range"],
+            )
+
+        if options["metrics_port"] is not None:
+            serve(metrics, options["metrics_port"])
+        self.metrics_file = options["metrics_file"]
+
+        with connection.execute_wrapper(count_queries), contextlib.closing(engine):
+            if options["daemon"]:
+                self.run_daemon(
+                    engine,
+                    no_dry_run,
+                    log_verbosity,
+                    rescan_interval=options["rescan_interval"],
+                    max_backoff=options["max_backoff"],
+                    subscribe=options["subscribe"],
+                    subscribe_logs=options["subscribe_logs"],
                 )
+            else:
+                try:
+                    with metrics.timer("pretix_eth_pass_duration_seconds"):
+                        pending_transfers = self.collect_all_pending_transfers(
+                            log_verbosity, claim=no_dry_run
+                        )
+                        self.verify_within_budget(
+                            engine,
+                            pending_transfers,
+                            budget,
+                            no_dry_run,
+                            log_verbosity,
+                            slice_size=options["batch_size"] * max(options["workers"], 1),
+                        )
+                finally:
+                    if no_dry_run:
+                        release_order_payments(self.worker_id)
+                self.export_metrics()
+
+        if log_verbosity > 0:
+            self.log_metrics_summary()
+
+    def verify_within_budget(self, engine, pending_transfers, budget, no_dry_run,
+                             log_verbosity=0, slice_size=DEFAULT_BATCH_SIZE):
+        """
+        Verify ``pending_transfers`` with ``engine``. If ``budget`` is limited, they are
+        verified by priority, ``slice_size`` at a time, until the budget is spent; the
+        transfers that were left unchecked are reported and returned.
+        """
+        if not budget.is_limited:
+            self.apply_verdicts(engine.verify(pending_transfers), no_dry_run, log_verbosity)
+            return []
+
+        pending_transfers = prioritize(pending_transfers)
+        checked = 0
+        while checked < len(pending_transfers) and not budget.exhausted:
+            size = slice_size
+            remaining_rpc_calls = budget.remaining_rpc_calls
+            if remaining_rpc_calls is not None:
+                # A transfer takes up to two lookups, its receipt and its transaction
+                size = max(min(size, remaining_rpc_calls // 2), 1)
+            self.apply_verdicts(
+                engine.verify(pending_transfers[checked:checked + size]),
+                no_dry_run,
+                log_verbosity,
+            )
+            checked += size
+
+        left = pending_transfers[checked:]
+        if left:
+            self.report_backlog(left, len(pending_transfers))
+        return left
+
+    @staticmethod
+    def report_backlog(left, total):
+        by_network = defaultdict(int)
+        for pending in left:
+            by_network[pending.token.NETWORK_IDENTIFIER] += 1
+        for network, count in sorted(by_network.items()):
+            metrics.inc("pretix_eth_deferred_transfers_total", count, network=network)
+
+        logger.warning(
+            f"Budget spent, leaving {len(left)} of {total} pending transfers for the next "
+            f"run: " + ", ".join(
+                f"{count} on {network}" for network, count in sorted(by_network.items())
+            )
+        )
 
-        for order_payment in unconfirmed_order_payments:
+    def export_metrics(self):
+        if self.metrics_file:
             try:
-                if log_verbosity > 0:
-                    logger.info(
-                        f" * trying to confirm payment: {order_payment} "
-                        f"(has {order_payment.signed_messages.all().count()} signed messages)"
+                metrics.write_to_file(self.metrics_file)
+            except OSError as e:
+                logger.warning(f"Could not write metrics to {self.metrics_file}: {e}")
+
+    def log_metrics_summary(self):
+        rows = metrics.summary()
+        if not rows:
+            return
+        width = max(len(name + labels) for name, labels, _ in rows)
+        logger.info("Metrics:")
+        for name, labels, value in rows:
+            logger.info(f"  {(name + labels).ljust(width)}  {value}")
+
+    def run_daemon(self, engine, no_dry_run, log_verbosity=0,
+                   rescan_interval=DEFAULT_RESCAN_INTERVAL, max_backoff=DEFAULT_MAX_BACKOFF,
+                   subscribe=False, subscribe_logs=False):
+        """
+        Keep confirming payments until SIGTERM or SIGINT is received.
+
+        Pending signed messages are picked up from the database every
+        ``rescan_interval`` seconds, and each of them is checked whenever the scheduler
+        says it is due instead of on every pass. Transfers that are too young wait until
+        the chain head reaches the block at which they become eligible.
+
+        With ``subscribe``, new blocks (and with ``subscribe_logs``, Transfer logs) are
+        announced over WebSocket where a WebSocket URL is configured, and the transfers
+        they make eligible are checked right away. Networks without a live
+        subscription are polled as usual.
+        """
+        stop = threading.Event()
+        wake = threading.Event()
+
+        def request_stop(signum, frame):
+            logger.info(f"Received signal {signum}, shutting down after the current pass.")
+            stop.set()
+            wake.set()
+
+        previous_handlers = {
+            signum: signal.signal(signum, request_stop)
+            for signum in (signal.SIGTERM, signal.SIGINT)
+        }
+
+        scheduler = ConfirmationScheduler(max_backoff=max_backoff)
+        subscriptions = None
+        if subscribe:
+            subscriptions = HeadSubscriptions(heads=engine.heads, wake=wake.set)
+        next_rescan_at = 0
+
+        def get_head(rpc_url):
+            head = subscriptions.head(rpc_url) if subscriptions is not None else None
+            return engine.heads.get(rpc_url) if head is None else head
+
+        failures = 0
+        try:
+            while not stop.is_set():
+                close_old_connections()
+
+                started_at = time.perf_counter()
+                rescanned = time.time() >= next_rescan_at
+                due = []
+                try:
+                    if rescanned:
+                        pending_transfers = self.collect_all_pending_transfers(
+                            log_verbosity, claim=no_dry_run
+                        )
+                        scheduler.sync(pending_transfers)
+                        if subscriptions is not None:
+                            subscriptions.update(
+                                self.subscription_targets(pending_transfers, subscribe_logs)
+                            )
+                        next_rescan_at = time.time() + rescan_interval
+                        if log_verbosity > 0:
+                            logger.info(
+                                f" * Tracking {len(scheduler)} pending signed messages"
+                            )
+
+                    due = scheduler.pop_due(get_head)
+                    if subscriptions is not None:
+                        new_heads, transaction_hashes = subscriptions.drain()
+                        for rpc_url, head in new_heads.items():
+                            due.extend(scheduler.pop_ready(rpc_url, head))
+                        due.extend(scheduler.pop_transactions(transaction_hashes))
+                    if due:
+                        self.apply_verdicts(
+                            engine.verify(due), no_dry_run, log_verbosity, scheduler
+                        )
+                except Exception:
+                    # e.g. the database went away for a moment: keep the schedule, put
+                    # back whatever was taken out of it and try again after a while
+                    scheduler.requeue(due)
+                    failures += 1
+                    retry_in = min(DEFAULT_ERROR_BACKOFF * 2 ** (failures - 1), max_backoff)
+                    logger.exception(f"Confirmation pass failed, retrying in {retry_in}s")
+                    metrics.inc("pretix_eth_pass_failures_total")
+                    wake.wait(retry_in)
+                    wake.clear()
+                    continue
+                failures = 0
+
+                if rescanned or due:
+                    metrics.observe(
+                        "pretix_eth_pass_duration_seconds", time.perf_counter() - started_at
                     )
-                # it is tempting to put .filter(invalid=False) here, but remember
-                # there is still a chance that low-gas txs are mined later on.
-                for signed_message in order_payment.signed_messages.all():
-                    rpc_urls = json.loads(
-                        order_payment.payment_provider.settings.NETWORK_RPC_URL
+                    self.export_metrics()
+
+                wake_at = next_rescan_at
+                next_due_at = scheduler.next_due_at()
+                if next_due_at is not None:
+                    wake_at = min(wake_at, next_due_at)
+                wake.wait(max(wake_at - time.time(), 0))
+                wake.clear()
+        finally:
+            for signum, handler in previous_handlers.items():
+                signal.signal(signum, handler)
+            if subscriptions is not None:
+                subscriptions.close()
+            if no_dry_run:
+                release_order_payments(self.worker_id)
+            close_old_connections()
+
+    @staticmethod
+    def subscription_targets(pending_transfers, subscribe_logs=False):
+        """
+        What to follow over WebSocket for ``pending_transfers``: new blocks on every
+        chain that has a WebSocket URL, and with ``subscribe_logs`` the Transfer logs of
+        the pending tokens to their receiver addresses.
+        """
+        groups = {}
+        for pending in pending_transfers:
+            if not pending.ws_url:
+                continue
+            group = groups.setdefault(pending.rpc_url, (pending, set(), set()))
+            if subscribe_logs and not pending.token.IS_NATIVE_ASSET:
+                group[1].add(pending.token.ADDRESS.lower())
+                group[2].add(address_to_topic(pending.signed_message.recipient_address))
+
+        targets = {}
+        for rpc_url, (pending, token_addresses, receiver_topics) in groups.items():
+            log_filter = None
+            if token_addresses:
+                log_filter = {
+                    "address": sorted(token_addresses),
+                    "topics": [TRANSFER_TOPIC, None, sorted(receiver_topics)],
+                }
+            targets[rpc_url] = SubscriptionTarget(
+                ws_url=pending.ws_url,
+                network=pending.token.NETWORK_IDENTIFIER,
+                log_filter=log_filter,
+            )
+        return targets
+
+    def collect_all_pending_transfers(self, log_verbosity=0, chunk_size=DEFAULT_CHUNK_SIZE,
+                                      claim=False):
+        """
+        Collect pending transfers of all events at once, so that lookups for the same
+        network can be batched together and different networks verified concurrently.
+
+        Only payments with at least one signed message can be confirmed, so those
+        are streamed from the database in chunks, with their signed messages
+        prefetched per chunk. Invalidated signed messages are still checked, since
+        low-gas transactions may be mined after the retry timeout. Signed messages only
+        expire once their transaction has been looked up and not found, see
+        ``not_found_verdict`` and ``expire_signed_messages``.
+
+        With ``claim``, each chunk is leased to this worker first, and payments that
+        another worker holds a lease on are left out. With ``max_claims``, the worker
+        keeps the payments it holds already and takes on new ones only up to that
+        many in total, leaving the rest of the backlog to other workers.
+        """
+        with scope(organizer=None):
+            events = {event.pk: event for event in self.events_with_pending_transfers()}
+
+            order_payments = OrderPayment.objects.filter(
+                Exists(SignedMessage.objects.filter(order_payment=OuterRef('pk'))),
+                provider='ethereum',
+                state__in=PENDING_PAYMENT_STATES,
+            )
+            if claim and self.max_claims is not None:
+                held = held_order_payments(self.worker_id, order_payments)
+                new_claims = 0
+
+            pending_transfers = []
+            order_payments = order_payments.select_related(
+                'order', 'order__event', 'order__event__organizer',
+            ).order_by('pk').iterator(chunk_size=chunk_size)
+            for chunk in iter(lambda: list(itertools.islice(order_payments, chunk_size)), []):
+                if claim:
+                    order_payment_ids = [order_payment.pk for order_payment in chunk]
+                    limit = None
+                    if self.max_claims is not None:
+                        limit = max(self.max_claims - len(held) - new_claims, 0)
+                        if not limit and held.isdisjoint(order_payment_ids):
+                            continue
+                    claimed = claim_order_payments(
+                        order_payment_ids, self.worker_id, self.lease_seconds, limit=limit,
                     )
-                    full_id = order_payment.full_id
+                    if limit is not None:
+                        new_claims += len(claimed - held)
+                    chunk = [
+                        order_payment for order_payment in chunk
+                        if order_payment.pk in claimed
+                    ]
+
+                prefetch_related_objects(
+                    chunk, 'signed_messages', 'signed_messages__verification_state',
+                )
+
+                for order_payment in chunk:
+                    # Share one event instance per event, so that its payment provider
+                    # is only set up once.
+                    order = order_payment.order
+                    order.event = events.setdefault(order.event_id, order.event)
 
-                    info = order_payment.info_data
                     try:
-                        token: IToken = all_token_and_network_ids_to_tokens[
-                            info["currency_type"]
-                        ]
-                    except KeyError:
-                        logger.info(f"info['currency_type'] = {info['currency_type']}")
-                        logger.warning("Invalid network, invalidating signed message and skipping.")
-                        signed_message.invalidate()
-                        continue
-
-                    expected_network_id = token.NETWORK_IDENTIFIER
-                    expected_network_rpc_url_key = f"{expected_network_id}_RPC_URL"
-
-                    if expected_network_rpc_url_key in rpc_urls:
-                        network_rpc_url = rpc_urls[expected_network_rpc_url_key]
-                    else:
-                        logger.warning(
-                            f"No RPC URL configured for {expected_network_id}. Skipping..."
+                        pending_transfers.extend(
+                            self.collect_pending_transfers(order_payment, log_verbosity)
                         )
-                        continue
+                    except Exception as e:
+                        logger.warning(f"An unhandled error occurred for order: {order_payment}")
+                        logger.warning(e)
 
-                    expected_amount = info["amount"]
+                if self.writes.is_full:
+                    self.flush_writes()
+            self.flush_writes()
+            self.expire_signed_messages(events.values(), leased=claim)
 
-                    # Get balance
-                    w3 = Web3(load_provider_from_uri(network_rpc_url))
-                    transaction_hash = signed_message.transaction_hash
-                    is_safe_app_tx = signed_message.safe_app_transaction_url
+        pending_transfers = self.resolve_safe_transactions(pending_transfers, log_verbosity)
 
-                    if log_verbosity > 0:
-                        if is_safe_app_tx:
-                            logger.info(
-                                f"   * Processing safe app transaction with "
-                                f"safe_internal_tx_url={signed_message.safe_app_transaction_url}"
-                            )
-                        else:
-                            logger.info(
-                                f"   * Looking for a receipt for a transaction with "
-                                f"hash={transaction_hash}"
-                            )
-
-                    try:
-                        # Custom safe transaction handling - can be removed once we create a smart contract for payment handling # noqa: E501
-                        if signed_message.safe_app_transaction_url:
-                            try:
-                                resp = requests.get(signed_message.safe_app_transaction_url)
-
-                                jsonResp = resp.json()
-
-                                if jsonResp.get('isExecuted') and jsonResp.get('isSuccessful'):
-                                    safe_tx_sender = jsonResp.get('safe').lower()
-                                    safe_tx_receiver = jsonResp.get('to')
-                                    payment_amount = int(jsonResp.get('value'))
-                                    transaction_hash = jsonResp.get('transactionHash')
-                                else:
-                                    if log_verbosity > 0:
-                                        logger.info(
-                                            f"   * Safe App Transaction"
-                                            f" safe_tx={signed_message.safe_app_transaction_url} did not execute/is not succesful,"  # noqa: E501
-                                            f" skipping."
-                                        )
-
-                                    if signed_message.age > order_payment.payment_provider.settings.get('PAYMENT_NOT_RECIEVED_RETRY_TIMEOUT', as_type=float):  # noqa: E501
-                                        signed_message.invalidate()
-                                    continue
-                            except Exception:
-                                if log_verbosity > 0:
-                                    logger.info(
-                                        f"   * Safe App Transaction"
-                                        f" safe_tx={signed_message.safe_app_transaction_url} could not be processed,"  # noqa: E501
-                                        f" skipping."
-                                    )
-
-                                if signed_message.age > order_payment.payment_provider.settings.get('PAYMENT_NOT_RECIEVED_RETRY_TIMEOUT', as_type=float):  # noqa: E501
-                                    signed_message.invalidate()
-                                continue
-
-                        receipt = w3.eth.get_transaction_receipt(
-                            transaction_hash
-                        )
-                    except TransactionNotFound:
-                        if log_verbosity > 0:
-                            logger.info(
-                                f"   * Transaction"
-                                f" hash={transaction_hash} not found,"
-                                f" skipping."
-                            )
+        if log_verbosity > 0:
+            logger.info(
+                f" * Found {len(pending_transfers)} pending transfers "
+                f"in {len(events)} events"
+            )
 
-                        if signed_message.age > order_payment.payment_provider.settings.get('PAYMENT_NOT_RECIEVED_RETRY_TIMEOUT', as_type=float):  # noqa: E501
-                            signed_message.invalidate()
-                        continue
+        return pending_transfers
+
+    @staticmethod
+    def events_with_pending_transfers():
+        """Events with pending ethereum payments that have at least one signed message."""
+        return Event.objects.filter(
+            Exists(SignedMessage.objects.filter(
+                order_payment__order__event=OuterRef('pk'),
+                order_payment__provider='ethereum',
+                order_payment__state__in=PENDING_PAYMENT_STATES,
+            )),
+        ).select_related('organizer')
+
+    def expire_signed_messages(self, events, leased=False):
+        """
+        Invalidate the signed messages of pending payments in ``events`` whose
+        transaction was last looked up and not found, and which are older than the
+        event's retry timeout, with one UPDATE per distinct retry timeout instead of
+        one per signed message. With ``leased``, only payments that this worker holds
+        a lease on are touched.
+
+        This catches messages that aren't looked up in this pass (e.g. left for a
+        later run by the budget); like the invalidations that follow from a lookup, it
+        only allows the customer to pay again: invalidated signed messages are still
+        checked.
+        """
+        event_ids_by_timeout = defaultdict(list)
+        for event in events:
+            provider = event.get_payment_providers(cached=True).get('ethereum')
+            if provider is None:
+                continue
+            retry_timeout = get_provider_settings(provider).retry_timeout
+            event_ids_by_timeout[retry_timeout].append(event.pk)
+
+        now = timezone.now()
+        expired = 0
+        for retry_timeout, event_ids in event_ids_by_timeout.items():
+            signed_messages = SignedMessage.objects.filter(
+                invalid=False,
+                created_at__lt=now - datetime.timedelta(seconds=retry_timeout),
+                verification_state__reason="not_found",
+                order_payment__order__event_id__in=event_ids,
+                order_payment__provider='ethereum',
+                order_payment__state__in=PENDING_PAYMENT_STATES,
+            )
+            if leased:
+                signed_messages = signed_messages.filter(
+                    order_payment__confirmation_lease__worker_id=self.worker_id,
+                    order_payment__confirmation_lease__expires_at__gt=now,
+                )
+            expired += signed_messages.update(invalid=True)
 
-                    if receipt.status == 0:
-                        if log_verbosity > 0:
-                            logger.info(
-                                f"   * Transaction hash={transaction_hash}"
-                                f" was has status=0, invalidating."
-                            )
-                        signed_message.invalidate()
-                        continue
+        if expired:
+            metrics.inc(
+                "pretix_eth_verdicts_total", expired, action=INVALIDATE, reason="expired"
+            )
+            logger.info(f" * Invalidated {expired} expired signed messages")
+        return expired
+
+    def resolve_safe_transactions(self, pending_transfers, log_verbosity=0):
+        """
+        Look up the executed transactions of Safe transfers, all at once. Return the
+        pending transfers that have a transaction to verify; Safe transfers that
+        haven't been executed (or couldn't be looked up) are dealt with right away.
+        """
+        # Custom safe transaction handling - can be removed once we create a smart contract for payment handling # noqa: E501
+        safe_transactions = get_safe_transaction_service().get_many(
+            pending.signed_message.safe_app_transaction_url
+            for pending in pending_transfers
+            if pending.signed_message.safe_app_transaction_url
+        )
 
-                    block_number = receipt.blockNumber
+        resolved = []
+        verdicts = []
+        for pending in pending_transfers:
+            safe_app_transaction_url = pending.signed_message.safe_app_transaction_url
+            if not safe_app_transaction_url:
+                resolved.append(pending)
+                continue
 
-                    safety_block_count = order_payment.payment_provider.settings.get(
-                        'SAFETY_BLOCK_COUNT',
-                        as_type=int,
-                        default=10,
+            safe_transaction = safe_transactions[safe_app_transaction_url]
+            if isinstance(safe_transaction, Exception):
+                if log_verbosity > 0:
+                    logger.info(
+                        f"   * Safe App Transaction"
+                        f" safe_tx={safe_app_transaction_url} could not be processed,"
+                        f" skipping."
                     )
+                verdicts.append((pending, not_found_verdict(pending, "safe_error")))
+                continue
 
-                    if (
-                            block_number is None
-                            or block_number + safety_block_count > w3.eth.get_block_number()
-                    ):
-                        logger.warning(
-                            f"  * Transfer found in a block that is too young, "
-                            f"waiting until at least {safety_block_count} more blocks are confirmed."  # noqa: E501
-                        )
-                        continue
+            if safe_transaction is None:
+                if log_verbosity > 0:
+                    logger.info(
+                        f"   * Safe App Transaction"
+                        f" safe_tx={safe_app_transaction_url} did not execute/is not succesful,"  # noqa: E501
+                        f" skipping."
+                    )
+                verdicts.append((pending, not_found_verdict(pending, "safe_not_executed")))
+                continue
+
+            pending.safe_transaction = safe_transaction
+            pending.transaction_hash = safe_transaction["transaction_hash"]
+            resolved.append(pending)
+
+        self.apply_verdicts(verdicts, False)
+
+        return resolved
+
+    def apply_verdicts(self, verdicts, no_dry_run, log_verbosity=0, scheduler=None):
+        """
+        Apply ``verdicts`` as they come in. Invalidations, confirmation flags and
+        verification state are written in bulk, whenever enough have piled up and
+        at the end.
+        """
+        try:
+            for pending, verdict in verdicts:
+                metrics.inc(
+                    "pretix_eth_messages_examined_total",
+                    network=pending.token.NETWORK_IDENTIFIER,
+                )
+                try:
+                    self.apply_verdict(pending, verdict, no_dry_run, log_verbosity)
+                except Exception as e:
+                    logger.warning(
+                        f"An unhandled error occurred for order: {pending.order_payment}"
+                    )
+                    logger.warning(e)
+                    verdict = Verdict(SKIP, "rpc_error")
+
+                if scheduler is not None:
+                    scheduler.reschedule(pending, verdict)
+
+                if self.writes.is_full:
+                    self.flush_writes()
+        finally:
+            self.flush_writes()
+
+    def flush_writes(self):
+        try:
+            self.writes.flush()
+        except Exception as e:
+            logger.warning("An unhandled error occurred while writing verdicts")
+            logger.warning(e)
+
+    def collect_pending_transfers(self, order_payment: OrderPayment, log_verbosity=0):
+        """
+        Yield a PendingTransfer for every signed message of ``order_payment`` that has
+        a transaction to look up. Signed messages that can be decided without touching
+        the chain are dealt with right away. Safe transactions are resolved later, see
+        ``resolve_safe_transactions``.
+        """
+        if log_verbosity > 0:
+            logger.info(
+                f" * trying to confirm payment: {order_payment} "
+                f"(has {len(order_payment.signed_messages.all())} signed messages)"
+            )
 
-                    if token.IS_NATIVE_ASSET:
-                        # ETH
-                        if is_safe_app_tx:
-                            receipt_receiver = safe_tx_receiver
-                        else:
-                            receipt_receiver = receipt.to.lower()
+        provider_settings = get_provider_settings(order_payment.payment_provider)
+        info = order_payment.info_data
 
-                            payment_amount = w3.eth.get_transaction(
-                                transaction_hash
-                            ).value
+        # it is tempting to put .filter(invalid=False) here, but remember
+        # there is still a chance that low-gas txs are mined later on.
+        for signed_message in order_payment.signed_messages.all():
+            try:
+                token: IToken = all_token_and_network_ids_to_tokens[
+                    info["currency_type"]
+                ]
+            except KeyError:
+                logger.info(f"info['currency_type'] = {info['currency_type']}")
+                logger.warning("Invalid network, invalidating signed message and skipping.")
+                metrics.inc(
+                    "pretix_eth_verdicts_total", action=INVALIDATE, reason="invalid_currency"
+                )
+                self.writes.invalidate(signed_message)
+                continue
 
-                        correct_recipient = (
-                            receipt_receiver == signed_message.recipient_address.lower()
-                        )
+            expected_network_id = token.NETWORK_IDENTIFIER
+            network_rpc_url = provider_settings.get_rpc_url(expected_network_id)
 
-                    else:
-                        # DAI
-                        contract = w3.eth.contract(address=token.ADDRESS,
-                                                   abi=TOKEN_ABI)
+            if network_rpc_url is None:
+                logger.warning(
+                    f"No RPC URL configured for {expected_network_id}. Skipping..."
+                )
+                continue
+
+            pending = PendingTransfer(
+                signed_message=signed_message,
+                order_payment=order_payment,
+                token=token,
+                rpc_url=network_rpc_url,
+                expected_amount=info["amount"],
+                retry_timeout=provider_settings.retry_timeout,
+                safety_block_count=provider_settings.safety_block_count,
+                state=getattr(signed_message, 'verification_state', None),
+                ws_url=provider_settings.get_ws_url(expected_network_id),
+            )
 
-                        # This may warn about mismatched ABI if its a smart contract wallet tx because of intermediary function calls - but it'll still process the Transfer event correctly # noqa: E501
-                        transaction_details = (
-                            contract.events.Transfer().process_receipt(receipt)[0].args
-                        )
+            if not pending.transaction_hash and not signed_message.safe_app_transaction_url:
+                # Signed messages from before transaction hashes were recorded
+                logger.warning(
+                    f"   * Signed message {signed_message.pk} has no transaction hash, "
+                    f"skipping."
+                )
+                self.apply_verdict(
+                    pending, not_found_verdict(pending, "no_transaction_hash"), False,
+                    log_verbosity,
+                )
+                continue
 
-                        payment_amount = transaction_details.value
-                        receipt_receiver = transaction_details.to.lower()
+            if log_verbosity > 0:
+                if signed_message.safe_app_transaction_url:
+                    logger.info(
+                        f"   * Processing safe app transaction with "
+                        f"safe_internal_tx_url={signed_message.safe_app_transaction_url}"
+                    )
+                else:
+                    logger.info(
+                        f"   * Looking for a receipt for a transaction with "
+                        f"hash={pending.transaction_hash}"
+                    )
 
-                        # Safe has intermediary function calls (which is not the token address), so we'll need to pull the receiver address from the internal safe transaction rather than the tx receipt # noqa: E501
-                        if is_safe_app_tx:
-                            correct_contract = token.ADDRESS.lower() == safe_tx_receiver.lower()
-                        else:
-                            correct_contract = token.ADDRESS.lower() == receipt.to.lower()
+            yield pending
 
-                        correct_recipient = correct_contract and (
-                            receipt_receiver == signed_message.recipient_address.lower())
+    def apply_verdict(self, pending: PendingTransfer, verdict: Verdict, no_dry_run,
+                      log_verbosity=0):
+        signed_message = pending.signed_message
+        order_payment = pending.order_payment
+        full_id = order_payment.full_id
+        token = pending.token
+        transaction_hash = pending.transaction_hash
 
-                    if is_safe_app_tx:
-                        receipt_sender = safe_tx_sender
-                    else:
-                        receipt_sender = getattr(receipt, "from").lower()
+        metrics.inc("pretix_eth_verdicts_total", action=verdict.action, reason=verdict.reason)
 
-                    correct_sender = receipt_sender == signed_message.sender_address.lower()
+        if verdict.reason == "not_found" and log_verbosity > 0:
+            logger.info(
+                f"   * Transaction"
+                f" hash={transaction_hash} not found,"
+                f" skipping."
+            )
+        elif verdict.reason == "failed" and log_verbosity > 0:
+            logger.info(
+                f"   * Transaction hash={transaction_hash}"
+                f" was has status=0, invalidating."
+            )
+        elif verdict.reason == "rpc_error":
+            logger.warning(
+                f"  * Could not look up transaction hash={transaction_hash}, skipping."
+            )
+        elif verdict.reason == "too_young":
+            logger.warning(
+                f"  * Transfer found in a block that is too young, "
+                f"waiting until at least {pending.safety_block_count} more blocks are confirmed."  # noqa: E501
+            )
+        elif verdict.reason in ("mismatch", "no_transfer"):
+            logger.warning(
+                "  * Transaction hash provided does not match "
+                "correct sender and recipient"
+            )
+        elif verdict.reason == "no_payment":
+            logger.info(f"No payments found for {full_id}")
+        elif verdict.reason == "underpaid":
+            logger.info(
+                f"Payments found for {full_id} at {signed_message.sender_address}:"
+            )
+            logger.warning(
+                f"  * Expected payment of at least"
+                f" {pending.expected_amount} {token.TOKEN_SYMBOL}"
+            )
+            logger.warning(
+                f"  * Given payment was"
+                f" {verdict.payment_amount} {token.TOKEN_SYMBOL}"
+            )
+            logger.warning(f"  * Skipping")  # noqa: F541
 
-                    if not (correct_sender and correct_recipient):
-                        logger.warning(
-                            "  * Transaction hash provided does not match "
-                            "correct sender and recipient"
-                        )
-                        if log_verbosity > 0:
-                            logger.info(
-                                f"receipt sender={receipt_sender}, "
-                                f"expected sender={signed_message.sender_address.lower()}"
-                            )
-                            logger.info(
-                                f"receipt recipient={receipt_receiver}, "
-                                f"expected recipient={signed_message.recipient_address.lower()}"
-                            )
-                        continue
+        if verdict.action == INVALIDATE:
+            self.writes.invalidate(signed_message)
+        elif verdict.action == CONFIRM:
+            logger.info(
+                f"Payments found for {full_id} at {signed_message.sender_address}:"
+            )
+            if no_dry_run and not holds_lease(order_payment.pk, self.worker_id):
+                logger.warning(
+                    f"  * Lease on order payment {full_id} expired, "
+                    f"leaving it to the worker that holds it now."
+                )
+                return
+            elif no_dry_run:
+                logger.info(f"  * Confirming order payment {full_id}")
+                # The exporter relies on is_confirmed, so it is written along with
+                # the confirmation rather than buffered
+                with scope(organizer=None), transaction.atomic():
+                    order_payment.confirm()
+                    SignedMessage.objects.filter(pk=signed_message.pk).update(
+                        is_confirmed=True
+                    )
+                signed_message.is_confirmed = True
+            else:
+                logger.info(
+                    f"  * DRY RUN: Would confirm order payment {full_id}"
+                )
 
-                    if payment_amount > 0:
-                        logger.info(
-                            f"Payments found for {full_id} at {signed_message.sender_address}:"
-                        )
-                        if payment_amount < expected_amount:
-                            logger.warning(
-                                f"  * Expected payment of at least"
-                                f" {expected_amount} {token.TOKEN_SYMBOL}"
-                            )
-                            logger.warning(
-                                f"  * Given payment was"
-                                f" {payment_amount} {token.TOKEN_SYMBOL}"
-                            )
-                            logger.warning(f"  * Skipping")  # noqa: F541
-                            continue
-                        if no_dry_run:
-                            logger.info(f"  * Confirming order payment {full_id}")
-                            with scope(organizer=None):
-                                order_payment.confirm()
-                            signed_message.is_confirmed = True
-                            signed_message.save()
-                        else:
-                            logger.info(
-                                f"  * DRY RUN: Would confirm order payment {full_id}"
-                            )
-                    else:
-                        logger.info(f"No payments found for {full_id}")
-            except Exception as e:
-                logger.warning(f"An unhandled error occurred for order: {order_payment}")
-                logger.warning(e)
+        self.record_verification_state(pending, verdict)
+
+    def record_verification_state(self, pending: PendingTransfer, verdict: Verdict):
+        """
+        Remember what the chain said about a signed message, so that later runs can
+        skip lookups that cannot change the verdict. This only caches what is on
+        chain, so it is kept up to date in dry runs too.
+        """
+        if verdict.reason in STATELESS_REASONS:
+            return
+
+        next_check_block = None
+        if verdict.reason == "too_young":
+            next_check_block = verdict.block_number + pending.safety_block_count
+
+        state = pending.state
+        if state is not None and (
+            state.reason, state.block_number, state.next_check_block
+        ) == (verdict.reason, verdict.block_number, next_check_block):
+            return
+
+        if state is None:
+            state = VerificationState(signed_message=pending.signed_message)
+        state.receipt_found = verdict.block_number is not None
+        state.block_number = verdict.block_number
+        state.verified_sender = verdict.sender
+        state.verified_amount = verdict.payment_amount
+        state.reason = verdict.reason
+        state.next_check_block = next_check_block
+
+        pending.state = state
+        self.writes.save_state(state)
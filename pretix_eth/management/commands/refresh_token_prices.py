@@ -0,0 +1,100 @@
+import datetime
+import logging
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Q
+from django.utils import timezone
+from django_scopes import scope
+
+from pretix.base.models import Event
+
+from pretix_eth.cache import get_cache, local_cache
+from pretix_eth.network import price_history
+from pretix_eth.network.helpers import (
+    PRICE_MAX_AGE,
+    REFRESH_PRICE_DEADLINE,
+    REFRESH_PRICE_REQUEST_TIMEOUT,
+    aggregate_prices,
+    cache_prices,
+    get_quotes_from_oracles,
+)
+from pretix_eth.network.tokens import registry
+from pretix_eth.provider_settings import get_provider_settings
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = (
+        "Fetch the market prices of all tokens that events take payments in and put them "
+        f"in the shared cache, so that checkouts don't have to. Run this more often than "
+        f"every {PRICE_MAX_AGE // 60} minutes, e.g. from cron every 5 minutes."
+    )
+
+    def handle(self, *args, **options):
+        log_verbosity = int(options.get("verbosity", 0))
+
+        if get_cache() is local_cache:
+            logger.warning(
+                "pretix has no shared cache (redis or memcached), so the prices fetched "
+                "here can't be shared with the processes serving checkouts."
+            )
+
+        pairs = self.collect_price_pairs()
+        if log_verbosity > 0:
+            logger.info(f" * Refreshing prices of {len(pairs)} token and currency pairs")
+
+        # One batched request per oracle for all pairs. Nobody waits for this, so slow
+        # oracles get more time than at checkout
+        quotes = get_quotes_from_oracles(
+            pairs, deadline=REFRESH_PRICE_DEADLINE, timeout=REFRESH_PRICE_REQUEST_TIMEOUT
+        )
+        prices = cache_prices(aggregate_prices(quotes))
+        with scope(organizer=None):
+            price_history.record_prices(prices, quotes)
+            deleted = price_history.downsample()
+        if log_verbosity > 0 and deleted:
+            logger.info(f" * Downsampled the price history by {deleted} samples")
+
+        failed = []
+        for token_symbol, fiat_currency in sorted(pairs):
+            price = prices.get((token_symbol, fiat_currency))
+            if price is None:
+                failed.append(f"{token_symbol}/{fiat_currency}")
+            elif log_verbosity > 0:
+                logger.info(f"   * {token_symbol}/{fiat_currency}: {price}")
+
+        if failed:
+            raise CommandError(f"Could not refresh the prices of {', '.join(failed)}")
+
+    @staticmethod
+    def collect_price_pairs():
+        """
+        The (token symbol, fiat currency) pairs with a market price that events with
+        the Ethereum payment provider enabled may be paid in, leaving out events that
+        are over.
+        """
+        now = timezone.now()
+        pairs = set()
+        with scope(organizer=None):
+            events = Event.objects.filter(
+                plugins__contains='pretix_eth',
+                _settings_objects__key='payment_ethereum__enabled',
+                _settings_objects__value='True',
+            ).filter(
+                Q(has_subevents=True)
+                | Q(date_to__gte=now)
+                | Q(date_to__isnull=True, date_from__gte=now - datetime.timedelta(days=1))
+            ).select_related('organizer').distinct()
+
+            for event in events:
+                provider = event.get_payment_providers(cached=True).get('ethereum')
+                if provider is None:
+                    continue
+                provider_settings = get_provider_settings(provider)
+                for token in registry:
+                    if token.is_allowed(
+                        provider_settings.token_rates, provider_settings.networks
+                    ) and token.has_live_price(event.currency):
+                        pairs.add((token.TOKEN_SYMBOL, event.currency))
+        return pairs
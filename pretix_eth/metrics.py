@@ -0,0 +1,213 @@
+import contextlib
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+DEFINITIONS = {
+    "pretix_eth_messages_examined_total": (
+        "counter", "Signed messages checked by confirm_payments."
+    ),
+    "pretix_eth_verdicts_total": (
+        "counter", "Decisions on signed messages, by action and reason."
+    ),
+    "pretix_eth_rpc_calls_total": (
+        "counter", "JSON-RPC calls made, by network and method."
+    ),
+    "pretix_eth_rpc_request_seconds": (
+        "histogram", "Latency of JSON-RPC round trips, by network and method."
+    ),
+    "pretix_eth_rpc_failovers_total": (
+        "counter", "JSON-RPC requests retried on another endpoint after an error."
+    ),
+    "pretix_eth_rpc_hedged_requests_total": (
+        "counter", "JSON-RPC requests also sent to a second endpoint for being slow."
+    ),
+    "pretix_eth_transaction_cache_hits_total": (
+        "counter", "Lookups answered by the cache of finalized transactions, by method."
+    ),
+    "pretix_eth_deferred_transfers_total": (
+        "counter", "Pending transfers left for the next run because its budget was spent."
+    ),
+    "pretix_eth_db_queries_total": (
+        "counter", "Database queries made by confirm_payments."
+    ),
+    "pretix_eth_pass_duration_seconds": (
+        "histogram", "Duration of confirm_payments passes."
+    ),
+}
+
+
+def _format_labels(labels, extra=()):
+    items = sorted(labels) + list(extra)
+    if not items:
+        return ""
+    escaped = (
+        '{}="{}"'.format(
+            key, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        )
+        for key, value in items
+    )
+    return "{" + ",".join(escaped) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metrics(object):
+    """
+    Counters and histograms, kept in memory and rendered in the Prometheus text format.
+
+    Label values are passed as keyword arguments. All methods are thread safe.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._counters = defaultdict(float)
+        # (name, labels) -> [bucket counts..., sum, count]
+        self._histograms = {}
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    def inc(self, name, amount=1, **labels):
+        with self._lock:
+            self._counters[self._key(name, labels)] += amount
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [0] * (len(self.buckets) + 2)
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram[index] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started_at, **labels)
+
+    def value(self, name, **labels):
+        """Current value of a counter, or the number of observations of a histogram."""
+        key = self._key(name, labels)
+        with self._lock:
+            if key in self._histograms:
+                return self._histograms[key][-1]
+            return self._counters.get(key, 0)
+
+    def total(self, name):
+        """Value of a counter summed over all its labels."""
+        with self._lock:
+            return sum(value for (key, _), value in self._counters.items() if key == name)
+
+    def clear(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    def render(self):
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((key, list(value)) for key, value in self._histograms.items())
+
+        lines = []
+        described = set()
+
+        def describe(name):
+            if name not in described and name in DEFINITIONS:
+                metric_type, help_text = DEFINITIONS[name]
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {metric_type}")
+            described.add(name)
+
+        for (name, labels), value in counters:
+            describe(name)
+            lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+
+        for (name, labels), histogram in histograms:
+            describe(name)
+            bucket_counts = histogram[:len(self.buckets)] + [histogram[-1]]
+            for bound, count in zip(self.buckets + (float("inf"),), bucket_counts):
+                lines.append(
+                    f"{name}_bucket{_format_labels(labels, [('le', _format_value(bound))])}"
+                    f" {count}"
+                )
+            lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(histogram[-2])}")
+            lines.append(f"{name}_count{_format_labels(labels)} {histogram[-1]}")
+
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """Rows of ``(metric, labels, value)`` for a human readable overview."""
+        with self._lock:
+            rows = [
+                (name, _format_labels(labels), _format_value(value))
+                for (name, labels), value in sorted(self._counters.items())
+            ]
+            for (name, labels), histogram in sorted(self._histograms.items()):
+                count, total = histogram[-1], histogram[-2]
+                rows.append((
+                    name,
+                    _format_labels(labels),
+                    f"{count} x {total / count if count else 0:.3f}s avg",
+                ))
+        return rows
+
+    def write_to_file(self, path):
+        """Atomically replace ``path`` with the current metrics, e.g. for a textfile collector."""
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, temporary_path = tempfile.mkstemp(dir=directory, prefix=".pretix_eth_metrics")
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(self.render())
+            os.replace(temporary_path, path)
+        except Exception:
+            os.unlink(temporary_path)
+            raise
+
+
+def serve(metrics, port, address="127.0.0.1"):
+    """Serve ``metrics`` on ``http://address:port/metrics`` from a background thread."""
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = metrics.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logger.debug(format % args)
+
+    server = ThreadingHTTPServer((address, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# Shared by everything that runs in a confirm_payments process
+metrics = Metrics()
@@ -0,0 +1,26 @@
+# Generated by Django 3.2.25 on 2026-10-18 17:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pretix_eth', '0009_auto_20230627_1210'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NetworkCheckpoint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False)),
+                ('network_identifier', models.CharField(max_length=64)),
+                ('receiver_address', models.CharField(max_length=42)),
+                ('last_scanned_block', models.BigIntegerField()),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'unique_together': {('network_identifier', 'receiver_address')},
+            },
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 3.2.25 on 2026-10-18 17:36
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pretix_eth', '0010_networkcheckpoint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='networkcheckpoint',
+            name='head_seen',
+            field=models.BigIntegerField(null=True),
+        ),
+        migrations.CreateModel(
+            name='VerificationState',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False)),
+                ('receipt_found', models.BooleanField(default=False)),
+                ('block_number', models.BigIntegerField(null=True)),
+                ('verified_sender', models.CharField(max_length=42, null=True)),
+                ('verified_amount', models.DecimalField(decimal_places=0, max_digits=78, null=True)),
+                ('reason', models.CharField(blank=True, max_length=32)),
+                ('next_check_block', models.BigIntegerField(null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('signed_message', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='verification_state', to='pretix_eth.signedmessage')),
+            ],
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 3.2.25 on 2026-10-18 17:43
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pretixbase', '0208_auto_20220214_1632'),
+        ('pretix_eth', '0011_verificationstate'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ConfirmationLease',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False)),
+                ('worker_id', models.CharField(blank=True, max_length=255)),
+                ('expires_at', models.DateTimeField(db_index=True)),
+                ('order_payment', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='confirmation_lease', to='pretixbase.orderpayment')),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-18 17:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pretix_eth', '0012_confirmationlease'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='signedmessage',
+            name='created_at',
+            field=models.DateTimeField(db_index=True, editable=False, null=True),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 3.2.25 on 2026-10-18 18:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pretix_eth', '0013_signedmessage_created_at_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FinalizedTransaction',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False)),
+                ('chain_id', models.IntegerField()),
+                ('transaction_hash', models.CharField(max_length=66)),
+                ('block_number', models.BigIntegerField()),
+                ('receipt', models.TextField()),
+                ('transaction', models.TextField(null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'unique_together': {('chain_id', 'transaction_hash')},
+            },
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 3.2.25 on 2026-10-18 18:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pretix_eth', '0014_finalizedtransaction'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PriceSample',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False)),
+                ('token_symbol', models.CharField(max_length=16)),
+                ('fiat_currency', models.CharField(max_length=3)),
+                ('timestamp', models.DateTimeField()),
+                ('price', models.DecimalField(decimal_places=8, max_digits=28)),
+                ('quote_count', models.PositiveSmallIntegerField()),
+                ('lowest_quote', models.DecimalField(decimal_places=8, max_digits=28)),
+                ('highest_quote', models.DecimalField(decimal_places=8, max_digits=28)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='pricesample',
+            index=models.Index(fields=['token_symbol', 'fiat_currency', 'timestamp'], name='pretix_eth__token_s_611f5a_idx'),
+        ),
+    ]
@@ -3,6 +3,13 @@ from django.utils import timezone
 
 from pretix.base.models import OrderPayment
 
+# Payments whose signed messages are still checked against the chain
+PENDING_PAYMENT_STATES = (
+    OrderPayment.PAYMENT_STATE_CREATED,
+    OrderPayment.PAYMENT_STATE_PENDING,
+    OrderPayment.PAYMENT_STATE_CANCELED,
+)
+
 
 class SignedMessage(models.Model):
 
@@ -19,7 +26,7 @@ class SignedMessage(models.Model):
     transaction_hash = models.CharField(max_length=66, null=True, unique=True)
     safe_app_transaction_url = models.TextField(null=True, unique=True)
     invalid = models.BooleanField(default=False)
-    created_at = models.DateTimeField(editable=False, null=True)
+    created_at = models.DateTimeField(editable=False, null=True, db_index=True)
     is_confirmed = models.BooleanField(
         default=False)  # true for the payment that arrived
 
@@ -46,3 +53,87 @@ class SignedMessage(models.Model):
             order_payment__order=self.order_payment.order,
             invalid=False
         ).exists()
+
+
+class NetworkCheckpoint(models.Model):
+    """Last block scanned for transfers to a receiver address on a network."""
+
+    network_identifier = models.CharField(max_length=64)
+    receiver_address = models.CharField(max_length=42)
+    last_scanned_block = models.BigIntegerField()
+    head_seen = models.BigIntegerField(null=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = (('network_identifier', 'receiver_address'),)
+
+
+class VerificationState(models.Model):
+    """
+    What the chain said about a signed message the last time it was checked, so that
+    later runs can skip lookups whose outcome cannot have changed.
+    """
+
+    signed_message = models.OneToOneField(
+        to=SignedMessage,
+        on_delete=models.CASCADE,
+        related_name='verification_state',
+    )
+    receipt_found = models.BooleanField(default=False)
+    block_number = models.BigIntegerField(null=True)
+    verified_sender = models.CharField(max_length=42, null=True)
+    verified_amount = models.DecimalField(max_digits=78, decimal_places=0, null=True)
+    reason = models.CharField(max_length=32, blank=True)
+    next_check_block = models.BigIntegerField(null=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+
+class ConfirmationLease(models.Model):
+    """Which confirm_payments worker may process an order payment, and until when."""
+
+    order_payment = models.OneToOneField(
+        to=OrderPayment,
+        on_delete=models.CASCADE,
+        related_name='confirmation_lease',
+    )
+    worker_id = models.CharField(max_length=255, blank=True)
+    expires_at = models.DateTimeField(db_index=True)
+
+
+class FinalizedTransaction(models.Model):
+    """
+    Receipt and transaction of a transaction that is too deep in the chain to ever
+    change again, as returned by JSON-RPC, so that it is only looked up once.
+    """
+
+    chain_id = models.IntegerField()
+    transaction_hash = models.CharField(max_length=66)
+    block_number = models.BigIntegerField()
+    receipt = models.TextField()
+    # Only stored once it was needed, i.e. for native transfers
+    transaction = models.TextField(null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = (('chain_id', 'transaction_hash'),)
+
+
+class PriceSample(models.Model):
+    """
+    Market price of a token in a fiat currency at one instant, aggregated from the
+    quotes of the price oracles. Older samples are thinned out, see price_history.
+    """
+
+    token_symbol = models.CharField(max_length=16)
+    fiat_currency = models.CharField(max_length=3)
+    timestamp = models.DateTimeField()
+    price = models.DecimalField(max_digits=28, decimal_places=8)
+    # What the oracles quoted, outliers included
+    quote_count = models.PositiveSmallIntegerField()
+    lowest_quote = models.DecimalField(max_digits=28, decimal_places=8)
+    highest_quote = models.DecimalField(max_digits=28, decimal_places=8)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['token_symbol', 'fiat_currency', 'timestamp']),
+        ]
@@ -1,6 +1,32 @@
-import requests
-import statistics
+import logging
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from pretix_eth.cache import get_cache
+from pretix_eth.network import oracles
+
+logger = logging.getLogger(__name__)
+
+# Seconds a checkout waits for price quotes in total, and for each oracle
+PRICE_DEADLINE = 0.8
+PRICE_REQUEST_TIMEOUT = 0.8
+PRICE_WORKERS = 16
+# The same for refresh_token_prices, which runs in the background and can wait longer
+REFRESH_PRICE_DEADLINE = 20
+REFRESH_PRICE_REQUEST_TIMEOUT = 10
+
+# Seconds a cached price is fresh for, and for how long a stale one is still served
+# while it is being refreshed
+PRICE_MAX_AGE = 900
+PRICE_STALE_MAX_AGE = 24 * 60 * 60
+PRICE_REFRESH_LOCK_TIMEOUT = 60
+
+# Fiat currencies the oracles quote tokens in
+LIVE_PRICE_CURRENCIES = ("USD", "EUR")
 
 
 def make_erc_681_url(
@@ -51,70 +77,144 @@ def make_checkout_web3modal_url(
     return f"https://checkout.web3modal.com/?currency={currency_type}&amount={amount_in_ether_or_token}&to={wallet_address}&chainId={chainId}"  # noqa: E501
 
 
-api_cache = {}
+_session = None
+_executor = None
+_lock = threading.Lock()
+
+
+def _get_session():
+    """One pooled session for all oracles, so connections are kept alive between quotes."""
+    global _session
+    with _lock:
+        if _session is None:
+            _session = requests.Session()
+            _session.mount("https://", HTTPAdapter(pool_maxsize=PRICE_WORKERS))
+        return _session
 
-# List of API endpoints
-api_endpoints = [
-    "https://api.kraken.com/0/public/Ticker?pair=ETH{currency}",
-    "https://api.binance.com/api/v3/ticker/bookTicker?symbol=ETH{currency}",
-    "https://api.gemini.com/v1/pubticker/eth{currency}",
-    "https://api.coingecko.com/api/v3/simple/price?ids=ethereum&vs_currencies={currency}"
-]
 
+def _get_executor():
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=PRICE_WORKERS, thread_name_prefix="pretix-eth-prices"
+            )
+        return _executor
 
-def format_api_endpoint(api_endpoint, fiat_currency):
-    if fiat_currency == 'USD' and "binance.com" in api_endpoint:
-        fiat_currency = 'USDC'
 
-    return api_endpoint.format(currency=fiat_currency)
+def fetch_oracle_prices(oracle, pairs, timeout=PRICE_REQUEST_TIMEOUT):
+    try:
+        return oracle.get_prices(_get_session(), pairs, timeout)
+    except Exception as e:
+        logger.warning(f"Error fetching prices from {oracle.NAME}: {e}")
+        return {}
 
 
-def fetch_eth_price(api_endpoint, fiat_currency):
-    api_endpoint = format_api_endpoint(api_endpoint, fiat_currency)
+def get_quotes_from_oracles(pairs, deadline=PRICE_DEADLINE, timeout=PRICE_REQUEST_TIMEOUT):
+    """
+    Ask all oracles for the prices of all (token symbol, fiat currency) ``pairs`` at
+    once, and return the quotes that arrived within ``deadline`` seconds per pair.
+    Each request to an oracle times out after ``timeout`` seconds.
+    """
+    pairs = set(pairs)
+    executor = _get_executor()
+    futures = [
+        executor.submit(fetch_oracle_prices, oracle, pairs, timeout)
+        for oracle in oracles.registry
+        if oracle.supported_pairs(pairs)
+    ]
+    done, not_done = wait(futures, timeout=deadline)
+    if not_done:
+        logger.warning(
+            f"{len(not_done)} of {len(futures)} price oracles didn't answer "
+            f"within {deadline}s"
+        )
+
+    quotes = {pair: [] for pair in pairs}
+    for future in done:
+        for pair, price in future.result().items():
+            if pair in quotes:
+                quotes[pair].append(price)
+    return quotes
 
-    # Check if the data is already cached and within the 15-minute window
-    if api_endpoint in api_cache:
-        cached_data = api_cache[api_endpoint]
-        current_time = time.time()
-        if current_time - cached_data["timestamp"] <= 900:
-            return cached_data["price"]
 
-    try:
-        response = requests.get(api_endpoint)
-        data = response.json()
-
-        # Extract ETH price from each API response based on the endpoint
-        if "kraken.com" in api_endpoint:
-            eth_price = float(data["result"]["XETHZ" + fiat_currency.upper()]["c"][0])
-        elif "binance.com" in api_endpoint:
-            eth_price = float(data["bidPrice"])
-        elif "gemini.com" in api_endpoint:
-            eth_price = float(data["last"])
-        elif "coingecko.com" in api_endpoint:
-            eth_price = float(data['ethereum'][fiat_currency.lower()])
+def aggregate_prices(quotes):
+    """
+    One price per pair from the oracles' ``quotes``. Pairs that no oracle quoted, or
+    whose quotes disagree, are left out.
+    """
+    prices = {}
+    for pair, pair_quotes in quotes.items():
+        price = oracles.aggregate_quotes(pair_quotes)
+        if price is None:
+            logger.warning(f"No valid price quotes for {pair[0]}/{pair[1]}")
         else:
-            eth_price = None
+            prices[pair] = price
+    return prices
 
-        if eth_price is not None:
-            # Cache the data with the ETH price and timestamp
-            api_cache[api_endpoint] = {"price": eth_price, "timestamp": time.time()}
 
-        return eth_price
-    except Exception as e:
-        print(f"Error fetching data from {api_endpoint}: {e}")
-        return None
+def get_prices_from_oracles(pairs, deadline=PRICE_DEADLINE):
+    return aggregate_prices(get_quotes_from_oracles(pairs, deadline))
+
+
+def get_price_cache_key(token_symbol, fiat_currency):
+    return f"pretix_eth:price:{token_symbol.upper()}:{fiat_currency.upper()}"
+
 
+def cache_prices(prices):
+    """Put the prices of (token symbol, fiat currency) pairs in the shared cache."""
+    now = time.time()
+    get_cache().set_many(
+        {
+            get_price_cache_key(*pair): {"price": price, "timestamp": now}
+            for pair, price in prices.items()
+        },
+        PRICE_STALE_MAX_AGE,
+    )
+    return prices
+
+
+def refresh_prices(pairs):
+    """
+    Fetch the prices of all (token symbol, fiat currency) ``pairs`` and put them in
+    the shared cache. Returns the prices that could be fetched.
+    """
+    return cache_prices(get_prices_from_oracles(pairs))
 
-def get_eth_price_from_external_apis(fiat_currency):
-    # Fetch prices from all API endpoints
-    eth_prices = [fetch_eth_price(endpoint, fiat_currency) for endpoint in api_endpoints]
 
-    # Filter out None values (indicating errors)
-    eth_prices = [price for price in eth_prices if price is not None]
+def refresh_price(token_symbol, fiat_currency):
+    return refresh_prices([(token_symbol, fiat_currency)]).get((token_symbol, fiat_currency))
 
-    # Calculate the average price while discarding values that deviate too much
-    if eth_prices:
-        return statistics.median(eth_prices)
-    else:
-        print("No valid API results to calculate an average.")
+
+def refresh_price_in_background(token_symbol, fiat_currency):
+    """Refresh the cached price on a worker thread, unless any process is doing so already."""
+    cache = get_cache()
+    lock_key = get_price_cache_key(token_symbol, fiat_currency) + ":refreshing"
+    if not cache.add(lock_key, True, PRICE_REFRESH_LOCK_TIMEOUT):
         return None
+
+    def refresh():
+        try:
+            return refresh_price(token_symbol, fiat_currency)
+        finally:
+            cache.delete(lock_key)
+
+    return _get_executor().submit(refresh)
+
+
+def get_price(token_symbol, fiat_currency, max_age=PRICE_MAX_AGE):
+    """
+    The price of ``token_symbol`` in ``fiat_currency``, from the cache that all
+    processes share - or, without redis or memcached, that of this process.
+
+    A price older than ``max_age`` seconds is still returned right away, while one
+    process refreshes it in the background. Only without a cached price, e.g. on a
+    cold cache, are the oracles asked before returning.
+    """
+    entry = get_cache().get(get_price_cache_key(token_symbol, fiat_currency))
+    if entry is None:
+        return refresh_price(token_symbol, fiat_currency)
+
+    if time.time() - entry["timestamp"] > max_age:
+        refresh_price_in_background(token_symbol, fiat_currency)
+    return entry["price"]
@@ -0,0 +1,158 @@
+import json
+import logging
+import statistics
+from typing import Dict, Iterable, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Quotes further than this from the median of all quotes for a pair are left out
+MAX_DEVIATION = 0.05
+
+# (token symbol, fiat currency), e.g. ("ETH", "USD")
+Pair = Tuple[str, str]
+
+
+class PriceOracle(object):
+    """
+    An exchange or price API that quotes token prices in fiat currencies.
+
+    ``get_prices`` asks for the prices of all pairs it supports with as few requests
+    as the API allows - one, for all built-in oracles.
+    """
+
+    NAME: str = ""
+    # Token symbols this oracle quotes
+    TOKEN_SYMBOLS: Tuple[str, ...] = ()
+
+    def supported_pairs(self, pairs: Iterable[Pair]):
+        return sorted(pair for pair in pairs if pair[0] in self.TOKEN_SYMBOLS)
+
+    def get_prices(self, session, pairs: Iterable[Pair], timeout) -> Dict[Pair, float]:
+        """Return the prices of ``pairs`` that this oracle knows, as a map of pair -> price."""
+        pairs = self.supported_pairs(pairs)
+        if not pairs:
+            return {}
+        return self.request_prices(session, pairs, timeout)
+
+    def request_prices(self, session, pairs, timeout) -> Dict[Pair, float]:
+        raise NotImplementedError
+
+
+class KrakenOracle(PriceOracle):
+    NAME = "kraken"
+    TOKEN_SYMBOLS = ("ETH", "DAI")
+    URL = "https://api.kraken.com/0/public/Ticker"
+
+    def request_prices(self, session, pairs, timeout):
+        response = session.get(
+            self.URL,
+            params={"pair": ",".join(token + fiat for token, fiat in pairs)},
+            timeout=timeout,
+        )
+        result = response.json()["result"]
+
+        prices = {}
+        for token, fiat in pairs:
+            # Older assets are listed under their X/Z prefixed names, e.g. XETHZUSD
+            ticker = result.get(f"X{token}Z{fiat}") or result.get(token + fiat)
+            if ticker is not None:
+                prices[token, fiat] = float(ticker["c"][0])
+        return prices
+
+
+class BinanceOracle(PriceOracle):
+    NAME = "binance"
+    # An unknown symbol fails the whole request, so only ask for well known ones
+    TOKEN_SYMBOLS = ("ETH",)
+    URL = "https://api.binance.com/api/v3/ticker/bookTicker"
+    # Binance has no USD markets, USDC is the closest
+    QUOTE_ASSETS = {"USD": "USDC"}
+
+    def request_prices(self, session, pairs, timeout):
+        symbols = {
+            token + self.QUOTE_ASSETS.get(fiat, fiat): (token, fiat) for token, fiat in pairs
+        }
+        response = session.get(
+            self.URL,
+            params={"symbols": json.dumps(sorted(symbols), separators=(",", ":"))},
+            timeout=timeout,
+        )
+        return {
+            symbols[ticker["symbol"]]: float(ticker["bidPrice"])
+            for ticker in response.json()
+            if ticker.get("symbol") in symbols
+        }
+
+
+class GeminiOracle(PriceOracle):
+    NAME = "gemini"
+    TOKEN_SYMBOLS = ("ETH", "DAI")
+    # The prices of all pairs at once
+    URL = "https://api.gemini.com/v1/pricefeed"
+
+    def request_prices(self, session, pairs, timeout):
+        wanted = {token + fiat: (token, fiat) for token, fiat in pairs}
+        response = session.get(self.URL, timeout=timeout)
+        return {
+            wanted[item["pair"]]: float(item["price"])
+            for item in response.json()
+            if item.get("pair") in wanted
+        }
+
+
+class CoinGeckoOracle(PriceOracle):
+    NAME = "coingecko"
+    TOKEN_IDS = {"ETH": "ethereum", "DAI": "dai"}
+    TOKEN_SYMBOLS = tuple(TOKEN_IDS)
+    URL = "https://api.coingecko.com/api/v3/simple/price"
+
+    def request_prices(self, session, pairs, timeout):
+        response = session.get(
+            self.URL,
+            params={
+                "ids": ",".join(sorted(set(self.TOKEN_IDS[token] for token, _ in pairs))),
+                "vs_currencies": ",".join(sorted(set(fiat.lower() for _, fiat in pairs))),
+            },
+            timeout=timeout,
+        )
+        data = response.json()
+
+        prices = {}
+        for token, fiat in pairs:
+            price = data.get(self.TOKEN_IDS[token], {}).get(fiat.lower())
+            if price is not None:
+                prices[token, fiat] = float(price)
+        return prices
+
+
+registry = [
+    KrakenOracle(),
+    BinanceOracle(),
+    GeminiOracle(),
+    CoinGeckoOracle(),
+]
+
+# Tokens at least one oracle quotes
+LIVE_PRICE_TOKENS = frozenset(
+    token for oracle in registry for token in oracle.TOKEN_SYMBOLS
+)
+
+
+def aggregate_quotes(quotes, max_deviation=MAX_DEVIATION) -> Optional[float]:
+    """
+    The median of ``quotes`` after leaving out those further than ``max_deviation``
+    from the median of all of them. None if there are no quotes, or if they disagree
+    so much that none is left.
+    """
+    if not quotes:
+        return None
+    median = statistics.median(quotes)
+    agreeing = [quote for quote in quotes if abs(quote - median) <= max_deviation * median]
+    if len(agreeing) < len(quotes):
+        logger.warning(
+            f"Leaving out price quotes {sorted(set(quotes) - set(agreeing))} that are more "
+            f"than {max_deviation:.0%} off the median {median}"
+        )
+    if not agreeing:
+        return None
+    return statistics.median(agreeing)
@@ -0,0 +1,116 @@
+import bisect
+import datetime
+import decimal
+
+from django.utils import timezone
+
+from pretix_eth.models import PriceSample
+
+# Samples older than the age are thinned out to one per interval (in seconds)
+DOWNSAMPLING = (
+    (datetime.timedelta(days=7), 60 * 60),
+    (datetime.timedelta(days=90), 24 * 60 * 60),
+)
+DELETE_BATCH_SIZE = 1000
+
+
+def _to_decimal(price):
+    return decimal.Decimal(str(price))
+
+
+def record_prices(prices, quotes, timestamp=None):
+    """
+    Store the aggregated ``prices`` of (token symbol, fiat currency) pairs, along
+    with the range of the oracle ``quotes`` they came from.
+    """
+    timestamp = timestamp or timezone.now()
+    samples = [
+        PriceSample(
+            token_symbol=token_symbol,
+            fiat_currency=fiat_currency,
+            timestamp=timestamp,
+            price=_to_decimal(price),
+            quote_count=len(quotes[token_symbol, fiat_currency]),
+            lowest_quote=_to_decimal(min(quotes[token_symbol, fiat_currency])),
+            highest_quote=_to_decimal(max(quotes[token_symbol, fiat_currency])),
+        )
+        for (token_symbol, fiat_currency), price in prices.items()
+    ]
+    return PriceSample.objects.bulk_create(samples)
+
+
+def get_price_sample_at(token_symbol, fiat_currency, instant):
+    """The last sample of the pair at or before ``instant``, or None if there is none."""
+    return PriceSample.objects.filter(
+        token_symbol=token_symbol,
+        fiat_currency=fiat_currency,
+        timestamp__lte=instant,
+    ).order_by('-timestamp').first()
+
+
+class PriceHistoryWindow(object):
+    """
+    Answers ``get_price_sample_at`` for instants between ``start`` and ``end`` from
+    memory. The samples of a pair in the window, and the last one before it, are
+    loaded in two queries the first time the pair is asked for; instants outside of
+    the window are looked up in the database.
+    """
+
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+        # (token symbol, fiat currency) -> (timestamps, samples), both by timestamp
+        self._pairs = {}
+
+    def _load(self, token_symbol, fiat_currency):
+        samples = PriceSample.objects.filter(
+            token_symbol=token_symbol, fiat_currency=fiat_currency,
+        )
+        before = samples.filter(timestamp__lt=self.start).order_by('-timestamp').first()
+        loaded = list(samples.filter(
+            timestamp__gte=self.start, timestamp__lte=self.end,
+        ).order_by('timestamp', 'id'))
+        if before is not None:
+            loaded.insert(0, before)
+        return [sample.timestamp for sample in loaded], loaded
+
+    def sample_at(self, token_symbol, fiat_currency, instant):
+        if not self.start <= instant <= self.end:
+            return get_price_sample_at(token_symbol, fiat_currency, instant)
+        pair = (token_symbol, fiat_currency)
+        if pair not in self._pairs:
+            self._pairs[pair] = self._load(token_symbol, fiat_currency)
+        timestamps, samples = self._pairs[pair]
+        index = bisect.bisect_right(timestamps, instant)
+        return samples[index - 1] if index else None
+
+
+def _downsample_before(cutoff, interval):
+    samples = PriceSample.objects.filter(
+        timestamp__lt=cutoff,
+    ).order_by(
+        'token_symbol', 'fiat_currency', 'timestamp', 'id',
+    ).values_list('id', 'token_symbol', 'fiat_currency', 'timestamp')
+
+    # Keep the first sample of each pair in each interval
+    redundant = []
+    last_bucket = None
+    for sample_id, token_symbol, fiat_currency, timestamp in samples.iterator():
+        bucket = (token_symbol, fiat_currency, int(timestamp.timestamp() // interval))
+        if bucket == last_bucket:
+            redundant.append(sample_id)
+        last_bucket = bucket
+
+    for start in range(0, len(redundant), DELETE_BATCH_SIZE):
+        PriceSample.objects.filter(
+            id__in=redundant[start:start + DELETE_BATCH_SIZE]
+        ).delete()
+    return len(redundant)
+
+
+def downsample(now=None):
+    """Thin out old samples according to DOWNSAMPLING. Returns how many were deleted."""
+    now = now or timezone.now()
+    return sum(
+        _downsample_before(now - age, interval) for age, interval in DOWNSAMPLING
+    )
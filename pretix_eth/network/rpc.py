@@ -0,0 +1,511 @@
+import collections
+import itertools
+import json
+import logging
+import statistics
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import aiohttp
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from web3 import AsyncHTTPProvider, HTTPProvider, Web3
+from web3._utils.method_formatters import PYTHONIC_RESULT_FORMATTERS
+from web3._utils.request import make_post_request
+from web3.datastructures import AttributeDict
+from web3.providers.auto import load_provider_from_uri
+
+from pretix_eth.exceptions import TransactionProviderError
+from pretix_eth.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_HEAD_MAX_AGE = 5
+
+# Connection pool defaults, can be overridden in the [pretix_eth] section of pretix.cfg
+DEFAULT_POOL_CONNECTIONS = 10
+DEFAULT_POOL_MAXSIZE = 10
+DEFAULT_TIMEOUT = 10
+
+# Circuit breaker defaults, can be overridden in pretix.cfg as well
+DEFAULT_CIRCUIT_FAILURES = 3
+DEFAULT_CIRCUIT_COOLDOWN = 30
+
+# Blocks after which a transaction is cached for good, can be overridden in pretix.cfg
+DEFAULT_FINALITY_DEPTH = 64
+
+# Latency samples kept per endpoint, and how many are needed before hedging
+HEALTH_WINDOW = 100
+MIN_HEDGE_SAMPLES = 20
+# Seconds added to an endpoint's score for an error rate of 100%
+ERROR_PENALTY = 1.0
+HEDGE_WORKERS = 16
+
+_request_ids = itertools.count()
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+_endpoint_health = {}
+_hedge_executor = None
+
+
+class PooledHTTPProvider(HTTPProvider):
+    """
+    HTTPProvider that sends all requests, from every thread, through one session.
+
+    web3 keeps its HTTP sessions per thread, so threads never share keep-alive
+    connections; this provider owns a single pooled session instead.
+    """
+
+    def __init__(self, endpoint_uri, session, request_kwargs=None):
+        self.session = session
+        super().__init__(endpoint_uri, request_kwargs=request_kwargs)
+
+    def post(self, data):
+        response = self.session.post(self.endpoint_uri, data=data, **self.get_request_kwargs())
+        response.raise_for_status()
+        return response.content
+
+    def make_request(self, method, params):
+        request_data = self.encode_rpc_request(method, params)
+        return self.decode_rpc_response(self.post(request_data))
+
+
+class EndpointHealth(object):
+    """
+    Recent latencies and errors of one RPC endpoint, shared by every client in the
+    process, with a circuit breaker: after ``failures`` consecutive errors the endpoint
+    is skipped for ``cooldown`` seconds, then it gets one trial request.
+    """
+
+    def __init__(self, endpoint_uri, failures=DEFAULT_CIRCUIT_FAILURES,
+                 cooldown=DEFAULT_CIRCUIT_COOLDOWN, clock=time.monotonic):
+        self.endpoint_uri = endpoint_uri
+        self.failures = failures
+        self.cooldown = cooldown
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._latencies = collections.deque(maxlen=HEALTH_WINDOW)
+        self._outcomes = collections.deque(maxlen=HEALTH_WINDOW)
+        self._consecutive_failures = 0
+        self._open_until = None
+
+    def record_success(self, latency):
+        with self._lock:
+            self._latencies.append(latency)
+            self._outcomes.append(True)
+            self._consecutive_failures = 0
+            self._open_until = None
+
+    def record_failure(self):
+        with self._lock:
+            self._outcomes.append(False)
+            self._consecutive_failures += 1
+            if self._consecutive_failures >= self.failures:
+                self._open_until = self.clock() + self.cooldown
+
+    @property
+    def available(self):
+        with self._lock:
+            return self._open_until is None or self.clock() >= self._open_until
+
+    @property
+    def open_until(self):
+        with self._lock:
+            return self._open_until
+
+    def score(self):
+        """Lower is better: the median latency, plus a penalty for recent errors."""
+        with self._lock:
+            latency = statistics.median(self._latencies) if self._latencies else 0
+            error_rate = (
+                self._outcomes.count(False) / len(self._outcomes) if self._outcomes else 0
+            )
+        return latency + ERROR_PENALTY * error_rate
+
+    def hedge_delay(self):
+        """The 95th percentile latency, or None while there are too few samples."""
+        with self._lock:
+            if len(self._latencies) < MIN_HEDGE_SAMPLES:
+                return None
+            latencies = sorted(self._latencies)
+        return latencies[int(0.95 * (len(latencies) - 1))]
+
+
+def get_endpoint_health(endpoint_uri) -> EndpointHealth:
+    health = _endpoint_health.get(endpoint_uri)
+    if health is not None:
+        return health
+
+    with _clients_lock:
+        if endpoint_uri not in _endpoint_health:
+            _endpoint_health[endpoint_uri] = EndpointHealth(
+                endpoint_uri,
+                failures=_get_config_value(
+                    "getint", "rpc_circuit_failures", DEFAULT_CIRCUIT_FAILURES
+                ),
+                cooldown=_get_config_value(
+                    "getfloat", "rpc_circuit_cooldown", DEFAULT_CIRCUIT_COOLDOWN
+                ),
+            )
+        return _endpoint_health[endpoint_uri]
+
+
+def rank_endpoints(endpoint_uris):
+    """
+    Order ``endpoint_uris`` from the most to the least promising. Endpoints with an
+    open circuit are left out, unless all of them have one.
+    """
+    healths = [get_endpoint_health(endpoint_uri) for endpoint_uri in endpoint_uris]
+    available = sorted(
+        (health for health in healths if health.available), key=EndpointHealth.score
+    )
+    if available:
+        return available
+    return sorted(healths, key=lambda health: health.open_until)
+
+
+def _get_hedge_executor():
+    global _hedge_executor
+    if _hedge_executor is None:
+        with _clients_lock:
+            if _hedge_executor is None:
+                _hedge_executor = ThreadPoolExecutor(
+                    max_workers=HEDGE_WORKERS, thread_name_prefix="pretix-eth-rpc-hedge"
+                )
+    return _hedge_executor
+
+
+class FailoverHTTPProvider(PooledHTTPProvider):
+    """
+    PooledHTTPProvider for several interchangeable endpoints of the same chain.
+
+    Every request goes to the endpoint with the best health score. If it hasn't
+    answered within its 95th percentile latency, the same request is also sent to the
+    next best endpoint, and whichever answers first wins. Failed requests are retried
+    on the remaining endpoints, and endpoints that keep failing are skipped for a while.
+    """
+
+    def __init__(self, endpoint_uris, session, request_kwargs=None):
+        self.endpoint_uris = tuple(endpoint_uris)
+        super().__init__(self.endpoint_uris[0], session, request_kwargs=request_kwargs)
+
+    def _post_to(self, health, data):
+        started_at = time.perf_counter()
+        try:
+            response = self.session.post(
+                health.endpoint_uri, data=data, **self.get_request_kwargs()
+            )
+            response.raise_for_status()
+        except Exception:
+            health.record_failure()
+            raise
+        health.record_success(time.perf_counter() - started_at)
+        return response.content
+
+    def post(self, data):
+        candidates = rank_endpoints(self.endpoint_uris)
+        error = None
+        while candidates:
+            primary = candidates.pop(0)
+            hedge_delay = primary.hedge_delay()
+            if hedge_delay is None or not candidates:
+                try:
+                    return self._post_to(primary, data)
+                except Exception as e:
+                    error = e
+            else:
+                executor = _get_hedge_executor()
+                futures = {executor.submit(self._post_to, primary, data)}
+                done, _ = wait(futures, timeout=hedge_delay)
+                if not done:
+                    metrics.inc("pretix_eth_rpc_hedged_requests_total")
+                    futures.add(executor.submit(self._post_to, candidates.pop(0), data))
+                while futures:
+                    done, futures = wait(futures, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        try:
+                            return future.result()
+                        except Exception as e:
+                            error = e
+
+            if candidates:
+                metrics.inc("pretix_eth_rpc_failovers_total")
+                logger.warning(
+                    f"RPC request to {primary.endpoint_uri} failed, failing over: {error}"
+                )
+        raise error
+
+
+def _get_config_value(getter, option, fallback):
+    config = getattr(settings, "CONFIG_FILE", None)
+    if config is None:
+        return fallback
+    return getattr(config, getter)("pretix_eth", option, fallback=fallback)
+
+
+def get_finality_depth():
+    """Number of blocks after which a transaction can't be reorganized away anymore."""
+    return _get_config_value("getint", "finality_depth", DEFAULT_FINALITY_DEPTH)
+
+
+def is_http_url(rpc_url):
+    """Whether ``rpc_url`` - an RPC URL or a tuple of them - is served over HTTP."""
+    rpc_urls = (rpc_url,) if isinstance(rpc_url, str) else rpc_url
+    return all(url.startswith(("http://", "https://")) for url in rpc_urls)
+
+
+def _make_provider(rpc_url):
+    if not isinstance(rpc_url, str) and len(rpc_url) == 1:
+        rpc_url = rpc_url[0]
+    if not is_http_url(rpc_url):
+        if not isinstance(rpc_url, str):
+            logger.warning("Failover only works between HTTP endpoints, using the first one")
+            rpc_url = rpc_url[0]
+        return load_provider_from_uri(rpc_url)
+
+    adapter = HTTPAdapter(
+        pool_connections=_get_config_value(
+            "getint", "rpc_pool_connections", DEFAULT_POOL_CONNECTIONS
+        ),
+        pool_maxsize=_get_config_value("getint", "rpc_pool_maxsize", DEFAULT_POOL_MAXSIZE),
+    )
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    request_kwargs = {
+        "timeout": _get_config_value("getfloat", "rpc_timeout", DEFAULT_TIMEOUT),
+    }
+
+    if not isinstance(rpc_url, str):
+        return FailoverHTTPProvider(rpc_url, session, request_kwargs=request_kwargs)
+    return PooledHTTPProvider(rpc_url, session, request_kwargs=request_kwargs)
+
+
+def get_web3(rpc_url) -> Web3:
+    """
+    Return the process-wide Web3 client for ``rpc_url``, or for a tuple of RPC URLs of
+    interchangeable endpoints of the same chain.
+
+    Clients are created once per RPC URL and reused, so that HTTP connections are kept
+    alive between requests instead of paying for a new TLS handshake every time.
+    """
+    w3 = _clients.get(rpc_url)
+    if w3 is not None:
+        return w3
+
+    with _clients_lock:
+        if rpc_url not in _clients:
+            _clients[rpc_url] = Web3(_make_provider(rpc_url))
+        return _clients[rpc_url]
+
+
+def clear_clients():
+    """Drop all cached clients, closing their connection pools, and endpoint health."""
+    with _clients_lock:
+        for w3 in _clients.values():
+            session = getattr(w3.provider, "session", None)
+            if session is not None:
+                session.close()
+        _clients.clear()
+        _endpoint_health.clear()
+
+
+class ChainHeadCache(object):
+    """
+    Latest block heights per RPC URL, shared by everything that checks whether a
+    transaction has enough confirmations during a confirmation pass.
+
+    A height is refreshed once it is older than ``max_age`` seconds. Working with a
+    slightly stale height is safe: it can only delay a confirmation, never hasten it.
+    """
+
+    def __init__(self, max_age=DEFAULT_HEAD_MAX_AGE, clock=time.monotonic):
+        self.max_age = max_age
+        self.clock = clock
+        self._heads = {}
+        self._lock = threading.Lock()
+
+    def peek(self, rpc_url):
+        """Return the cached height of ``rpc_url`` if it is fresh enough, or None."""
+        with self._lock:
+            head, fetched_at = self._heads.get(rpc_url, (None, None))
+        if head is None or self.clock() - fetched_at > self.max_age:
+            return None
+        return head
+
+    def set(self, rpc_url, head):
+        """Record a height fetched elsewhere, e.g. as part of a batch request."""
+        with self._lock:
+            self._heads[rpc_url] = (head, self.clock())
+
+    def get(self, rpc_url, network=None):
+        head = self.peek(rpc_url)
+        if head is None:
+            labels = dict(network=network or "unknown", method="eth_blockNumber")
+            metrics.inc("pretix_eth_rpc_calls_total", **labels)
+            with metrics.timer("pretix_eth_rpc_request_seconds", **labels):
+                head = get_web3(rpc_url).eth.block_number
+            self.set(rpc_url, head)
+        return head
+
+
+def _format_result(method, response):
+    if "error" in response:
+        return TransactionProviderError(f"{method} failed: {response['error']}")
+
+    result = response.get("result")
+    if result is None:
+        return None
+
+    formatter = PYTHONIC_RESULT_FORMATTERS.get(method)
+    if formatter is not None:
+        result = formatter(result)
+    # Like web3's attrdict middleware, which doesn't see these hand-made batches
+    if isinstance(result, dict):
+        return AttributeDict.recursive(result)
+    if isinstance(result, list):
+        return [
+            AttributeDict.recursive(item) if isinstance(item, dict) else item
+            for item in result
+        ]
+    return result
+
+
+def encode_result(result):
+    """Serialize a formatted result, e.g. a receipt, so that ``decode_result`` can restore it."""
+    return Web3.to_json(result)
+
+
+def decode_result(method, data):
+    """Restore a result of ``method`` that was serialized with ``encode_result``."""
+    return _format_result(method, {"result": json.loads(data)})
+
+
+def _send_batch(provider, calls):
+    requests_by_id = {}
+    payload = []
+    for method, params in calls:
+        request_id = next(_request_ids)
+        requests_by_id[request_id] = method
+        payload.append({
+            "jsonrpc": "2.0",
+            "method": method,
+            "params": list(params),
+            "id": request_id,
+        })
+
+    data = json.dumps(payload)
+    if isinstance(provider, PooledHTTPProvider):
+        raw_response = provider.post(data)
+    else:
+        raw_response = make_post_request(
+            provider.endpoint_uri, data, **provider.get_request_kwargs()
+        )
+    responses = json.loads(raw_response)
+
+    if not isinstance(responses, list):
+        # Some nodes answer a batch they refuse to process with one error object.
+        error = TransactionProviderError(f"Batch request rejected: {responses}")
+        return [error] * len(calls)
+
+    results_by_id = {
+        response.get("id"): _format_result(requests_by_id.get(response.get("id")), response)
+        for response in responses
+    }
+    return [
+        results_by_id.get(
+            request_id, TransactionProviderError(f"No response for {method}")
+        )
+        for request_id, method in requests_by_id.items()
+    ]
+
+
+def _count_calls(calls, network):
+    """Count ``calls`` and return the labels to time their round trip with."""
+    methods = collections.Counter(method for method, _ in calls)
+    for method, count in methods.items():
+        metrics.inc("pretix_eth_rpc_calls_total", count, network=network, method=method)
+    # A batch is timed as a whole, under the method most of its calls are for
+    return dict(network=network, method=methods.most_common(1)[0][0])
+
+
+def batch_request(w3, calls, batch_size=DEFAULT_BATCH_SIZE, network=None):
+    """
+    Resolve ``calls`` - a list of ``(method, params)`` pairs - with as few round trips
+    as possible. HTTP providers get JSON-RPC batches of at most ``batch_size`` calls,
+    any other provider gets one request per call.
+
+    Results are returned in the order of ``calls`` and formatted the way ``w3.eth``
+    would format them. Calls that failed yield a ``TransactionProviderError`` instance
+    instead of raising, so one bad transaction hash doesn't spoil the whole batch.
+
+    ``network`` is only used to label the metrics of these calls.
+    """
+    provider = w3.provider
+    network = network or "unknown"
+    results = []
+
+    if not isinstance(provider, HTTPProvider):
+        for method, params in calls:
+            try:
+                labels = _count_calls([(method, params)], network)
+                with metrics.timer("pretix_eth_rpc_request_seconds", **labels):
+                    response = provider.make_request(method, list(params))
+            except Exception as e:
+                results.append(TransactionProviderError(f"{method} failed: {e}"))
+            else:
+                results.append(_format_result(method, response))
+        return results
+
+    for start in range(0, len(calls), batch_size):
+        chunk = calls[start:start + batch_size]
+        try:
+            labels = _count_calls(chunk, network)
+            with metrics.timer("pretix_eth_rpc_request_seconds", **labels):
+                results.extend(_send_batch(provider, chunk))
+        except Exception as e:
+            logger.warning(f"Batch request to {provider.endpoint_uri} failed: {e}")
+            results.extend([TransactionProviderError(str(e))] * len(chunk))
+
+    return results
+
+
+async def make_async_provider(rpc_url, connections=DEFAULT_POOL_MAXSIZE):
+    """
+    Return an ``(AsyncHTTPProvider, session)`` pair for ``rpc_url``, with a session of
+    its own that keeps at most ``connections`` connections alive.
+
+    Sessions are bound to the event loop they were created on, so this has to be
+    awaited on the loop that will use the provider. The caller closes the session.
+    """
+    session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=connections))
+    provider = AsyncHTTPProvider(
+        rpc_url,
+        request_kwargs={
+            "timeout": aiohttp.ClientTimeout(
+                total=_get_config_value("getfloat", "rpc_timeout", DEFAULT_TIMEOUT)
+            ),
+        },
+    )
+    await provider.cache_async_session(session)
+    return provider, session
+
+
+async def async_request(provider, method, params, network=None):
+    """
+    Make a single call on an async provider. Like ``batch_request``, the result is
+    formatted the way ``w3.eth`` would format it, and a failed call returns a
+    ``TransactionProviderError`` instead of raising.
+    """
+    labels = _count_calls([(method, params)], network or "unknown")
+    try:
+        with metrics.timer("pretix_eth_rpc_request_seconds", **labels):
+            response = await provider.make_request(method, list(params))
+    except Exception as e:
+        return TransactionProviderError(f"{method} failed: {e}")
+    return _format_result(method, response)
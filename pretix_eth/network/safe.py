@@ -0,0 +1,115 @@
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from pretix_eth.cache import get_cache
+from pretix_eth.verification import parse_safe_transaction
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_WORKERS = 8
+DEFAULT_PENDING_TTL = 30
+# (connect, read) timeouts in seconds
+DEFAULT_TIMEOUT = (3.05, 5)
+
+CACHE_KEY_PREFIX = "pretix_eth_safe_tx_"
+NOT_EXECUTED = {"executed": False}
+
+_service = None
+_service_lock = threading.Lock()
+
+
+class SafeTransactionService(object):
+    """
+    Looks up Safe transactions in the Safe transaction service.
+
+    All lookups go through one pooled session, with at most ``max_workers`` requests in
+    flight. Executed and successful transactions never change, so they are cached for
+    good; transactions that haven't been executed yet are cached for ``pending_ttl``
+    seconds. Failed lookups aren't cached.
+    """
+
+    def __init__(self, max_workers=DEFAULT_MAX_WORKERS, timeout=DEFAULT_TIMEOUT,
+                 pending_ttl=DEFAULT_PENDING_TTL, session=None):
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.pending_ttl = pending_ttl
+        if session is None:
+            adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+            session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+        self.session = session
+
+    @staticmethod
+    def _cache_key(url):
+        return CACHE_KEY_PREFIX + hashlib.sha256(url.encode()).hexdigest()
+
+    def _fetch(self, url):
+        response = self.session.get(url, timeout=self.timeout)
+        response.raise_for_status()
+        return parse_safe_transaction(response.json())
+
+    def get(self, url):
+        """
+        Return the executed transfer of the Safe transaction at ``url`` (see
+        ``parse_safe_transaction``), or None if it hasn't been executed successfully yet.
+        Raises if the lookup fails.
+        """
+        return self.get_many([url])[url]
+
+    def get_many(self, urls):
+        """
+        Look up several Safe transactions concurrently. Returns a dict of url -> result
+        of ``get``, where lookups that failed map to the exception they raised.
+        """
+        cache = get_cache()
+        urls = list(dict.fromkeys(urls))
+        keys = {url: self._cache_key(url) for url in urls}
+        cached = cache.get_many(list(keys.values()))
+
+        results = {}
+        missing = []
+        for url in urls:
+            if keys[url] in cached:
+                value = cached[keys[url]]
+                results[url] = None if value == NOT_EXECUTED else value
+            else:
+                missing.append(url)
+
+        if not missing:
+            return results
+
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(missing))) as executor:
+            futures = {url: executor.submit(self._fetch, url) for url in missing}
+
+        executed = {}
+        for url, future in futures.items():
+            try:
+                results[url] = future.result()
+            except Exception as e:
+                logger.warning(f"Could not look up the Safe transaction {url}: {e}")
+                results[url] = e
+                continue
+
+            if results[url] is None:
+                cache.set(keys[url], NOT_EXECUTED, self.pending_ttl)
+            else:
+                executed[keys[url]] = results[url]
+
+        if executed:
+            cache.set_many(executed, None)
+        return results
+
+
+def get_safe_transaction_service():
+    """Return the Safe transaction service client shared by this process."""
+    global _service
+    with _service_lock:
+        if _service is None:
+            _service = SafeTransactionService()
+        return _service
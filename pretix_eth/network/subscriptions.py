@@ -0,0 +1,238 @@
+import asyncio
+import itertools
+import json
+import logging
+import threading
+from typing import NamedTuple, Optional, Tuple, Union
+
+import websockets
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RECONNECT_DELAY = 1
+DEFAULT_MAX_RECONNECT_DELAY = 60
+
+
+class SubscriptionTarget(NamedTuple):
+    """What to follow over WebSocket for the chain behind one (HTTP) RPC URL."""
+
+    ws_url: Union[str, Tuple[str, ...]]  # several URLs are tried in turn
+    network: str
+    # eth_getLogs style filter for a "logs" subscription, if any
+    log_filter: Optional[dict] = None
+
+
+class SubscriptionError(Exception):
+    pass
+
+
+class _Connection(object):
+    """JSON-RPC over one WebSocket connection, with notifications dispatched in between."""
+
+    def __init__(self, websocket, on_notification):
+        self.websocket = websocket
+        self.on_notification = on_notification
+        self._ids = itertools.count(1)
+
+    async def call(self, method, params):
+        request_id = next(self._ids)
+        await self.websocket.send(json.dumps({
+            "jsonrpc": "2.0", "id": request_id, "method": method, "params": params,
+        }))
+        while True:
+            message = json.loads(await self.websocket.recv())
+            if message.get("id") != request_id:
+                self.dispatch(message)
+                continue
+            if "error" in message:
+                raise SubscriptionError(f"{method} failed: {message['error']}")
+            return message.get("result")
+
+    def dispatch(self, message):
+        if message.get("method") == "eth_subscription":
+            params = message.get("params") or {}
+            self.on_notification(params.get("subscription"), params.get("result"))
+
+    async def listen(self):
+        async for raw_message in self.websocket:
+            self.dispatch(json.loads(raw_message))
+
+
+class HeadSubscriptions(object):
+    """
+    Follows the chain head of several networks through ``eth_subscribe("newHeads")``
+    over WebSocket, and optionally the ``Transfer`` logs matching a filter, on an event
+    loop running on a thread of its own.
+
+    Targets are keyed by the HTTP RPC URL that the rest of the plugin uses for the same
+    chain. Dropped connections are re-established with exponential backoff, moving on
+    to the next WebSocket URL if a target has several. On every (re)connect, the
+    current block height is fetched and logs emitted since the last block seen are
+    backfilled with ``eth_getLogs``, so nothing is missed while disconnected.
+
+    New heads are also recorded in ``heads`` (a ChainHeadCache). Everything that
+    arrives is queued until ``drain`` is called, and ``wake`` is called to signal that
+    there is something to drain. While a target isn't connected, ``head`` returns None
+    and callers should fall back to polling over HTTP.
+    """
+
+    def __init__(self, heads=None, wake=None, reconnect_delay=DEFAULT_RECONNECT_DELAY,
+                 max_reconnect_delay=DEFAULT_MAX_RECONNECT_DELAY):
+        self.heads = heads
+        self.wake = wake
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        self._lock = threading.Lock()
+        self._targets = {}
+        self._tasks = {}
+        self._live_heads = {}
+        self._new_heads = {}
+        self._transaction_hashes = set()
+        self._loop = None
+        self._thread = None
+
+    def _get_loop(self):
+        if self._loop is None:
+            self._loop = asyncio.new_event_loop()
+            self._thread = threading.Thread(
+                target=self._loop.run_forever, name="pretix-eth-subscriptions", daemon=True
+            )
+            self._thread.start()
+        return self._loop
+
+    def update(self, targets):
+        """
+        Follow ``targets``, a map of RPC URL -> SubscriptionTarget. Subscriptions that
+        aren't in ``targets`` anymore are dropped, changed ones are re-established.
+        """
+        changed = {
+            rpc_url: target for rpc_url, target in targets.items()
+            if self._targets.get(rpc_url) != target
+        }
+        removed = [rpc_url for rpc_url in self._targets if rpc_url not in targets]
+        if not changed and not removed:
+            return
+
+        self._targets = dict(targets)
+        asyncio.run_coroutine_threadsafe(
+            self._update(changed, removed), self._get_loop()
+        ).result()
+
+    async def _update(self, changed, removed):
+        cancelled = []
+        for rpc_url in itertools.chain(removed, changed):
+            task = self._tasks.pop(rpc_url, None)
+            if task is not None:
+                task.cancel()
+                cancelled.append(task)
+            self._set_live(rpc_url, None)
+        # Let cancelled subscriptions close their connections
+        await asyncio.gather(*cancelled, return_exceptions=True)
+        for rpc_url, target in changed.items():
+            self._tasks[rpc_url] = asyncio.ensure_future(self._follow(rpc_url, target))
+
+    def close(self):
+        if self._loop is None:
+            return
+        self.update({})
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+        self._loop = self._thread = None
+
+    def head(self, rpc_url):
+        """The latest block height seen on ``rpc_url``'s subscription, if it is live."""
+        with self._lock:
+            return self._live_heads.get(rpc_url)
+
+    def drain(self):
+        """
+        Return the heads that arrived since the last call, as a map of RPC URL -> block
+        height, and the set of transaction hashes of logs that arrived.
+        """
+        with self._lock:
+            new_heads, self._new_heads = self._new_heads, {}
+            transaction_hashes, self._transaction_hashes = self._transaction_hashes, set()
+        return new_heads, transaction_hashes
+
+    def _set_live(self, rpc_url, head):
+        with self._lock:
+            if head is None:
+                self._live_heads.pop(rpc_url, None)
+            else:
+                self._live_heads[rpc_url] = head
+
+    def _on_head(self, rpc_url, head):
+        with self._lock:
+            if head <= self._live_heads.get(rpc_url, -1):
+                return
+            self._live_heads[rpc_url] = head
+            self._new_heads[rpc_url] = head
+        if self.heads is not None:
+            self.heads.set(rpc_url, head)
+        if self.wake is not None:
+            self.wake()
+
+    def _on_logs(self, logs):
+        transaction_hashes = {
+            log["transactionHash"] for log in logs
+            if log.get("transactionHash") and not log.get("removed")
+        }
+        if not transaction_hashes:
+            return
+        with self._lock:
+            self._transaction_hashes.update(transaction_hashes)
+        if self.wake is not None:
+            self.wake()
+
+    async def _follow(self, rpc_url, target):
+        delay = self.reconnect_delay
+        last_head = None
+        ws_urls = itertools.cycle(
+            (target.ws_url,) if isinstance(target.ws_url, str) else target.ws_url
+        )
+        while True:
+            try:
+                async with websockets.connect(next(ws_urls), close_timeout=1) as websocket:
+                    subscriptions = {}
+
+                    def on_notification(subscription_id, result):
+                        kind = subscriptions.get(subscription_id)
+                        if kind == "newHeads" and result:
+                            self._on_head(rpc_url, int(result["number"], 16))
+                        elif kind == "logs" and result:
+                            self._on_logs([result])
+
+                    connection = _Connection(websocket, on_notification)
+                    subscriptions[
+                        await connection.call("eth_subscribe", ["newHeads"])
+                    ] = "newHeads"
+                    if target.log_filter is not None:
+                        subscriptions[
+                            await connection.call("eth_subscribe", ["logs", target.log_filter])
+                        ] = "logs"
+
+                    head = int(await connection.call("eth_blockNumber", []), 16)
+                    if target.log_filter is not None and last_head is not None and (
+                        head > last_head
+                    ):
+                        self._on_logs(await connection.call("eth_getLogs", [dict(
+                            target.log_filter, fromBlock=hex(last_head + 1), toBlock=hex(head),
+                        )]))
+                    self._on_head(rpc_url, head)
+                    logger.info(f"Following new blocks of {target.network} over WebSocket")
+                    delay = self.reconnect_delay
+
+                    await connection.listen()
+                    raise SubscriptionError("Connection closed")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                last_head = self.head(rpc_url) or last_head
+                self._set_live(rpc_url, None)
+                logger.warning(
+                    f"WebSocket subscription to {target.network} failed, polling over HTTP "
+                    f"and reconnecting in {delay}s: {e}"
+                )
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.max_reconnect_delay)
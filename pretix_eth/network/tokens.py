@@ -6,14 +6,16 @@ from django.utils.translation import gettext_lazy as _
 
 from eth_utils import to_wei
 from web3 import Web3
-from web3.providers.auto import load_provider_from_uri
 
 from pretix_eth.network.helpers import (
+    LIVE_PRICE_CURRENCIES,
     make_checkout_web3modal_url,
     make_erc_681_url,
     make_uniswap_url,
-    get_eth_price_from_external_apis
+    get_price
 )
+from pretix_eth.network.oracles import LIVE_PRICE_TOKENS
+from pretix_eth.network.rpc import get_web3
 
 TOKEN_ABI = [
     # Functions
@@ -75,6 +77,7 @@ class IToken(object):
     ADDRESS = None  # If a token, then the smart contract address.
     EIP3091_EXPLORER_URL = None  # if set, allows links to transactions to be generated
     CHAIN_ID = None
+    BLOCK_TIME = 12  # Average seconds between blocks, used to schedule confirmation checks
     DISABLED = False
 
     def __init__(self):
@@ -115,6 +118,10 @@ class IToken(object):
             self.NETWORK_IDENTIFIER in network_ids
         ) and not self.DISABLED
 
+    def has_live_price(self, fiat_currency):
+        """Whether the price in ``fiat_currency`` comes from the oracles, not TOKEN_RATES."""
+        return self.TOKEN_SYMBOL in LIVE_PRICE_TOKENS and fiat_currency in LIVE_PRICE_CURRENCIES
+
     def get_ticket_price_in_token(self, total, rates, fiat_currency):
         if not (self.TOKEN_SYMBOL + "_RATE" in rates):
             raise ImproperlyConfigured(
@@ -123,15 +130,15 @@ class IToken(object):
 
         chosen_currency_rate = decimal.Decimal(rates[self.TOKEN_SYMBOL + "_RATE"])
 
-        # We can't dynamically fetch arbitrary fiat currencies as we have to ensure the exchange apis support them - we support EUR and USD for now  # noqa: E501
+        # We can't dynamically fetch arbitrary fiat currencies as we have to ensure the oracles support them - we support EUR and USD for now  # noqa: E501
         # Fall back to the manually set price in this case
-        if (self.TOKEN_SYMBOL == 'ETH' and (fiat_currency == 'USD' or fiat_currency == 'EUR')):
-            # If token is ETH, fetch the price from external apis -
-            # if this fails for some reason (endpoints down, unreliable results, etc.), use the manually set price instead  # noqa: E501
-            eth_price = get_eth_price_from_external_apis(fiat_currency)
+        if self.has_live_price(fiat_currency):
+            # Fetch the price from the oracles -
+            # if this fails for some reason (oracles down, unreliable results, etc.), use the manually set price instead  # noqa: E501
+            live_price = get_price(self.TOKEN_SYMBOL, fiat_currency)
 
-            if (eth_price is not None):
-                chosen_currency_rate = decimal.Decimal(eth_price)
+            if (live_price is not None):
+                chosen_currency_rate = decimal.Decimal(live_price)
 
         rounding_base = decimal.Decimal("1.00000")
         rounded_price = (total / chosen_currency_rate).quantize(rounding_base)
@@ -164,13 +171,13 @@ class IToken(object):
         :param rpc_url: used to make balance query calls
         :returns balance in smallest denomination
         """
-        w3 = Web3(load_provider_from_uri(rpc_url))
-        checksum_address = w3.toChecksumAddress(hex_wallet_address)
+        w3 = get_web3(rpc_url)
+        checksum_address = Web3.to_checksum_address(hex_wallet_address)
 
         if self.IS_NATIVE_ASSET:
-            return w3.eth.getBalance(checksum_address)
+            return w3.eth.get_balance(checksum_address)
         else:
-            token_checksum_address = w3.toChecksumAddress(self.ADDRESS)
+            token_checksum_address = Web3.to_checksum_address(self.ADDRESS)
             token_contract = w3.eth.contract(
                 abi=TOKEN_ABI, address=token_checksum_address
             )
@@ -295,6 +302,7 @@ class Optimism(L1):
     NETWORK_VERBOSE_NAME = "Optimism Mainnet"
     CHAIN_ID = 10
     EIP3091_EXPLORER_URL = "https://optimistic.etherscan.io"
+    BLOCK_TIME = 2
 
 
 class EthOptimism(Optimism):
@@ -351,6 +359,7 @@ class Arbitrum(L1):
     NETWORK_VERBOSE_NAME = "Arbitrum Mainnet"
     CHAIN_ID = 42161
     EIP3091_EXPLORER_URL = "https://explorer.arbitrum.io"
+    BLOCK_TIME = 0.25
 
     def payment_instructions(
         self, wallet_address, payment_amount, amount_in_token_base_unit
@@ -437,6 +446,7 @@ class Polygon(L1):
     NETWORK_VERBOSE_NAME = "Polygon zkEVM"
     CHAIN_ID = 1101
     EIP3091_EXPLORER_URL = "https://zkevm.polygonscan.com/"
+    BLOCK_TIME = 3
 
 
 class ETHPolygonZkEvm(Polygon):
@@ -467,6 +477,7 @@ class ZkSync(L1):
     NETWORK_VERBOSE_NAME = "ZkSync Mainnet"
     CHAIN_ID = 324
     EIP3091_EXPLORER_URL = "https://explorer.zksync.io"
+    BLOCK_TIME = 1
 
 
 class ETHZkSync(ZkSync):
@@ -28,7 +28,9 @@ from .network.tokens import (
     token_verbose_name_to_token_network_id,
 )
 
+from pretix_eth.confirmation.transaction_cache import TransactionCache
 from pretix_eth.models import SignedMessage
+from pretix_eth.provider_settings import ProviderSettings, get_provider_settings
 
 logger = logging.getLogger(__name__)
 
@@ -128,7 +130,9 @@ class Ethereum(BasePaymentProvider):
                         label=_("RPC URLs for networks"),
                         help_text=_(
                             "JSON field with key = {NETWORK_IDENTIFIER}_RPC_URL and value = url "
-                            "of the network RPC endpoint you are using"
+                            "of the network RPC endpoint you are using. Optionally, "
+                            "{NETWORK_IDENTIFIER}_WS_URL can be set to a WebSocket endpoint "
+                            "of the same network for confirm_payments --subscribe"
                         ),
                     ),
                 ),
@@ -165,14 +169,18 @@ class Ethereum(BasePaymentProvider):
         form_fields["_NETWORKS"]._as_type = list
         return form_fields
 
+    @property
+    def settings_snapshot(self) -> ProviderSettings:
+        return get_provider_settings(self)
+
     def get_token_rates_from_admin_settings(self):
-        return self.settings.get("TOKEN_RATES", as_type=dict, default={})
+        return dict(self.settings_snapshot.token_rates)
 
     def get_networks_chosen_from_admin_settings(self):
-        return set(self.settings.get("_NETWORKS", as_type=list, default=[]))
+        return set(self.settings_snapshot.networks)
 
     def get_receiving_address(self):
-        return self.settings.SINGLE_RECEIVER_ADDRESS
+        return self.settings_snapshot.receiver_address
 
     def is_allowed(self, request, **kwargs):
         one_or_more_currencies_configured = (
@@ -187,7 +195,7 @@ class Ethereum(BasePaymentProvider):
                 len(self.get_networks_chosen_from_admin_settings()) > 0,
                 # TODO: Check that NETWORK_RPC_URL mappings contain all networks selected
                 # TODO: Check that NETWORK_RPC_URL conforms to a schema
-                len(self.settings.NETWORK_RPC_URL) > 0,
+                len(self.settings_snapshot.rpc_urls) > 0,
             )
         )
         if not at_least_one_network_configured:
@@ -203,8 +211,7 @@ class Ethereum(BasePaymentProvider):
             logger.error("Single receiver addresses not configured properly")
 
         walletconnect_project_id_configured = bool(
-            self.settings.WALLETCONNECT_PROJECT_ID is not None
-            and len(self.settings.WALLETCONNECT_PROJECT_ID) > 0
+            self.settings_snapshot.walletconnect_project_id
         )
 
         if not walletconnect_project_id_configured:
@@ -368,8 +375,9 @@ class Ethereum(BasePaymentProvider):
             wallet_address, payment_amount, amount_in_ether_or_token
         )
 
-        walletconnect_project_id = payment.payment_provider.settings.get(
-            "WALLETCONNECT_PROJECT_ID", as_type=str, default="")
+        walletconnect_project_id = get_provider_settings(
+            payment.payment_provider
+        ).walletconnect_project_id
 
         ctx.update(instructions)
         ctx["network_name"] = token.NETWORK_VERBOSE_NAME
@@ -429,10 +437,22 @@ class Ethereum(BasePaymentProvider):
             "transaction_hash": transaction_hash,
             "transaction_hash_link": token.get_transaction_link(
                 transaction_hash),
+            "transaction_receipt": self.get_transaction_receipt(token, transaction_hash),
         }
 
         return template.render(ctx)
 
+    def get_transaction_receipt(self, token: IToken, transaction_hash):
+        """
+        The receipt of a submitted transaction, if it is final and has been cached by
+        the confirm_payments command. Rendering never makes RPC calls.
+        """
+        if not transaction_hash:
+            return None
+        cache = TransactionCache()
+        cache.load([(token.CHAIN_ID, transaction_hash)])
+        return cache.receipt(token.CHAIN_ID, transaction_hash)
+
     abort_pending_allowed = True
 
     def payment_refund_supported(self, payment: OrderPayment):
@@ -0,0 +1,145 @@
+import json
+import logging
+import threading
+import time
+import uuid
+from types import MappingProxyType
+from typing import FrozenSet, Mapping, NamedTuple, Optional, Tuple, Union
+
+from pretix_eth.cache import get_cache
+
+logger = logging.getLogger(__name__)
+
+# Saving the settings bumps a version per event in the shared cache, which every
+# process compares its snapshot against. Without a shared cache, other processes
+# (like a running confirm_payments daemon) pick up changes after this long.
+DEFAULT_TTL = 60
+VERSION_KEY = "pretix_eth_provider_settings_version_{}"
+
+DEFAULT_RETRY_TIMEOUT = 30 * 60
+DEFAULT_SAFETY_BLOCK_COUNT = 10
+
+SETTINGS_KEY_PREFIX = "payment_ethereum_"
+RPC_URL_KEY_SUFFIX = "_RPC_URL"
+WS_URL_KEY_SUFFIX = "_WS_URL"
+
+# One URL, or a tuple of URLs of interchangeable endpoints to fail over between
+RpcUrl = Union[str, Tuple[str, ...]]
+
+
+class ProviderSettings(NamedTuple):
+    """Parsed, read-only settings of the Ethereum payment provider of one event."""
+
+    rpc_urls: Mapping[str, RpcUrl]  # network identifier -> RPC URL(s)
+    ws_urls: Mapping[str, RpcUrl]  # network identifier -> WebSocket RPC URL(s)
+    networks: FrozenSet[str]
+    token_rates: Mapping[str, float]
+    receiver_address: Optional[str]
+    walletconnect_project_id: str
+    retry_timeout: float
+    safety_block_count: int
+
+    def get_rpc_url(self, network_id) -> Optional[RpcUrl]:
+        return self.rpc_urls.get(network_id)
+
+    def get_ws_url(self, network_id) -> Optional[RpcUrl]:
+        return self.ws_urls.get(network_id)
+
+
+def _parse_endpoints(value) -> Optional[RpcUrl]:
+    if isinstance(value, str):
+        return value
+    if isinstance(value, list) and value and all(isinstance(url, str) for url in value):
+        # Duplicates would only count against the same endpoint twice
+        urls = tuple(dict.fromkeys(value))
+        return urls[0] if len(urls) == 1 else urls
+    return None
+
+
+def parse_rpc_urls(value, suffix=RPC_URL_KEY_SUFFIX) -> Mapping[str, RpcUrl]:
+    """
+    Turn the ``NETWORK_RPC_URL`` setting into a map of network identifier -> URL, for
+    the keys that end in ``suffix``. A list of URLs becomes a tuple of endpoints to fail
+    over between.
+    """
+    if not value:
+        return MappingProxyType({})
+    if isinstance(value, str):
+        try:
+            value = json.loads(value)
+        except ValueError:
+            logger.error("NETWORK_RPC_URL is not valid JSON")
+            return MappingProxyType({})
+    if not isinstance(value, dict):
+        logger.error("NETWORK_RPC_URL must be a JSON object")
+        return MappingProxyType({})
+
+    rpc_urls = {}
+    for key, rpc_url in value.items():
+        rpc_url = _parse_endpoints(rpc_url)
+        if not key.endswith((RPC_URL_KEY_SUFFIX, WS_URL_KEY_SUFFIX)) or rpc_url is None:
+            logger.warning(f"Ignoring invalid NETWORK_RPC_URL entry {key}")
+            continue
+        if key.endswith(suffix):
+            rpc_urls[key[:-len(suffix)]] = rpc_url
+    return MappingProxyType(rpc_urls)
+
+
+def load_provider_settings(provider_settings) -> ProviderSettings:
+    """Build a snapshot from the (``SettingsSandbox``) settings of a payment provider."""
+    receiver_address = provider_settings.get("SINGLE_RECEIVER_ADDRESS", as_type=str)
+    retry_timeout = provider_settings.get("PAYMENT_NOT_RECIEVED_RETRY_TIMEOUT", as_type=float)
+    safety_block_count = provider_settings.get("SAFETY_BLOCK_COUNT", as_type=int)
+
+    network_rpc_urls = provider_settings.get("NETWORK_RPC_URL", as_type=str)
+
+    return ProviderSettings(
+        rpc_urls=parse_rpc_urls(network_rpc_urls),
+        ws_urls=parse_rpc_urls(network_rpc_urls, WS_URL_KEY_SUFFIX),
+        networks=frozenset(provider_settings.get("_NETWORKS", as_type=list, default=[])),
+        token_rates=MappingProxyType(
+            provider_settings.get("TOKEN_RATES", as_type=dict, default={})
+        ),
+        receiver_address=receiver_address.strip() if receiver_address else None,
+        walletconnect_project_id=provider_settings.get(
+            "WALLETCONNECT_PROJECT_ID", as_type=str, default=""
+        ) or "",
+        retry_timeout=DEFAULT_RETRY_TIMEOUT if retry_timeout is None else retry_timeout,
+        safety_block_count=(
+            DEFAULT_SAFETY_BLOCK_COUNT if safety_block_count is None else safety_block_count
+        ),
+    )
+
+
+_snapshots = {}
+_snapshots_lock = threading.Lock()
+
+
+def get_provider_settings(payment_provider, ttl=DEFAULT_TTL, clock=time.monotonic):
+    """Return the cached settings snapshot of ``payment_provider``'s event."""
+    event_id = payment_provider.event.pk
+    now = clock()
+    version = get_cache().get(VERSION_KEY.format(event_id))
+    with _snapshots_lock:
+        cached = _snapshots.get(event_id)
+    if cached is not None and cached[1] > now and cached[2] == version:
+        return cached[0]
+
+    snapshot = load_provider_settings(payment_provider.settings)
+    with _snapshots_lock:
+        _snapshots[event_id] = (snapshot, now + ttl, version)
+    return snapshot
+
+
+def invalidate_provider_settings(event_id=None):
+    """
+    Drop the snapshot of one event, also in other processes, or the snapshots of all
+    events in this process if ``event_id`` is None.
+    """
+    with _snapshots_lock:
+        if event_id is None:
+            _snapshots.clear()
+        else:
+            _snapshots.pop(event_id, None)
+    if event_id is not None:
+        get_cache().set(VERSION_KEY.format(event_id), uuid.uuid4().hex, None)
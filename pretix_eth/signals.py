@@ -1,3 +1,4 @@
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
 from django.template.loader import get_template
 
@@ -6,12 +7,14 @@ from pretix.presale.signals import (
     html_head,
     process_response,
 )
+from pretix.base.models import Event_SettingsStore
 from pretix.base.signals import (
     register_payment_providers,
     register_data_exporters,
 )
 
 from .exporter import EthereumOrdersExporter
+from .provider_settings import SETTINGS_KEY_PREFIX, invalidate_provider_settings
 
 
 NUM_WIDGET = '<div class="numwidget"><span class="num">{num}</span><span class="text">{text}</span></div>'  # noqa: E501
@@ -95,3 +98,10 @@ def register_payment_provider(sender, **kwargs):
 @receiver(register_data_exporters, dispatch_uid='single_event_eth_orders')
 def register_data_exporter(sender, **kwargs):
     return EthereumOrdersExporter
+
+
+@receiver(post_save, sender=Event_SettingsStore, dispatch_uid="payment_eth_settings_saved")
+@receiver(post_delete, sender=Event_SettingsStore, dispatch_uid="payment_eth_settings_deleted")
+def invalidate_provider_settings_on_change(sender, instance, **kwargs):
+    if instance.key.startswith(SETTINGS_KEY_PREFIX):
+        invalidate_provider_settings(instance.object_id)
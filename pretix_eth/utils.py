@@ -1,8 +1,9 @@
-import json
 import logging
 
 from eth_account._utils.structured_data.validation import validate_structured_data
 
+from pretix_eth.provider_settings import get_provider_settings
+
 
 logger = logging.getLogger(__name__)
 
@@ -46,12 +47,8 @@ def get_message_to_sign(
 
 
 def get_rpc_url_for_network(payment_provider, network_id):
-    rpc_urls = json.loads(payment_provider.settings.NETWORK_RPC_URL)
-
-    expected_network_rpc_url_key = f"{network_id}_RPC_URL"
+    rpc_url = get_provider_settings(payment_provider).get_rpc_url(network_id)
 
-    if expected_network_rpc_url_key in rpc_urls:
-        return rpc_urls[expected_network_rpc_url_key]
-    else:
+    if rpc_url is None:
         logger.warning(f"No RPC URL configured for {network_id}. Skipping...")
-        return None
+    return rpc_url
@@ -0,0 +1,224 @@
+import functools
+import logging
+from typing import NamedTuple, Optional
+
+from web3 import Web3
+
+from pretix_eth.exceptions import TransactionProviderError
+from pretix_eth.network.tokens import IToken, TOKEN_ABI
+
+logger = logging.getLogger(__name__)
+
+CONFIRM = "confirm"
+INVALIDATE = "invalidate"
+SKIP = "skip"
+
+
+class Verdict(NamedTuple):
+    action: str  # one of CONFIRM, INVALIDATE, SKIP
+    reason: str
+    payment_amount: Optional[int] = None
+    block_number: Optional[int] = None  # block the transaction was mined in, if found
+    head: Optional[int] = None  # block height the decision was made at
+    sender: Optional[str] = None  # sender of the transfer, once it was verified
+
+
+# Verdicts on a receipt that is past the safety margin, which won't change on a re-check
+FINAL_REASONS = ("no_transfer", "mismatch", "no_payment", "underpaid")
+
+
+class PendingTransfer(object):
+    """
+    Everything needed to verify one signed message against the chain, detached from the
+    database so that the verification itself can run anywhere.
+    """
+
+    def __init__(
+        self,
+        signed_message,
+        order_payment,
+        token: IToken,
+        rpc_url,
+        expected_amount: int,
+        retry_timeout: float,
+        safety_block_count: int,
+        transaction_hash: Optional[str] = None,
+        safe_transaction: Optional[dict] = None,
+        state=None,
+        ws_url: Optional[str] = None,
+    ):
+        self.signed_message = signed_message
+        self.order_payment = order_payment
+        self.token = token
+        self.rpc_url = rpc_url
+        # WebSocket endpoint of the same chain, to follow new blocks with
+        self.ws_url = ws_url
+        self.expected_amount = expected_amount
+        self.retry_timeout = retry_timeout
+        self.safety_block_count = safety_block_count
+        # For Safe transactions this is the hash of the executed transaction reported by
+        # the Safe transaction service, not whatever the signed message was submitted with.
+        self.transaction_hash = transaction_hash or signed_message.transaction_hash
+        self.safe_transaction = safe_transaction
+        # The VerificationState of the signed message, if it was checked before
+        self.state = state
+
+    @property
+    def is_expired(self):
+        return self.signed_message.age > self.retry_timeout
+
+    @property
+    def needs_transaction(self):
+        """Native transfers outside of Safe carry the paid amount on the transaction only."""
+        return self.token.IS_NATIVE_ASSET and self.safe_transaction is None
+
+
+def not_found_verdict(pending: PendingTransfer, reason: str) -> Verdict:
+    """Nothing to verify (yet) - give up on the signed message once it is old enough."""
+    if pending.is_expired:
+        return Verdict(INVALIDATE, reason)
+    return Verdict(SKIP, reason)
+
+
+def verdict_from_state(pending: PendingTransfer, head) -> Optional[Verdict]:
+    """
+    Repeat the verdict of an earlier check if nothing it depended on can have changed
+    by block ``head``, or return None if the transfer has to be looked up again.
+    """
+    state = pending.state
+    if state is None:
+        return None
+
+    found = dict(block_number=state.block_number, head=head)
+
+    if state.next_check_block is not None and head < state.next_check_block:
+        return Verdict(SKIP, "too_young", **found)
+
+    if (
+        state.receipt_found
+        and state.reason in FINAL_REASONS
+        and is_old_enough(state.block_number, pending.safety_block_count, head)
+    ):
+        payment_amount = state.verified_amount
+        if payment_amount is not None:
+            payment_amount = int(payment_amount)
+        return Verdict(SKIP, state.reason, payment_amount, sender=state.verified_sender, **found)
+
+    return None
+
+
+def parse_safe_transaction(response_json: dict) -> Optional[dict]:
+    """
+    Extract the executed transfer from a Safe transaction service response, or return
+    None if the Safe transaction hasn't been executed successfully (yet).
+    """
+    if not (response_json.get('isExecuted') and response_json.get('isSuccessful')):
+        return None
+
+    return {
+        "sender": response_json.get('safe').lower(),
+        "receiver": response_json.get('to'),
+        "amount": int(response_json.get('value')),
+        "transaction_hash": response_json.get('transactionHash'),
+    }
+
+
+@functools.lru_cache(maxsize=None)
+def _transfer_event(token_address):
+    return Web3().eth.contract(address=token_address, abi=TOKEN_ABI).events.Transfer()
+
+
+def is_old_enough(block_number, safety_block_count, head):
+    return block_number is not None and block_number + safety_block_count <= head
+
+
+def is_eligible_receipt(receipt, safety_block_count, head):
+    """Whether ``receipt`` belongs to a successful transaction with enough confirmations."""
+    return (
+        receipt is not None
+        and not isinstance(receipt, TransactionProviderError)
+        and receipt.status != 0
+        and is_old_enough(receipt.blockNumber, safety_block_count, head)
+    )
+
+
+def verify_transfer(pending: PendingTransfer, receipt, transaction, head) -> Verdict:
+    """
+    Decide what to do with a pending transfer, given its receipt, its transaction (only
+    fetched if ``pending.needs_transaction``) and the current block height.
+
+    This makes no RPC calls and touches no database rows.
+    """
+    if isinstance(receipt, TransactionProviderError):
+        return Verdict(SKIP, "rpc_error")
+    if receipt is None:
+        return not_found_verdict(pending, "not_found")
+
+    found = dict(block_number=receipt.blockNumber, head=head)
+
+    if receipt.status == 0:
+        return Verdict(INVALIDATE, "failed", **found)
+
+    if not is_old_enough(receipt.blockNumber, pending.safety_block_count, head):
+        return Verdict(SKIP, "too_young", **found)
+
+    safe_transaction = pending.safe_transaction
+    token = pending.token
+    signed_message = pending.signed_message
+
+    if token.IS_NATIVE_ASSET:
+        if safe_transaction is not None:
+            receipt_receiver = safe_transaction["receiver"]
+            payment_amount = safe_transaction["amount"]
+        else:
+            if isinstance(transaction, TransactionProviderError) or transaction is None:
+                return Verdict(SKIP, "rpc_error", **found)
+            receipt_receiver = (receipt.to or "").lower()
+            payment_amount = transaction.value
+
+        correct_recipient = (
+            receipt_receiver == signed_message.recipient_address.lower()
+        )
+    else:
+        # This may warn about mismatched ABI if its a smart contract wallet tx because of intermediary function calls - but it'll still process the Transfer event correctly # noqa: E501
+        transfers = _transfer_event(token.ADDRESS).process_receipt(receipt)
+        if not transfers:
+            return Verdict(SKIP, "no_transfer", **found)
+        transaction_details = transfers[0].args
+
+        payment_amount = transaction_details.value
+        receipt_receiver = transaction_details.to.lower()
+
+        # Safe has intermediary function calls (which is not the token address), so we'll need to pull the receiver address from the internal safe transaction rather than the tx receipt # noqa: E501
+        if safe_transaction is not None:
+            called_contract = safe_transaction["receiver"] or ""
+        else:
+            called_contract = receipt.to or ""
+        correct_contract = token.ADDRESS.lower() == called_contract.lower()
+
+        correct_recipient = correct_contract and (
+            receipt_receiver == signed_message.recipient_address.lower())
+
+    if safe_transaction is not None:
+        receipt_sender = safe_transaction["sender"]
+    else:
+        receipt_sender = getattr(receipt, "from").lower()
+
+    correct_sender = receipt_sender == signed_message.sender_address.lower()
+
+    if not (correct_sender and correct_recipient):
+        logger.debug(
+            f"receipt sender={receipt_sender}, "
+            f"expected sender={signed_message.sender_address.lower()}, "
+            f"receipt recipient={receipt_receiver}, "
+            f"expected recipient={signed_message.recipient_address.lower()}"
+        )
+        return Verdict(SKIP, "mismatch", payment_amount, sender=receipt_sender, **found)
+
+    found["sender"] = receipt_sender
+    if payment_amount <= 0:
+        return Verdict(SKIP, "no_payment", payment_amount, **found)
+    if payment_amount < pending.expected_amount:
+        return Verdict(SKIP, "underpaid", payment_amount, **found)
+
+    return Verdict(CONFIRM, "confirmed", payment_amount, **found)
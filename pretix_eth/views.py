@@ -2,7 +2,6 @@ import json
 
 from web3 import Web3
 from eth_account.messages import encode_structured_data, defunct_hash_message
-from web3.providers.auto import load_provider_from_uri
 
 from django.http import HttpResponseBadRequest
 from django.shortcuts import get_object_or_404
@@ -18,6 +17,7 @@ from pretix_eth import serializers
 from pretix_eth.models import SignedMessage
 from pretix_eth.utils import get_rpc_url_for_network
 from pretix_eth.network import tokens
+from pretix_eth.network.rpc import get_web3
 
 # Magic value in accordance to EIP1271 specification
 magic_value = '0x1626ba7e'
@@ -91,12 +91,10 @@ class PaymentTransactionDetailsView(GenericViewSet):
         typed_data = serializer.data.get('message')
         typed_data['message']['sender_address'] = sender_address
 
-        w3 = Web3(
-            load_provider_from_uri(
-                get_rpc_url_for_network(
-                    order_payment.payment_provider,
-                    serializer.data.get('network_identifier')
-                )
+        w3 = get_web3(
+            get_rpc_url_for_network(
+                order_payment.payment_provider,
+                serializer.data.get('network_identifier')
             )
         )
 
@@ -148,12 +146,10 @@ class PaymentTransactionDetailsView(GenericViewSet):
         typed_data = serializer.data.get('message')
         typed_data['message']['sender_address'] = sender_address
 
-        w3 = Web3(
-            load_provider_from_uri(
-                get_rpc_url_for_network(
-                    order_payment.payment_provider,
-                    serializer.data.get('network_identifier')
-                )
+        w3 = get_web3(
+            get_rpc_url_for_network(
+                order_payment.payment_provider,
+                serializer.data.get('network_identifier')
             )
         )
 
@@ -0,0 +1,3 @@
+# Sender and receiver of the transfers built by the make_pending fixture
+SENDER = '0x1111111111111111111111111111111111111111'
+RECEIVER = '0x47ABC45600bFb8069f53E55638Da593313e352C3'
@@ -0,0 +1,265 @@
+import datetime
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from django.utils import timezone
+from pretix.base.models import Order, OrderPayment
+
+from pretix_eth.confirmation.logs import TRANSFER_TOPIC, address_to_topic
+from pretix_eth.models import SignedMessage
+from pretix_eth.network import rpc
+from pretix_eth.network.tokens import all_token_and_network_ids_to_tokens
+
+SENDER = '0x1111111111111111111111111111111111111111'
+RECEIVER = '0x47abc45600bfb8069f53e55638da593313e352c3'
+
+HEAD = 1000
+SAFETY_BLOCK_COUNT = 5
+CURRENCY_TYPES = ("ETH - L1", "DAI - L1", "ETH - Optimism", "DAI - Arbitrum")
+AMOUNT = 10 ** 16
+
+# What the chain holds for the n-th seeded payment, by n % 4
+PAID, UNDERPAID, MISSING, TOO_YOUNG = range(4)
+
+ZERO_HASH = "0x" + "00" * 32
+
+
+class StubChain(object):
+    """
+    Just enough of the JSON-RPC API of several chains, one per URL path, to verify
+    transfers: blocks, receipts, transactions and Transfer logs. Batches are supported.
+    """
+
+    def __init__(self):
+        self.head = {}
+        self.receipts = {}
+        self.transactions = {}
+        self.logs = {}
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.http_requests = 0
+
+    def add_transfer(self, network, transaction_hash, amount, block_number, token_address=None):
+        value = hex(amount)
+        log = None
+        if token_address is not None:
+            log = {
+                "address": token_address,
+                "topics": [
+                    TRANSFER_TOPIC, address_to_topic(SENDER), address_to_topic(RECEIVER)
+                ],
+                "data": "0x" + hex(amount)[2:].rjust(64, "0"),
+                "blockNumber": hex(block_number),
+                "blockHash": ZERO_HASH,
+                "transactionHash": transaction_hash,
+                "transactionIndex": "0x0",
+                "logIndex": "0x0",
+                "removed": False,
+            }
+            self.logs.setdefault(network, []).append(log)
+            value = "0x0"
+
+        self.receipts[(network, transaction_hash)] = {
+            "blockHash": ZERO_HASH,
+            "blockNumber": hex(block_number),
+            "contractAddress": None,
+            "cumulativeGasUsed": "0x5208",
+            "effectiveGasPrice": "0x1",
+            "from": SENDER,
+            "gasUsed": "0x5208",
+            "logs": [log] if log is not None else [],
+            "logsBloom": "0x" + "00" * 256,
+            "status": "0x1",
+            "to": token_address or RECEIVER,
+            "transactionHash": transaction_hash,
+            "transactionIndex": "0x0",
+            "type": "0x2",
+        }
+        self.transactions[(network, transaction_hash)] = {
+            "blockHash": ZERO_HASH,
+            "blockNumber": hex(block_number),
+            "from": SENDER,
+            "gas": "0x5208",
+            "gasPrice": "0x1",
+            "hash": transaction_hash,
+            "input": "0x",
+            "nonce": "0x0",
+            "to": token_address or RECEIVER,
+            "transactionIndex": "0x0",
+            "value": value,
+            "type": "0x0",
+            "v": "0x1",
+            "r": "0x1",
+            "s": "0x1",
+        }
+
+    def _get_logs(self, network, log_filter):
+        from_block = int(log_filter["fromBlock"], 16)
+        to_block = int(log_filter["toBlock"], 16)
+        topics = log_filter.get("topics") or []
+        return [
+            log for log in self.logs.get(network, [])
+            if log["address"].lower() == log_filter["address"].lower()
+            and from_block <= int(log["blockNumber"], 16) <= to_block
+            and all(
+                topic is None or topic == log["topics"][index]
+                for index, topic in enumerate(topics)
+            )
+        ]
+
+    def call(self, network, method, params):
+        if method == "eth_blockNumber":
+            return hex(self.head[network])
+        if method == "eth_getTransactionReceipt":
+            return self.receipts.get((network, params[0]))
+        if method == "eth_getTransactionByHash":
+            return self.transactions.get((network, params[0]))
+        if method == "eth_getLogs":
+            return self._get_logs(network, params[0])
+        raise ValueError(f"Unsupported method {method}")
+
+    def respond(self, network, request):
+        try:
+            result = self.call(network, request["method"], request.get("params", []))
+        except ValueError as e:
+            return {"jsonrpc": "2.0", "id": request["id"], "error": {"message": str(e)}}
+        return {"jsonrpc": "2.0", "id": request["id"], "result": result}
+
+    def handle(self, network, body):
+        requests = json.loads(body)
+        batch = isinstance(requests, list)
+        if not batch:
+            requests = [requests]
+        with self.lock:
+            self.calls += len(requests)
+            self.http_requests += 1
+        responses = [self.respond(network, request) for request in requests]
+        return json.dumps(responses if batch else responses[0]).encode()
+
+
+@pytest.fixture
+def stub_chain():
+    chain = StubChain()
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers["Content-Length"]))
+            response = chain.handle(self.path.strip("/"), body)
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(response)))
+            self.end_headers()
+            self.wfile.write(response)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    chain.url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    rpc.clear_clients()
+    yield chain
+    rpc.clear_clients()
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def seed_payments(stub_chain, provider, event, get_organizer_scope):
+    """
+    Create ``count`` pending payments with one signed message each, spread over
+    CURRENCY_TYPES, and put a matching transfer on the stub chain for most of them.
+    Returns the payments that were paid in full and should be confirmed.
+    """
+    def _seed_payments(count):
+        networks = sorted(set(
+            all_token_and_network_ids_to_tokens[currency_type].NETWORK_IDENTIFIER
+            for currency_type in CURRENCY_TYPES
+        ))
+        provider.settings.set("NETWORK_RPC_URL", {
+            f"{network}_RPC_URL": f"{stub_chain.url}/{network}" for network in networks
+        })
+        provider.settings.set("SINGLE_RECEIVER_ADDRESS", RECEIVER)
+        provider.settings.set("SAFETY_BLOCK_COUNT", SAFETY_BLOCK_COUNT)
+        provider.settings.set("PAYMENT_NOT_RECIEVED_RETRY_TIMEOUT", 1800)
+        for network in networks:
+            stub_chain.head[network] = HEAD
+
+        now = timezone.now()
+        with get_organizer_scope():
+            orders = Order.objects.bulk_create([
+                Order(
+                    event=event,
+                    code=f"B{index:07d}",
+                    email="test@example.com",
+                    locale="en",
+                    datetime=now,
+                    expires=now + datetime.timedelta(days=1),
+                    total=100,
+                    status=Order.STATUS_PENDING,
+                )
+                for index in range(count)
+            ])
+            orders = list(Order.objects.filter(event=event).order_by("code"))
+
+            payments = []
+            for index, order in enumerate(orders):
+                payment = OrderPayment(
+                    order=order,
+                    local_id=1,
+                    amount=100,
+                    provider="ethereum",
+                    state=OrderPayment.PAYMENT_STATE_PENDING,
+                )
+                payment.info_data = {
+                    "currency_type": CURRENCY_TYPES[index % len(CURRENCY_TYPES)],
+                    "time": int(now.timestamp()),
+                    "amount": AMOUNT,
+                }
+                payments.append(payment)
+            OrderPayment.objects.bulk_create(payments)
+            payments = list(
+                OrderPayment.objects.filter(order__event=event).order_by("order__code")
+            )
+
+        signed_messages = []
+        paid = []
+        for index, payment in enumerate(payments):
+            currency_type = CURRENCY_TYPES[index % len(CURRENCY_TYPES)]
+            token = all_token_and_network_ids_to_tokens[currency_type]
+            transaction_hash = f"0x{index + 1:064x}"
+            signed_messages.append(SignedMessage(
+                signature="0x",
+                raw_message="{}",
+                sender_address=SENDER,
+                recipient_address=RECEIVER,
+                chain_id=token.CHAIN_ID,
+                order_payment=payment,
+                transaction_hash=transaction_hash,
+                created_at=now,
+            ))
+
+            outcome = index % 4
+            if outcome == PAID:
+                paid.append(payment)
+            elif outcome == MISSING:
+                continue
+            stub_chain.add_transfer(
+                token.NETWORK_IDENTIFIER,
+                transaction_hash,
+                AMOUNT // 2 if outcome == UNDERPAID else AMOUNT,
+                HEAD - 1 if outcome == TOO_YOUNG else HEAD - 100,
+                token_address=None if token.IS_NATIVE_ASSET else token.ADDRESS,
+            )
+        SignedMessage.objects.bulk_create(signed_messages)
+
+        return paid
+
+    return _seed_payments
@@ -0,0 +1,82 @@
+import time
+
+import pytest
+from django.core.management import call_command
+from pretix.base.models import OrderPayment
+
+from pretix_eth.metrics import metrics
+
+
+def check_benchmark(pytestconfig):
+    __tracebackhide__ = True
+
+    if not pytestconfig.getoption("--benchmark"):
+        pytest.skip("--benchmark flag is not set")
+
+
+def run_confirm_payments(*args, **options):
+    metrics.clear()
+    started_at = time.perf_counter()
+    call_command("confirm_payments", *args, **options)
+    return time.perf_counter() - started_at
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("engine", ["receipts", "async"])
+def test_stub_chain_run_confirms_the_paid_transfers(engine, seed_payments, stub_chain,
+                                                    get_organizer_scope):
+    paid = seed_payments(40)
+
+    run_confirm_payments("--no-dry-run", engine=engine, batch_size=8)
+
+    with get_organizer_scope():
+        confirmed = set(
+            OrderPayment.objects.filter(
+                state=OrderPayment.PAYMENT_STATE_CONFIRMED
+            ).values_list("pk", flat=True)
+        )
+    assert confirmed == {payment.pk for payment in paid}
+    assert metrics.total("pretix_eth_messages_examined_total") == 40
+    if engine == "receipts":
+        # receipts and native transactions are looked up in batches
+        assert stub_chain.http_requests < stub_chain.calls / 4
+
+
+@pytest.mark.django_db
+def test_stub_chain_run_stops_when_its_rpc_budget_is_spent(seed_payments, stub_chain):
+    seed_payments(40)
+
+    run_confirm_payments("--no-dry-run", batch_size=8, max_rpc_calls=12)
+
+    examined = metrics.total("pretix_eth_messages_examined_total")
+    assert 0 < examined < 40
+    assert metrics.total("pretix_eth_rpc_calls_total") <= 12 + 8
+    assert metrics.total("pretix_eth_deferred_transfers_total") == 40 - examined
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("engine, workers", [
+    ("receipts", 0),
+    ("receipts", 4),
+    ("async", 0),
+    ("logs", 0),
+])
+def test_benchmark_confirm_payments(engine, workers, seed_payments, stub_chain,
+                                    pytestconfig, capsys):
+    check_benchmark(pytestconfig)
+    count = pytestconfig.getoption("--benchmark-payments")
+    seed_payments(count)
+
+    duration = run_confirm_payments(engine=engine, workers=workers)
+
+    examined = metrics.total("pretix_eth_messages_examined_total")
+    assert examined == count
+    with capsys.disabled():
+        print(
+            f"\nconfirm_payments --engine={engine} --workers={workers}: "
+            f"{count} payments in {duration:.2f}s, "
+            f"{count / duration:.1f} payments/s, "
+            f"{metrics.total('pretix_eth_rpc_calls_total') / count:.2f} RPC calls/payment "
+            f"in {stub_chain.http_requests} HTTP requests, "
+            f"{metrics.total('pretix_eth_db_queries_total') / count:.2f} DB queries/payment"
+        )
@@ -2,6 +2,7 @@ import datetime
 import decimal
 import contextlib
 from packaging import version
+from types import SimpleNamespace
 
 from django.utils import timezone
 import pretix
@@ -17,9 +18,31 @@ from pretix.base.models import (
 )
 import pytest
 
+from pretix_eth.cache import local_cache
+from pretix_eth.network.tokens import all_token_and_network_ids_to_tokens
 from pretix_eth.payment import Ethereum
+from pretix_eth.provider_settings import invalidate_provider_settings
+from pretix_eth.verification import PendingTransfer
 from rest_framework.test import APIClient
 
+from addresses import RECEIVER, SENDER
+
+
+@pytest.fixture(autouse=True)
+def clear_provider_settings():
+    # Events of different tests share primary keys
+    invalidate_provider_settings()
+    yield
+    invalidate_provider_settings()
+
+
+@pytest.fixture(autouse=True)
+def clear_local_cache():
+    # Stands in for the dummy cache of the test settings
+    local_cache.clear()
+    yield
+    local_cache.clear()
+
 
 @pytest.fixture
 def organizer(django_db_reset_sequences):
@@ -80,6 +103,34 @@ def provider(event):
     return provider
 
 
+@pytest.fixture
+def make_pending():
+    """
+    Builds pending transfers without database rows behind them. Keyword arguments
+    other than the ones below are set on the signed message.
+    """
+    def _make_pending(index=0, currency_type="ETH - L1", amount=1000, age=0,
+                      retry_timeout=1800, rpc_url=None, order_payment=None, **signed_message):
+        token = all_token_and_network_ids_to_tokens[currency_type]
+        signed_message = dict({
+            'transaction_hash': f'0x{index:064x}',
+            'sender_address': SENDER,
+            'recipient_address': RECEIVER,
+            'age': age,
+        }, **signed_message)
+        return PendingTransfer(
+            signed_message=SimpleNamespace(**signed_message),
+            order_payment=order_payment,
+            token=token,
+            rpc_url=rpc_url or f'https://{token.NETWORK_IDENTIFIER}.example.org',
+            expected_amount=amount,
+            retry_timeout=retry_timeout,
+            safety_block_count=5,
+        )
+
+    return _make_pending
+
+
 @pytest.fixture
 def get_organizer_scope(organizer):
     if version.parse(pretix.__version__) >= version.parse('3.0.0'):
@@ -139,6 +190,14 @@ def pytest_addoption(parser):
         "--require-web3", action="store_true", default=False,
         help="run integration tests that need web3 provider",
     )
+    parser.addoption(
+        "--benchmark", action="store_true", default=False,
+        help="run confirm_payments benchmarks against a local stub chain",
+    )
+    parser.addoption(
+        "--benchmark-payments", type=int, default=2000,
+        help="number of pending payments to seed for each benchmark",
+    )
 
 
 def pytest_configure(config):
@@ -0,0 +1,146 @@
+import asyncio
+import threading
+import time
+
+import pytest
+from web3.datastructures import AttributeDict
+
+from pretix_eth.confirmation import async_engine as async_engine_module
+from pretix_eth.confirmation import engine as engine_module
+from pretix_eth.confirmation.async_engine import AsyncReceiptEngine
+from pretix_eth.confirmation.engine import ReceiptEngine
+from addresses import RECEIVER, SENDER
+
+
+def answer(method, params):
+    """Confirm every transaction hash divisible by 3, underpay the ones that are 1 off."""
+    if method == "eth_blockNumber":
+        return 200
+    index = int(params[0], 16)
+    if index % 3 == 2:
+        return None
+    if method == "eth_getTransactionReceipt":
+        return AttributeDict({
+            'status': 1, 'blockNumber': 100, 'to': RECEIVER, 'from': SENDER,
+        })
+    return AttributeDict({'value': 1000 if index % 3 == 0 else 10})
+
+
+class FakeAsyncChain(object):
+    def __init__(self, delay=0.01):
+        self.delay = delay
+        self.in_flight = {}
+        self.max_in_flight = {}
+        self.methods = []
+
+    async def request(self, provider, method, params, network=None):
+        rpc_url = provider
+        self.in_flight[rpc_url] = self.in_flight.get(rpc_url, 0) + 1
+        self.max_in_flight[rpc_url] = max(
+            self.max_in_flight.get(rpc_url, 0), self.in_flight[rpc_url]
+        )
+        await asyncio.sleep(self.delay)
+        self.in_flight[rpc_url] -= 1
+        self.methods.append(method)
+        return answer(method, params)
+
+
+class FakeSession(object):
+    closed = False
+
+    async def close(self):
+        self.closed = True
+
+
+def run_async_engine(monkeypatch, chain, pending_transfers, **kwargs):
+    sessions = []
+
+    async def fake_make_async_provider(rpc_url, connections):
+        sessions.append(FakeSession())
+        return rpc_url, sessions[-1]
+
+    monkeypatch.setattr(async_engine_module, "make_async_provider", fake_make_async_provider)
+    monkeypatch.setattr(async_engine_module, "async_request", chain.request)
+    engine = AsyncReceiptEngine(**kwargs)
+    try:
+        return {
+            pending.transaction_hash: verdict
+            for pending, verdict in engine.verify(pending_transfers)
+        }
+    finally:
+        engine.close()
+        assert sessions and all(session.closed for session in sessions)
+
+
+@pytest.mark.django_db
+def test_async_engine_produces_the_same_verdicts_as_the_receipt_engine(monkeypatch, make_pending):
+    pending_transfers = [
+        make_pending(i, currency_type)
+        for i, currency_type in enumerate(["ETH - L1", "ETH - Arbitrum"] * 12)
+    ]
+    monkeypatch.setattr(engine_module, "get_web3", lambda rpc_url: rpc_url)
+    monkeypatch.setattr(
+        engine_module, "batch_request",
+        lambda w3, calls, batch_size, network=None: [answer(*call) for call in calls],
+    )
+    batched = {
+        pending.transaction_hash: verdict
+        for pending, verdict in ReceiptEngine(batch_size=5).verify(pending_transfers)
+    }
+
+    concurrent = run_async_engine(monkeypatch, FakeAsyncChain(), pending_transfers)
+
+    assert len(batched) == 24
+    assert concurrent == batched
+    assert sorted(set(verdict.reason for verdict in concurrent.values())) == [
+        "confirmed", "not_found", "underpaid",
+    ]
+
+
+@pytest.mark.django_db
+def test_async_engine_caps_requests_in_flight_per_rpc_url(monkeypatch, make_pending):
+    chain = FakeAsyncChain()
+    pending_transfers = [
+        make_pending(i, currency_type)
+        for i, currency_type in enumerate(["ETH - L1", "ETH - Arbitrum"] * 20)
+    ]
+
+    run_async_engine(monkeypatch, chain, pending_transfers, concurrency=4)
+
+    assert set(chain.max_in_flight.values()) == {4}
+    # one block height per network, one receipt per transfer, and transactions only
+    # for the receipts that can confirm a payment
+    assert chain.methods.count("eth_blockNumber") == 2
+    assert chain.methods.count("eth_getTransactionReceipt") == 40
+    assert chain.methods.count("eth_getTransactionByHash") == 27
+
+
+@pytest.mark.django_db
+def test_requests_without_an_async_provider_are_capped_too(monkeypatch, make_pending):
+    lock = threading.Lock()
+    in_flight = [0]
+    max_in_flight = [0]
+
+    def batch_request(w3, calls, batch_size, network=None):
+        with lock:
+            in_flight[0] += 1
+            max_in_flight[0] = max(max_in_flight[0], in_flight[0])
+        time.sleep(0.01)
+        with lock:
+            in_flight[0] -= 1
+        return [answer(*call) for call in calls]
+
+    monkeypatch.setattr(async_engine_module, "get_web3", lambda rpc_url: rpc_url)
+    monkeypatch.setattr(async_engine_module, "batch_request", batch_request)
+    pending_transfers = [make_pending(i, "ETH - L1") for i in range(20)]
+    for pending in pending_transfers:
+        pending.rpc_url = '/var/run/geth.ipc'
+
+    engine = AsyncReceiptEngine(concurrency=2)
+    try:
+        verdicts = list(engine.verify(pending_transfers))
+    finally:
+        engine.close()
+
+    assert len(verdicts) == 20
+    assert max_in_flight[0] == 2
@@ -0,0 +1,381 @@
+import datetime
+from types import SimpleNamespace
+
+import pytest
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from pretix.base.models import Event, Order, OrderPayment
+
+from pretix_eth.confirmation.leases import claim_order_payments
+from pretix_eth.management.commands.confirm_payments import Command
+from pretix_eth.models import SignedMessage, VerificationState
+from pretix_eth.network.tokens import all_token_and_network_ids_to_tokens
+from pretix_eth.verification import (
+    CONFIRM,
+    SKIP,
+    PendingTransfer,
+    Verdict,
+    not_found_verdict,
+)
+
+
+def add_signed_message(payment, index, invalid=False):
+    return SignedMessage.objects.create(
+        signature='0x',
+        raw_message='{}',
+        sender_address='0x1111111111111111111111111111111111111111',
+        recipient_address='0x47ABC45600bFb8069f53E55638Da593313e352C3',
+        chain_id=1,
+        order_payment=payment,
+        transaction_hash=f'0x{index:064x}',
+        invalid=invalid,
+    )
+
+
+@pytest.mark.django_db
+def test_only_payments_with_signed_messages_are_collected(
+    monkeypatch, get_order_and_payment, get_organizer_scope
+):
+    payments = [get_order_and_payment()[1] for _ in range(6)]
+    valid, invalidated, unsigned, other_provider, confirmed, canceled = payments
+    with get_organizer_scope():
+        add_signed_message(valid, 1)
+        add_signed_message(invalidated, 2, invalid=True)
+        add_signed_message(other_provider, 3)
+        add_signed_message(confirmed, 4)
+        add_signed_message(canceled, 5)
+        OrderPayment.objects.filter(pk=other_provider.pk).update(provider='banktransfer')
+        OrderPayment.objects.filter(pk=confirmed.pk).update(
+            state=OrderPayment.PAYMENT_STATE_CONFIRMED
+        )
+        OrderPayment.objects.filter(pk=canceled.pk).update(
+            state=OrderPayment.PAYMENT_STATE_CANCELED
+        )
+
+    collected = []
+
+    def fake_collect_pending_transfers(self, order_payment, log_verbosity=0):
+        collected.append(order_payment)
+        return [
+            SimpleNamespace(signed_message=signed_message)
+            for signed_message in order_payment.signed_messages.all()
+        ]
+
+    monkeypatch.setattr(Command, "collect_pending_transfers", fake_collect_pending_transfers)
+
+    with CaptureQueriesContext(connection) as queries:
+        pending_transfers = Command().collect_all_pending_transfers(chunk_size=1)
+
+    # invalidated signed messages are still checked, low-gas transactions may be
+    # mined late
+    assert [payment.pk for payment in collected] == [valid.pk, invalidated.pk, canceled.pk]
+    assert len(pending_transfers) == 3
+    # one query for the events, one for the payments, signed messages with their
+    # verification state prefetched per chunk and one UPDATE for expired signed
+    # messages, on top of setting up the payment provider
+    assert len([
+        query for query in queries.captured_queries if 'settingsstore' not in query['sql']
+    ]) == 9
+    # all payments share the same event instance
+    assert collected[0].order.event is collected[2].order.event
+
+
+@pytest.mark.django_db
+def test_only_events_with_signed_pending_payments_are_loaded(
+    event, organizer, get_order_and_payment, get_organizer_scope
+):
+    add_signed_message(get_order_and_payment()[1], 1)
+    with get_organizer_scope():
+        unsigned_event = Event.objects.create(
+            organizer=organizer, name="Unsigned", slug="unsigned", plugins="pretix_eth",
+            date_from=event.date_from,
+        )
+        order = Order.objects.create(
+            event=unsigned_event, email='a@example.org', total=100,
+            status=Order.STATUS_PENDING, expires=event.date_from,
+        )
+        order.payments.create(provider='ethereum', amount=100)
+
+        assert list(Command.events_with_pending_transfers()) == [event]
+
+
+@pytest.mark.django_db
+def test_payments_leased_by_other_workers_are_left_out(monkeypatch, get_order_and_payment):
+    payments = [get_order_and_payment()[1] for _ in range(3)]
+    for index, payment in enumerate(payments):
+        add_signed_message(payment, index)
+    claim_order_payments([payments[1].pk], "other-worker")
+
+    monkeypatch.setattr(
+        Command, "collect_pending_transfers",
+        lambda self, order_payment, log_verbosity=0: [
+            SimpleNamespace(signed_message=SimpleNamespace(safe_app_transaction_url=None),
+                            order_payment=order_payment)
+        ],
+    )
+    command = Command()
+    command.worker_id = "this-worker"
+
+    pending_transfers = command.collect_all_pending_transfers(chunk_size=2, claim=True)
+
+    assert [pending.order_payment.pk for pending in pending_transfers] == [
+        payments[0].pk, payments[2].pk
+    ]
+
+
+@pytest.mark.django_db
+def test_workers_with_the_same_backlog_split_it(monkeypatch, get_order_and_payment):
+    payments = [get_order_and_payment()[1] for _ in range(5)]
+    for index, payment in enumerate(payments):
+        add_signed_message(payment, index)
+
+    monkeypatch.setattr(
+        Command, "collect_pending_transfers",
+        lambda self, order_payment, log_verbosity=0: [
+            SimpleNamespace(signed_message=SimpleNamespace(safe_app_transaction_url=None),
+                            order_payment=order_payment)
+        ],
+    )
+    workers = []
+    for worker_id in ("first", "second", "third"):
+        command = Command()
+        command.worker_id = worker_id
+        command.max_claims = 2
+        workers.append(command)
+
+    def collect(command):
+        return [
+            pending.order_payment.pk
+            for pending in command.collect_all_pending_transfers(chunk_size=2, claim=True)
+        ]
+
+    first, second, third = [collect(command) for command in workers]
+
+    assert first == [payment.pk for payment in payments[:2]]
+    assert second == [payment.pk for payment in payments[2:4]]
+    assert third == [payments[4].pk]
+    # later passes keep each worker's share, rather than taking on more
+    assert collect(workers[0]) == first
+    assert collect(workers[2]) == third
+
+
+@pytest.mark.django_db
+def test_verification_state_is_recorded_for_later_runs(get_order_and_payment):
+    signed_message = add_signed_message(get_order_and_payment()[1], 1)
+    pending = PendingTransfer(
+        signed_message=signed_message,
+        order_payment=signed_message.order_payment,
+        token=all_token_and_network_ids_to_tokens["ETH - L1"],
+        rpc_url='https://rpc.example.org',
+        expected_amount=1000,
+        retry_timeout=1800,
+        safety_block_count=5,
+    )
+    command = Command()
+
+    command.record_verification_state(pending, Verdict(SKIP, "rpc_error"))
+    command.flush_writes()
+    assert not VerificationState.objects.exists()
+
+    command.record_verification_state(
+        pending, Verdict(SKIP, "too_young", block_number=198, head=200)
+    )
+    command.flush_writes()
+    state = VerificationState.objects.get(signed_message=signed_message)
+    assert (state.receipt_found, state.next_check_block) == (True, 203)
+    assert pending.state.pk == state.pk
+
+    command.record_verification_state(
+        pending, Verdict(SKIP, "underpaid", 10, block_number=198, head=203, sender="0x1")
+    )
+    command.flush_writes()
+    state.refresh_from_db()
+    assert (state.reason, state.verified_amount, state.next_check_block) == (
+        "underpaid", 10, None
+    )
+
+
+@pytest.mark.django_db
+def test_only_signed_messages_that_were_looked_up_expire(
+    provider, get_order_and_payment
+):
+    provider.settings.set('PAYMENT_NOT_RECIEVED_RETRY_TIMEOUT', 600)
+    looked_up, not_looked_up = [
+        add_signed_message(
+            get_order_and_payment(info_data={"currency_type": "ETH - L1", "amount": 1000})[1],
+            index,
+        )
+        for index in range(2)
+    ]
+    SignedMessage.objects.update(created_at=timezone.now() - datetime.timedelta(seconds=601))
+    command = Command()
+
+    # without an RPC URL for the network, nothing is looked up
+    assert command.collect_all_pending_transfers() == []
+    assert not SignedMessage.objects.filter(invalid=True).exists()
+
+    looked_up.refresh_from_db()
+    pending = PendingTransfer(
+        signed_message=looked_up,
+        order_payment=looked_up.order_payment,
+        token=all_token_and_network_ids_to_tokens["ETH - L1"],
+        rpc_url='https://rpc.example.org',
+        expected_amount=1000,
+        retry_timeout=600,
+        safety_block_count=5,
+    )
+    command.apply_verdicts([(pending, not_found_verdict(pending, "not_found"))], True)
+
+    assert set(SignedMessage.objects.filter(invalid=True)) == {looked_up}
+
+
+@pytest.mark.django_db
+def test_signed_messages_last_not_found_expire_in_one_update(
+    provider, get_order_and_payment
+):
+    provider.settings.set('PAYMENT_NOT_RECIEVED_RETRY_TIMEOUT', 600)
+    expired, other_worker, never_looked_up, found, recent = [
+        add_signed_message(get_order_and_payment()[1], index) for index in range(5)
+    ]
+    SignedMessage.objects.exclude(pk=recent.pk).update(
+        created_at=timezone.now() - datetime.timedelta(seconds=601)
+    )
+    for signed_message in (expired, other_worker, recent):
+        VerificationState.objects.create(signed_message=signed_message, reason="not_found")
+    VerificationState.objects.create(
+        signed_message=found, reason="underpaid", receipt_found=True, block_number=1,
+    )
+    command = Command()
+    command.worker_id = "this-worker"
+    claim_order_payments(
+        [signed_message.order_payment_id for signed_message in (expired, found, recent)],
+        command.worker_id,
+    )
+    claim_order_payments([other_worker.order_payment_id], "other-worker")
+
+    with CaptureQueriesContext(connection) as queries:
+        assert command.expire_signed_messages([provider.event], leased=True) == 1
+
+    assert len([query for query in queries.captured_queries if 'UPDATE' in query['sql']]) == 1
+    assert set(SignedMessage.objects.filter(invalid=True)) == {expired}
+    # without leases, payments held by other workers are swept too
+    assert command.expire_signed_messages([provider.event]) == 1
+    assert set(SignedMessage.objects.filter(invalid=True)) == {expired, other_worker}
+
+
+@pytest.mark.django_db
+def test_signed_messages_without_a_transaction_hash_expire_without_a_lookup(
+    provider, get_order_and_payment
+):
+    provider.settings.set('NETWORK_RPC_URL', '{"L1_RPC_URL": "https://rpc.example.org"}')
+    provider.settings.set('PAYMENT_NOT_RECIEVED_RETRY_TIMEOUT', 600)
+    recent, old = [
+        add_signed_message(
+            get_order_and_payment(info_data={"currency_type": "ETH - L1", "amount": 1000})[1],
+            index,
+        )
+        for index in range(2)
+    ]
+    SignedMessage.objects.update(transaction_hash=None)
+    SignedMessage.objects.filter(pk=old.pk).update(
+        created_at=timezone.now() - datetime.timedelta(seconds=601)
+    )
+
+    assert Command().collect_all_pending_transfers() == []
+
+    assert set(SignedMessage.objects.filter(invalid=True)) == {old}
+    assert not VerificationState.objects.exists()
+
+
+@pytest.mark.django_db
+def test_verdict_writes_are_flushed_in_bulk(get_order_and_payment):
+    signed_messages = [
+        add_signed_message(get_order_and_payment()[1], index) for index in range(6)
+    ]
+    command = Command()
+
+    for signed_message in signed_messages[:3]:
+        command.writes.invalidate(signed_message)
+    for signed_message in signed_messages[3:]:
+        command.writes.save_state(VerificationState(
+            signed_message=signed_message, receipt_found=True, block_number=1,
+            reason="confirmed",
+        ))
+    assert SignedMessage.objects.filter(invalid=True).count() == 0
+
+    with CaptureQueriesContext(connection) as queries:
+        command.flush_writes()
+
+    # one UPDATE, one INSERT and one SELECT for the new primary keys, plus the
+    # savepoint around them
+    assert len(queries) <= 5
+    assert SignedMessage.objects.filter(invalid=True).count() == 3
+    assert VerificationState.objects.count() == 3
+    assert len(command.writes) == 0
+
+
+@pytest.mark.django_db
+def test_confirmed_flags_are_written_with_the_confirmation(
+    monkeypatch, get_order_and_payment, get_organizer_scope
+):
+    _, payment = get_order_and_payment(info_data={"currency_type": "ETH - L1", "amount": 1000})
+    signed_message = add_signed_message(payment, 1)
+    pending = PendingTransfer(
+        signed_message=signed_message,
+        order_payment=payment,
+        token=all_token_and_network_ids_to_tokens["ETH - L1"],
+        rpc_url='https://rpc.example.org',
+        expected_amount=1000,
+        retry_timeout=1800,
+        safety_block_count=5,
+    )
+    command = Command()
+    claim_order_payments([payment.pk], command.worker_id)
+
+    def fail():
+        raise RuntimeError("database went away")
+
+    monkeypatch.setattr(command.writes, "flush", fail)
+    command.apply_verdicts(
+        [(pending, Verdict(CONFIRM, "confirmed", 1000, block_number=1, head=10))], True
+    )
+
+    signed_message.refresh_from_db()
+    assert signed_message.is_confirmed
+    with get_organizer_scope():
+        payment.refresh_from_db()
+    assert payment.state == OrderPayment.PAYMENT_STATE_CONFIRMED
+
+
+def test_subscription_targets_cover_networks_with_a_websocket_url():
+    def make(currency_type, ws_url):
+        token = all_token_and_network_ids_to_tokens[currency_type]
+        return PendingTransfer(
+            signed_message=SimpleNamespace(
+                transaction_hash='0x01',
+                recipient_address='0x47ABC45600bFb8069f53E55638Da593313e352C3',
+            ),
+            order_payment=None,
+            token=token,
+            rpc_url=f'https://{token.NETWORK_IDENTIFIER}.example.org',
+            expected_amount=1000,
+            retry_timeout=1800,
+            safety_block_count=5,
+            ws_url=ws_url,
+        )
+
+    targets = Command.subscription_targets([
+        make("ETH - L1", "wss://l1.example.org"),
+        make("DAI - L1", "wss://l1.example.org"),
+        make("ETH - Optimism", None),
+    ], subscribe_logs=True)
+
+    assert list(targets) == ['https://L1.example.org']
+    target = targets['https://L1.example.org']
+    assert (target.ws_url, target.network) == ("wss://l1.example.org", "L1")
+    dai = all_token_and_network_ids_to_tokens["DAI - L1"].ADDRESS.lower()
+    assert target.log_filter["address"] == [dai]
+    assert Command.subscription_targets(
+        [make("DAI - L1", "wss://l1.example.org")]
+    )['https://L1.example.org'].log_filter is None
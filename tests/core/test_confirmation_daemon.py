@@ -0,0 +1,63 @@
+import datetime
+import os
+import signal
+from types import SimpleNamespace
+
+import pytest
+from django.db import OperationalError
+from django.utils import timezone
+
+from pretix_eth.management.commands.confirm_payments import Command
+from pretix_eth.verification import SKIP, Verdict
+
+
+class FlakyEngine(object):
+    """Fails the first check, then sends SIGTERM once a check went through."""
+
+    def __init__(self, failures=1):
+        self.heads = SimpleNamespace(get=lambda rpc_url: None)
+        self.failures = failures
+        self.checked = []
+
+    def verify(self, due):
+        self.checked.append([pending.signed_message.pk for pending in due])
+        if len(self.checked) > 5:
+            # don't keep a broken daemon loop spinning
+            os.kill(os.getpid(), signal.SIGTERM)
+        if self.failures:
+            self.failures -= 1
+            raise OperationalError("server closed the connection unexpectedly")
+        os.kill(os.getpid(), signal.SIGTERM)
+        return [(pending, Verdict(SKIP, "not_found")) for pending in due]
+
+
+@pytest.mark.django_db
+def test_daemon_survives_failed_passes_and_stops_on_sigterm(monkeypatch, caplog, make_pending):
+    pending = make_pending(pk=1, created_at=timezone.now() - datetime.timedelta(hours=1))
+    collected = []
+
+    def collect_all_pending_transfers(self, log_verbosity=0, claim=False):
+        collected.append(claim)
+        if len(collected) == 1:
+            raise OperationalError("could not connect to server")
+        return [pending]
+
+    applied = []
+    monkeypatch.setattr(Command, "collect_all_pending_transfers", collect_all_pending_transfers)
+    monkeypatch.setattr(
+        Command, "apply_verdict",
+        lambda self, pending, verdict, *args: applied.append((pending, verdict)),
+    )
+    previous_handler = signal.getsignal(signal.SIGTERM)
+
+    engine = FlakyEngine()
+    # no backoff, so that retries happen right away
+    Command().run_daemon(engine, no_dry_run=False, rescan_interval=3600, max_backoff=0)
+
+    # the failed rescan was retried, and the transfer taken out of the schedule by the
+    # failed check was put back and checked again
+    assert collected == [False, False]
+    assert engine.checked == [[1], [1]]
+    assert applied == [(pending, Verdict(SKIP, "not_found"))]
+    assert caplog.text.count("Confirmation pass failed") == 2
+    assert signal.getsignal(signal.SIGTERM) is previous_handler
@@ -0,0 +1,56 @@
+import datetime
+
+import pytest
+from django.utils import timezone
+
+from pretix_eth.confirmation.leases import (
+    claim_order_payments,
+    holds_lease,
+    release_order_payments,
+)
+from pretix_eth.models import ConfirmationLease
+
+
+@pytest.fixture
+def payment_ids(get_order_and_payment):
+    return [get_order_and_payment()[1].pk for _ in range(4)]
+
+
+@pytest.mark.django_db
+def test_workers_never_hold_the_same_payment(payment_ids):
+    first = claim_order_payments(payment_ids[:3], "first")
+    second = claim_order_payments(payment_ids, "second")
+
+    assert first == set(payment_ids[:3])
+    assert second == {payment_ids[3]}
+    assert holds_lease(payment_ids[0], "first")
+    assert not holds_lease(payment_ids[0], "second")
+
+    # claiming again renews the worker's own leases
+    assert claim_order_payments(payment_ids, "first") == first
+
+
+@pytest.mark.django_db
+def test_expired_and_released_leases_can_be_taken_over(payment_ids):
+    claim_order_payments(payment_ids, "first")
+    ConfirmationLease.objects.filter(order_payment_id=payment_ids[0]).update(
+        expires_at=timezone.now() - datetime.timedelta(seconds=1)
+    )
+
+    assert claim_order_payments(payment_ids, "second") == {payment_ids[0]}
+
+    release_order_payments("first")
+    assert claim_order_payments(payment_ids, "second") == set(payment_ids)
+
+
+@pytest.mark.django_db
+def test_limits_only_apply_to_payments_a_worker_takes_on(payment_ids):
+    claim_order_payments(payment_ids[2:3], "first")
+
+    assert claim_order_payments(payment_ids, "first", limit=1) == {
+        payment_ids[0], payment_ids[2]
+    }
+    assert claim_order_payments(payment_ids, "first", limit=0) == {
+        payment_ids[0], payment_ids[2]
+    }
+    assert claim_order_payments(payment_ids, "second", limit=1) == {payment_ids[1]}
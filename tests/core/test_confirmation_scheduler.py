@@ -0,0 +1,158 @@
+import datetime
+
+from pretix_eth.confirmation.scheduler import ConfirmationScheduler, HeightQueue
+from pretix_eth.verification import Verdict
+
+
+class FakeClock(object):
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def submitted_at(timestamp):
+    return datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc)
+
+
+def test_new_messages_are_checked_one_block_after_submission(make_pending):
+    clock = FakeClock()
+    scheduler = ConfirmationScheduler(clock=clock)
+    scheduler.sync([
+        make_pending(1, pk=1, created_at=submitted_at(1000.0)),
+        make_pending(2, pk=2, created_at=submitted_at(0)),
+    ])
+
+    assert [pending.signed_message.pk for pending in scheduler.pop_due()] == [2]
+    assert scheduler.next_due_at() == 1012.0
+
+    clock.now = 1012.0
+    assert [pending.signed_message.pk for pending in scheduler.pop_due()] == [1]
+
+
+def test_young_transactions_wait_for_the_eligible_block(make_pending):
+    clock = FakeClock()
+    scheduler = ConfirmationScheduler(clock=clock)
+    pending = make_pending(1, pk=1, created_at=submitted_at(0))
+    scheduler.sync([pending])
+    scheduler.pop_due()
+
+    scheduler.reschedule(pending, Verdict("skip", "too_young", block_number=100, head=102))
+
+    # 3 more blocks of 12 seconds each
+    assert scheduler.next_due_at() == 1036.0
+
+
+def test_missing_transactions_back_off_exponentially(make_pending):
+    clock = FakeClock()
+    scheduler = ConfirmationScheduler(max_backoff=40, clock=clock)
+    pending = make_pending(1, pk=1, created_at=submitted_at(0))
+    scheduler.sync([pending])
+
+    delays = []
+    for _ in range(4):
+        scheduler.pop_due()
+        scheduler.reschedule(pending, Verdict("skip", "not_found"))
+        delays.append(scheduler.next_due_at() - clock.now)
+        clock.now = scheduler.next_due_at()
+
+    assert delays == [12, 24, 40, 40]
+
+
+def test_confirmed_and_vanished_messages_are_forgotten(make_pending):
+    clock = FakeClock()
+    scheduler = ConfirmationScheduler(clock=clock)
+    first, second = [make_pending(pk, pk=pk, created_at=submitted_at(0)) for pk in (1, 2)]
+    scheduler.sync([first, second])
+    scheduler.pop_due()
+
+    scheduler.reschedule(first, Verdict("confirm", "confirmed"))
+    scheduler.sync([])
+
+    assert len(scheduler) == 0
+    assert scheduler.next_due_at() is None
+
+
+def test_transfers_popped_without_a_verdict_are_requeued(make_pending):
+    clock = FakeClock()
+    scheduler = ConfirmationScheduler(clock=clock)
+    first, second, third = [
+        make_pending(pk, pk=pk, created_at=submitted_at(0)) for pk in (1, 2, 3)
+    ]
+    scheduler.sync([first, second, third])
+    due = scheduler.pop_due()
+    # the pass failed after the first verdict had been applied
+    scheduler.reschedule(first, Verdict("skip", "too_young", block_number=100, head=102))
+    scheduler.reschedule(second, Verdict("confirm", "confirmed"))
+
+    scheduler.requeue(due)
+
+    assert len(scheduler) == 2
+    assert scheduler.pop_due() == []
+    clock.now = 1012.0
+    assert scheduler.pop_due() == [third]
+
+
+def test_height_queue_releases_keys_in_height_order():
+    queue = HeightQueue()
+    for key, height in ((1, 105), (2, 103), (3, 110)):
+        queue.push(key, 'https://rpc.example.org', height)
+    queue.push(4, 'https://other.example.org', 100)
+    queue.discard(3)
+
+    assert queue.pop_ready('https://rpc.example.org', 104) == [2]
+    assert queue.pop_ready('https://rpc.example.org', 200) == [1]
+    assert queue.rpc_urls() == ['https://other.example.org']
+
+
+def test_young_transactions_are_released_once_the_head_reaches_them(make_pending):
+    clock = FakeClock()
+    scheduler = ConfirmationScheduler(clock=clock)
+    pending = make_pending(1, pk=1, created_at=submitted_at(0))
+    scheduler.sync([pending])
+    scheduler.pop_due()
+    scheduler.reschedule(pending, Verdict("skip", "too_young", block_number=100, head=102))
+
+    looked_up = []
+
+    def heads(rpc_url):
+        looked_up.append(rpc_url)
+        return head
+
+    # the head isn't looked at before the eligible block is expected
+    head = 104
+    assert scheduler.pop_due(heads) == []
+    assert looked_up == []
+
+    # the chain is slower than expected: check again one block later
+    clock.now = 1036.0
+    assert scheduler.pop_due(heads) == []
+    assert scheduler.next_due_at() == 1048.0
+
+    clock.now = 1048.0
+    head = 105
+    assert scheduler.pop_due(heads) == [pending]
+    assert len(looked_up) == 2
+    assert scheduler.next_due_at() is None
+
+
+def test_announced_blocks_and_logs_release_transfers_right_away(make_pending):
+    clock = FakeClock()
+    scheduler = ConfirmationScheduler(clock=clock)
+    young, missing, checking = [
+        make_pending(pk, pk=pk, created_at=submitted_at(0)) for pk in (1, 2, 3)
+    ]
+    scheduler.sync([young, missing, checking])
+    scheduler.pop_due()
+    scheduler.reschedule(young, Verdict("skip", "too_young", block_number=100, head=102))
+    scheduler.reschedule(missing, Verdict("skip", "not_found"))
+
+    assert scheduler.pop_ready(young.rpc_url, 104) == []
+    assert scheduler.pop_ready(young.rpc_url, 105) == [young]
+
+    # the log of a transfer that is being checked already doesn't release it twice
+    assert scheduler.pop_transactions(
+        [missing.transaction_hash, checking.transaction_hash]
+    ) == [missing]
+    assert scheduler.pop_due() == []
@@ -0,0 +1,156 @@
+import asyncio
+import json
+import threading
+import time
+
+import pytest
+import websockets
+
+from pretix_eth.network.rpc import ChainHeadCache
+from pretix_eth.network.subscriptions import HeadSubscriptions, SubscriptionTarget
+
+RPC_URL = 'https://rpc.example.org'
+LOG_FILTER = {'address': ['0x6b175474e89094c44da98b954eedeac495271d0f'], 'topics': []}
+
+
+class FakeNode(object):
+    """A WebSocket JSON-RPC endpoint that announces the blocks and logs it is told to."""
+
+    def __init__(self):
+        self.head = 10
+        self.logs = []
+        self.clients = set()
+        self.calls = []
+        self.loop = asyncio.new_event_loop()
+        self.ready = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        self.ready.wait()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.server = self.loop.run_until_complete(
+            websockets.serve(self._handle, '127.0.0.1', 0)
+        )
+        self.url = f'ws://127.0.0.1:{self.server.sockets[0].getsockname()[1]}'
+        self.ready.set()
+        self.loop.run_forever()
+
+    async def _handle(self, websocket):
+        self.clients.add(websocket)
+        try:
+            async for raw_message in websocket:
+                request = json.loads(raw_message)
+                method, params = request['method'], request['params']
+                self.calls.append((method, params))
+                if method == 'eth_subscribe':
+                    result = f'0x{params[0]}'
+                elif method == 'eth_blockNumber':
+                    result = hex(self.head)
+                elif method == 'eth_getLogs':
+                    from_block = int(params[0]['fromBlock'], 16)
+                    to_block = int(params[0]['toBlock'], 16)
+                    result = [
+                        log for log in self.logs
+                        if from_block <= int(log['blockNumber'], 16) <= to_block
+                    ]
+                await websocket.send(json.dumps({'jsonrpc': '2.0', 'id': request['id'],
+                                                 'result': result}))
+        finally:
+            self.clients.discard(websocket)
+
+    def _run_coroutine(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def announce(self, head):
+        self.head = head
+
+        async def send():
+            for websocket in list(self.clients):
+                await websocket.send(json.dumps({
+                    'jsonrpc': '2.0', 'method': 'eth_subscription',
+                    'params': {'subscription': '0xnewHeads', 'result': {'number': hex(head)}},
+                }))
+        self._run_coroutine(send())
+
+    def disconnect(self):
+        async def close():
+            for websocket in list(self.clients):
+                await websocket.close()
+        self._run_coroutine(close())
+
+    def stop(self):
+        self.server.close()
+        self._run_coroutine(self.server.wait_closed())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+
+@pytest.fixture
+def node():
+    node = FakeNode()
+    yield node
+    node.stop()
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_new_heads_are_announced(node):
+    heads = ChainHeadCache()
+    woken = threading.Event()
+    subscriptions = HeadSubscriptions(heads=heads, wake=woken.set)
+    try:
+        subscriptions.update({RPC_URL: SubscriptionTarget(node.url, 'L1')})
+        wait_for(lambda: subscriptions.head(RPC_URL) == 10)
+
+        node.announce(11)
+        wait_for(lambda: subscriptions.head(RPC_URL) == 11)
+
+        assert woken.is_set()
+        assert heads.peek(RPC_URL) == 11
+        assert subscriptions.drain() == ({RPC_URL: 11}, set())
+        assert subscriptions.drain() == ({}, set())
+    finally:
+        subscriptions.close()
+
+
+def test_subscriptions_reconnect_and_backfill_logs(node):
+    subscriptions = HeadSubscriptions(reconnect_delay=0.05)
+    try:
+        subscriptions.update({RPC_URL: SubscriptionTarget(node.url, 'L1', LOG_FILTER)})
+        wait_for(lambda: subscriptions.head(RPC_URL) == 10)
+        assert [method for method, _ in node.calls] == [
+            'eth_subscribe', 'eth_subscribe', 'eth_blockNumber',
+        ]
+        subscriptions.drain()
+
+        # blocks and logs that show up while the connection is down
+        node.head = 13
+        node.logs = [
+            {'blockNumber': hex(10), 'transactionHash': '0xseen'},
+            {'blockNumber': hex(12), 'transactionHash': '0xmissed'},
+        ]
+        node.disconnect()
+
+        wait_for(lambda: subscriptions.head(RPC_URL) == 13)
+        assert node.calls[-1] == ('eth_getLogs', [dict(
+            LOG_FILTER, fromBlock=hex(11), toBlock=hex(13)
+        )])
+        assert subscriptions.drain() == ({RPC_URL: 13}, {'0xmissed'})
+    finally:
+        subscriptions.close()
+
+
+def test_no_head_is_reported_while_disconnected():
+    subscriptions = HeadSubscriptions(reconnect_delay=0.05)
+    try:
+        subscriptions.update({RPC_URL: SubscriptionTarget('ws://127.0.0.1:9', 'L1')})
+        time.sleep(0.2)
+        assert subscriptions.head(RPC_URL) is None
+    finally:
+        subscriptions.close()
@@ -0,0 +1,148 @@
+from types import SimpleNamespace
+
+import pytest
+from eth_abi import encode
+from hexbytes import HexBytes
+from web3.datastructures import AttributeDict
+
+from pretix_eth.confirmation import logs as logs_module
+from pretix_eth.confirmation.logs import (
+    LogScanEngine,
+    TRANSFER_TOPIC,
+    address_to_topic,
+)
+from pretix_eth.models import NetworkCheckpoint, SignedMessage
+from pretix_eth.network.rpc import ChainHeadCache
+from pretix_eth.network.tokens import all_token_and_network_ids_to_tokens
+from pretix_eth.verification import SKIP, Verdict
+from addresses import RECEIVER, SENDER
+
+DAI = all_token_and_network_ids_to_tokens["DAI - L1"]
+
+
+def make_log(index, value, block_number=150):
+    return AttributeDict({
+        'address': DAI.ADDRESS,
+        'topics': [
+            HexBytes(TRANSFER_TOPIC),
+            HexBytes(address_to_topic(SENDER)),
+            HexBytes(address_to_topic(RECEIVER)),
+        ],
+        'data': HexBytes(encode(['uint256'], [value])),
+        'blockNumber': block_number,
+        'blockHash': HexBytes(b'\x00' * 32),
+        'transactionHash': HexBytes(f'0x{index:064x}'),
+        'transactionIndex': 0,
+        'logIndex': 0,
+    })
+
+
+class FallbackEngine(object):
+    batch_size = 100
+
+    def __init__(self):
+        self.verified = []
+        self.heads = ChainHeadCache()
+        self.heads.set('https://L1.example.org', 200)
+
+    def verify(self, pending_transfers):
+        for pending in pending_transfers:
+            self.verified.append(pending)
+            yield pending, Verdict(SKIP, "not_found")
+
+
+@pytest.fixture
+def chain(monkeypatch):
+    chain = SimpleNamespace(calls=[], logs=[])
+
+    def fake_batch_request(w3, calls, batch_size, network=None):
+        chain.calls.extend(calls)
+        return [chain.logs for _ in calls]
+
+    monkeypatch.setattr(logs_module, "get_web3", lambda rpc_url: rpc_url)
+    monkeypatch.setattr(logs_module, "batch_request", fake_batch_request)
+    return chain
+
+
+@pytest.mark.django_db
+def test_logs_confirm_matching_transfers_and_fall_back_for_the_rest(chain, make_pending):
+    chain.logs = [make_log(1, 1000), make_log(2, 10), make_log(99, 1000)]
+    paid, underpaid, unseen = (
+        make_pending(index, "DAI - L1", pk=index) for index in (1, 2, 3)
+    )
+    native = make_pending(4, "ETH - L1", pk=4)
+    fallback = FallbackEngine()
+
+    verdicts = dict(
+        LogScanEngine(fallback, lookback_blocks=100, max_block_range=60).verify(
+            [paid, underpaid, unseen, native]
+        )
+    )
+
+    assert verdicts[paid].reason == "confirmed"
+    assert verdicts[underpaid].reason == "underpaid"
+    assert set(fallback.verified) == {unseen, native}
+    # blocks 95 to 195 in ranges of 60 blocks
+    assert [call[1][0]["fromBlock"] for call in chain.calls] == [hex(95), hex(155)]
+
+
+@pytest.mark.django_db
+def test_scans_continue_from_the_checkpoint(chain, make_pending):
+    engine = LogScanEngine(FallbackEngine(), lookback_blocks=100)
+
+    list(engine.verify([make_pending(1, "DAI - L1", pk=1)]))
+    checkpoint = NetworkCheckpoint.objects.get(network_identifier="L1")
+    assert checkpoint.receiver_address == RECEIVER.lower()
+    assert checkpoint.last_scanned_block == 195
+    assert checkpoint.head_seen == 200
+
+    checkpoint.last_scanned_block = 180
+    checkpoint.save()
+    chain.calls.clear()
+    list(engine.verify([make_pending(1, "DAI - L1", pk=1)]))
+
+    assert chain.calls[0][1][0]["fromBlock"] == hex(181)
+
+    # but never further back than the lookback
+    checkpoint.last_scanned_block = 10
+    checkpoint.save()
+    chain.calls.clear()
+    list(engine.verify([make_pending(1, "DAI - L1", pk=1)]))
+
+    assert chain.calls[0][1][0]["fromBlock"] == hex(95)
+
+
+@pytest.mark.django_db
+def test_partial_scans_leave_the_checkpoint_alone(chain, make_pending, get_order_and_payment):
+    signed_messages = [
+        SignedMessage.objects.create(
+            signature='0x',
+            raw_message='{}',
+            sender_address=SENDER,
+            recipient_address=RECEIVER,
+            chain_id=1,
+            order_payment=get_order_and_payment()[1],
+            transaction_hash=f'0x{index:064x}',
+        )
+        for index in (1, 2)
+    ]
+    first, second = (
+        make_pending(index, "DAI - L1", pk=signed_message.pk)
+        for index, signed_message in enumerate(signed_messages, 1)
+    )
+    chain.logs = [make_log(2, 1000)]
+    engine = LogScanEngine(FallbackEngine(), lookback_blocks=100)
+
+    # e.g. a budget slice, or another worker holding the second payment
+    list(engine.verify([first]))
+    assert not NetworkCheckpoint.objects.exists()
+
+    # the blocks scanned for the first transfer are scanned again for the second
+    chain.calls.clear()
+    verdicts = dict(engine.verify([second]))
+    assert verdicts[second].reason == "confirmed"
+    assert chain.calls[0][1][0]["fromBlock"] == hex(95)
+    assert not NetworkCheckpoint.objects.exists()
+
+    list(engine.verify([first, second]))
+    assert NetworkCheckpoint.objects.get().last_scanned_block == 195
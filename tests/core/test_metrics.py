@@ -0,0 +1,50 @@
+import urllib.request
+
+import pytest
+from django.core.management import call_command
+
+from pretix_eth.metrics import Metrics, metrics, serve
+
+
+def test_counters_and_histograms_render_in_the_prometheus_text_format():
+    registry = Metrics(buckets=(0.1, 1))
+    registry.inc("pretix_eth_verdicts_total", action="skip", reason="not_found")
+    registry.inc("pretix_eth_verdicts_total", 2, action="skip", reason="not_found")
+    registry.observe("pretix_eth_rpc_request_seconds", 0.5, network="L1", method="eth_call")
+
+    lines = registry.render().splitlines()
+
+    assert "# TYPE pretix_eth_verdicts_total counter" in lines
+    assert 'pretix_eth_verdicts_total{action="skip",reason="not_found"} 3.0' in lines
+    assert "# TYPE pretix_eth_rpc_request_seconds histogram" in lines
+    labels = 'method="eth_call",network="L1"'
+    assert f'pretix_eth_rpc_request_seconds_bucket{{{labels},le="0.1"}} 0' in lines
+    assert f'pretix_eth_rpc_request_seconds_bucket{{{labels},le="1"}} 1' in lines
+    assert f'pretix_eth_rpc_request_seconds_bucket{{{labels},le="+Inf"}} 1' in lines
+    assert f'pretix_eth_rpc_request_seconds_count{{{labels}}} 1' in lines
+
+
+def test_metrics_are_served_over_http():
+    registry = Metrics()
+    registry.inc("pretix_eth_db_queries_total", 7)
+    server = serve(registry, 0)
+    try:
+        url = f"http://127.0.0.1:{server.server_address[1]}/metrics"
+        with urllib.request.urlopen(url) as response:
+            body = response.read().decode()
+    finally:
+        server.shutdown()
+
+    assert "pretix_eth_db_queries_total 7.0" in body
+
+
+@pytest.mark.django_db
+def test_confirm_payments_writes_its_metrics(tmp_path):
+    metrics.clear()
+    metrics_file = tmp_path / "pretix_eth.prom"
+
+    call_command("confirm_payments", metrics_file=str(metrics_file))
+
+    body = metrics_file.read_text()
+    assert "pretix_eth_pass_duration_seconds_count 1" in body
+    assert metrics.total("pretix_eth_db_queries_total") > 0
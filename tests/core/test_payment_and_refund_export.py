@@ -1,8 +1,16 @@
+import datetime
+import decimal
+
 import pytest
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 
 from pretix.base.models import OrderPayment
 
+from pretix_eth.models import FinalizedTransaction, PriceSample, SignedMessage
+from pretix_eth.network.rpc import encode_result
+
 
 @pytest.mark.django_db
 def test_headers_are_present(organizer, event, create_admin_client):
@@ -98,3 +106,156 @@ def test_payment_data_present(
     assert "ETH - L1" in file_content
     assert "Payment" in file_content
     assert "100.0" in file_content
+
+
+@pytest.mark.django_db
+def test_block_numbers_of_finalized_transactions_are_exported(
+    organizer, event, create_admin_client, create_payment_with_address
+):
+    payment = create_payment_with_address()
+    transaction_hash = '0x' + '44' * 32
+    SignedMessage.objects.create(
+        signature='0x0',
+        raw_message='{}',
+        sender_address='0x' + '11' * 20,
+        recipient_address='0x' + '22' * 20,
+        chain_id=1,
+        order_payment=payment,
+        transaction_hash=transaction_hash,
+        is_confirmed=True,
+    )
+    FinalizedTransaction.objects.create(
+        chain_id=1,
+        transaction_hash=transaction_hash,
+        block_number=12345678,
+        receipt=encode_result({"blockNumber": 12345678, "status": 1}),
+    )
+
+    response = create_admin_client(event).post(
+        reverse(
+            "control:event.orders.export.do",
+            kwargs={"event": event.slug, "organizer": organizer.slug},
+        ),
+        {
+            "exporter": "ethorders",
+            "ethorders-_format": "default",
+            "ethorders-payment_states": "confirmed",
+        },
+        follow=True,
+    )
+
+    file_content = "".join(str(row) for row in response.streaming_content)
+    assert "Block number" in file_content
+    assert "12345678" in file_content
+
+
+@pytest.mark.django_db
+def test_finalized_transactions_are_loaded_once_per_export(
+    organizer, event, create_admin_client, create_payment_with_address
+):
+    for index in range(3):
+        payment = create_payment_with_address()
+        transaction_hash = '0x' + f'{index:02x}' * 32
+        SignedMessage.objects.create(
+            signature='0x0',
+            raw_message='{}',
+            sender_address='0x' + '11' * 20,
+            recipient_address='0x' + '22' * 20,
+            chain_id=1,
+            order_payment=payment,
+            transaction_hash=transaction_hash,
+            is_confirmed=True,
+        )
+        FinalizedTransaction.objects.create(
+            chain_id=1,
+            transaction_hash=transaction_hash,
+            block_number=1000 + index,
+            receipt=encode_result({"blockNumber": 1000 + index, "status": 1}),
+        )
+    client = create_admin_client(event)
+
+    with CaptureQueriesContext(connection) as queries:
+        response = client.post(
+            reverse(
+                "control:event.orders.export.do",
+                kwargs={"event": event.slug, "organizer": organizer.slug},
+            ),
+            {
+                "exporter": "ethorders",
+                "ethorders-_format": "default",
+                "ethorders-payment_states": "confirmed",
+            },
+            follow=True,
+        )
+        file_content = "".join(str(row) for row in response.streaming_content)
+
+    assert all(str(1000 + index) in file_content for index in range(3))
+    assert len([
+        query for query in queries.captured_queries
+        if 'FROM "pretix_eth_finalizedtransaction"' in query["sql"]
+    ]) == 1
+
+
+@pytest.mark.django_db
+def test_market_rates_come_from_the_price_history(
+    organizer, event, create_admin_client, create_payment_with_address
+):
+    payment = create_payment_with_address()
+    PriceSample.objects.create(
+        token_symbol="ETH", fiat_currency=event.currency,
+        timestamp=payment.created - datetime.timedelta(minutes=5),
+        price=decimal.Decimal("1234.5"), quote_count=4,
+        lowest_quote=decimal.Decimal("1230"), highest_quote=decimal.Decimal("1240"),
+    )
+
+    response = create_admin_client(event).post(
+        reverse(
+            "control:event.orders.export.do",
+            kwargs={"event": event.slug, "organizer": organizer.slug},
+        ),
+        {
+            "exporter": "ethorders",
+            "ethorders-_format": "default",
+            "ethorders-payment_states": "confirmed",
+        },
+        follow=True,
+    )
+
+    file_content = "".join(str(row) for row in response.streaming_content)
+    assert "Market rate at creation" in file_content
+    assert "1234.5" in file_content
+
+
+@pytest.mark.django_db
+def test_the_price_history_is_loaded_once_per_export(
+    organizer, event, create_admin_client, create_payment_with_address
+):
+    payments = [create_payment_with_address() for _ in range(3)]
+    PriceSample.objects.create(
+        token_symbol="ETH", fiat_currency=event.currency,
+        timestamp=payments[0].created - datetime.timedelta(minutes=5),
+        price=decimal.Decimal("1234.5"), quote_count=4,
+        lowest_quote=decimal.Decimal("1230"), highest_quote=decimal.Decimal("1240"),
+    )
+    client = create_admin_client(event)
+
+    with CaptureQueriesContext(connection) as queries:
+        response = client.post(
+            reverse(
+                "control:event.orders.export.do",
+                kwargs={"event": event.slug, "organizer": organizer.slug},
+            ),
+            {
+                "exporter": "ethorders",
+                "ethorders-_format": "default",
+                "ethorders-payment_states": "confirmed",
+            },
+            follow=True,
+        )
+        file_content = "".join(str(row) for row in response.streaming_content)
+
+    assert file_content.count("1234.5") == 3
+    assert len([
+        query for query in queries.captured_queries
+        if 'FROM "pretix_eth_pricesample"' in query["sql"]
+    ]) == 2
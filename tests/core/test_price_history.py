@@ -0,0 +1,66 @@
+import datetime
+
+import pytest
+from django.utils import timezone
+
+from pretix_eth.models import PriceSample
+from pretix_eth.network import price_history
+
+NOW = timezone.now().replace(minute=0, second=0, microsecond=0)
+
+
+def record(price, age, pair=("ETH", "USD")):
+    return price_history.record_prices(
+        {pair: price}, {pair: [price]}, timestamp=NOW - age
+    )
+
+
+@pytest.mark.django_db
+def test_the_price_at_an_instant_is_the_last_sample_before_it():
+    record(1000.0, datetime.timedelta(hours=2))
+    record(1100.0, datetime.timedelta(hours=1))
+    record(1.0, datetime.timedelta(hours=1), pair=("DAI", "USD"))
+
+    def price_at(age):
+        sample = price_history.get_price_sample_at("ETH", "USD", NOW - age)
+        return sample and sample.price
+
+    assert price_at(datetime.timedelta(minutes=90)) == 1000
+    assert price_at(datetime.timedelta(0)) == 1100
+    assert price_at(datetime.timedelta(hours=3)) is None
+
+
+@pytest.mark.django_db
+def test_a_window_answers_like_the_database(django_assert_num_queries):
+    for hours in range(6):
+        record(1000.0 + hours, datetime.timedelta(hours=hours))
+    record(1.0, datetime.timedelta(hours=3), pair=("DAI", "USD"))
+    instants = [NOW - datetime.timedelta(minutes=minutes) for minutes in range(0, 300, 7)]
+    expected = [price_history.get_price_sample_at("ETH", "USD", instant) for instant in instants]
+
+    window = price_history.PriceHistoryWindow(instants[-1], instants[0])
+    with django_assert_num_queries(2):
+        samples = [window.sample_at("ETH", "USD", instant) for instant in instants]
+
+    assert samples == expected
+    assert window.sample_at("BTC", "USD", NOW) is None
+    assert window.sample_at("DAI", "USD", NOW - datetime.timedelta(hours=4)) is None
+
+
+@pytest.mark.django_db
+def test_old_samples_are_downsampled():
+    # every 5 minutes for a day, 3 days ago and 100 days ago
+    for days in (3, 100):
+        for minutes in range(0, 24 * 60, 5):
+            record(1000.0 + minutes, datetime.timedelta(days=days, minutes=minutes))
+    record(1.0, datetime.timedelta(days=100), pair=("DAI", "USD"))
+
+    price_history.downsample(now=NOW)
+
+    recent = PriceSample.objects.filter(timestamp__gte=NOW - datetime.timedelta(days=7))
+    assert recent.count() == 24 * 12
+    old = PriceSample.objects.filter(timestamp__lt=NOW - datetime.timedelta(days=90))
+    # one per day and pair, the day boundary falls within the 24 hours
+    assert old.filter(token_symbol="ETH").count() <= 2
+    assert old.filter(token_symbol="DAI").count() == 1
+    assert price_history.downsample(now=NOW) == 0
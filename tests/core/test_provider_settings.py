@@ -0,0 +1,69 @@
+import pytest
+
+from pretix_eth import provider_settings
+from pretix_eth.provider_settings import get_provider_settings, parse_rpc_urls
+from pretix_eth.utils import get_rpc_url_for_network
+
+L1_RPC_URL = "https://mainnet.infura.io/v3/somekeyvaluehere"
+
+
+def test_rpc_urls_are_keyed_by_network():
+    rpc_urls = parse_rpc_urls(
+        '{"L1_RPC_URL": "%s", "Optimism": "https://example.org", "Arbitrum_RPC_URL": 1}'
+        % L1_RPC_URL
+    )
+
+    assert dict(rpc_urls) == {"L1": L1_RPC_URL}
+    assert dict(parse_rpc_urls('{"L1_WS_URL": "wss://example.org"}', "_WS_URL")) == {
+        "L1": "wss://example.org"
+    }
+    assert dict(parse_rpc_urls(
+        '{"L1_RPC_URL": ["https://a.example.org", "https://b.example.org"],'
+        ' "Optimism_RPC_URL": ["https://c.example.org"], "Arbitrum_RPC_URL": []}'
+    )) == {
+        "L1": ("https://a.example.org", "https://b.example.org"),
+        "Optimism": "https://c.example.org",
+    }
+    assert dict(parse_rpc_urls("not json")) == {}
+    assert dict(parse_rpc_urls(None)) == {}
+
+
+@pytest.mark.django_db
+def test_snapshot_is_cached_until_the_settings_change(provider):
+    provider.settings.set("NETWORK_RPC_URL", {"L1_RPC_URL": L1_RPC_URL})
+    provider.settings.set("_NETWORKS", ["L1"])
+
+    snapshot = get_provider_settings(provider)
+    assert snapshot.networks == frozenset(["L1"])
+    assert snapshot.safety_block_count == 10
+    assert get_provider_settings(provider) is snapshot
+    assert get_rpc_url_for_network(provider, "L1") == L1_RPC_URL
+
+    provider.settings.set("SAFETY_BLOCK_COUNT", 3)
+
+    assert get_provider_settings(provider).safety_block_count == 3
+    assert get_rpc_url_for_network(provider, "Optimism") is None
+
+
+@pytest.mark.django_db
+def test_settings_saved_by_other_processes_are_picked_up_right_away(provider):
+    provider.settings.set("SINGLE_RECEIVER_ADDRESS", "0x" + "11" * 20)
+    get_provider_settings(provider)
+    stale_snapshots = dict(provider_settings._snapshots)
+
+    provider.settings.set("SINGLE_RECEIVER_ADDRESS", "0x" + "22" * 20)
+    # as if the settings had been saved in another process, which only shares the cache
+    provider_settings._snapshots.update(stale_snapshots)
+
+    assert get_provider_settings(provider).receiver_address == "0x" + "22" * 20
+
+
+@pytest.mark.django_db
+def test_snapshot_expires(provider):
+    now = [0]
+    snapshot = get_provider_settings(provider, ttl=10, clock=lambda: now[0])
+
+    now[0] = 9
+    assert get_provider_settings(provider, ttl=10, clock=lambda: now[0]) is snapshot
+    now[0] = 10
+    assert get_provider_settings(provider, ttl=10, clock=lambda: now[0]) is not snapshot
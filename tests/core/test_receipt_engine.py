@@ -0,0 +1,169 @@
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+from web3.datastructures import AttributeDict
+
+from pretix_eth.confirmation import engine as engine_module
+from pretix_eth.confirmation.engine import ReceiptEngine
+from pretix_eth.models import FinalizedTransaction
+from pretix_eth.network import rpc as rpc_module
+from addresses import RECEIVER, SENDER
+
+
+class FakeChain(object):
+    """Answers batched lookups, confirming every even transaction hash."""
+
+    def __init__(self, delay=0, delays=None):
+        self.delay = delay
+        self.delays = delays or {}
+        self.lock = threading.Lock()
+        self.in_flight = {}
+        self.max_in_flight = {}
+        self.methods = []
+
+    def batch_request(self, w3, calls, batch_size, network=None):
+        rpc_url = w3
+        with self.lock:
+            self.in_flight[rpc_url] = self.in_flight.get(rpc_url, 0) + 1
+            self.max_in_flight[rpc_url] = max(
+                self.max_in_flight.get(rpc_url, 0), self.in_flight[rpc_url]
+            )
+        time.sleep(self.delays.get(rpc_url, self.delay))
+        with self.lock:
+            self.in_flight[rpc_url] -= 1
+
+        results = []
+        for method, params in calls:
+            self.methods.append(method)
+            if method == "eth_blockNumber":
+                results.append(200)
+            elif int(params[0], 16) % 2:
+                results.append(None)
+            elif method == "eth_getTransactionReceipt":
+                results.append(AttributeDict({
+                    'status': 1, 'blockNumber': 100, 'to': RECEIVER, 'from': SENDER,
+                }))
+            else:
+                results.append(AttributeDict({'value': 1000}))
+        return results
+
+
+def run_engine(monkeypatch, chain, pending_transfers, **kwargs):
+    monkeypatch.setattr(engine_module, "get_web3", lambda rpc_url: rpc_url)
+    monkeypatch.setattr(engine_module, "batch_request", chain.batch_request)
+    return {
+        pending.transaction_hash: verdict
+        for pending, verdict in ReceiptEngine(**kwargs).verify(pending_transfers)
+    }
+
+
+@pytest.mark.django_db
+def test_workers_produce_the_same_verdicts_as_serial_runs(monkeypatch, make_pending):
+    pending_transfers = [
+        make_pending(i, currency_type)
+        for i, currency_type in enumerate(["ETH - L1", "ETH - Arbitrum"] * 10)
+    ]
+
+    serial = run_engine(monkeypatch, FakeChain(), pending_transfers, batch_size=3)
+    threaded = run_engine(
+        monkeypatch, FakeChain(), pending_transfers, batch_size=3, workers=4
+    )
+
+    assert len(serial) == 20
+    assert serial == threaded
+    assert sorted(set(verdict.action for verdict in serial.values())) == ["confirm", "skip"]
+
+
+@pytest.mark.django_db
+def test_workers_respect_network_concurrency(monkeypatch, make_pending):
+    chain = FakeChain(delay=0.05)
+    pending_transfers = [
+        make_pending(i, currency_type)
+        for i, currency_type in enumerate(["ETH - L1", "ETH - Arbitrum"] * 8)
+    ]
+
+    run_engine(
+        monkeypatch, chain, pending_transfers,
+        batch_size=2, workers=8, network_concurrency=1,
+    )
+
+    assert set(chain.max_in_flight.values()) == {1}
+
+
+@pytest.mark.django_db
+def test_a_slow_network_does_not_hold_up_the_others(monkeypatch, make_pending):
+    slow_network = make_pending(0, "ETH - Arbitrum").rpc_url
+    chain = FakeChain(delays={slow_network: 0.2})
+    # eight batches for the slow network come first
+    pending_transfers = [make_pending(i, "ETH - Arbitrum") for i in range(16)]
+    pending_transfers.append(make_pending(16, "ETH - L1"))
+
+    monkeypatch.setattr(engine_module, "get_web3", lambda rpc_url: rpc_url)
+    monkeypatch.setattr(engine_module, "batch_request", chain.batch_request)
+    verdicts = ReceiptEngine(batch_size=2, workers=4, network_concurrency=2).verify(
+        pending_transfers
+    )
+
+    started_at = time.perf_counter()
+    first, _ = next(verdicts)
+    assert first.token.NETWORK_IDENTIFIER == "L1"
+    assert time.perf_counter() - started_at < 0.2
+    assert len(list(verdicts)) == 16
+    assert chain.max_in_flight[slow_network] == 2
+
+
+@pytest.mark.django_db
+def test_block_height_is_looked_up_once_per_rpc_url(monkeypatch, make_pending):
+    chain = FakeChain()
+    pending_transfers = [
+        make_pending(i, currency_type)
+        for i, currency_type in enumerate(["ETH - L1", "ETH - Arbitrum"] * 10)
+    ]
+
+    run_engine(monkeypatch, chain, pending_transfers, batch_size=3)
+
+    assert chain.methods.count("eth_blockNumber") == 2
+
+
+@pytest.mark.django_db
+def test_known_young_transfers_are_not_looked_up_again(monkeypatch, make_pending):
+    chain = FakeChain()
+    monkeypatch.setattr(
+        rpc_module, "get_web3",
+        lambda rpc_url: SimpleNamespace(eth=SimpleNamespace(block_number=200)),
+    )
+    waiting, unknown = make_pending(0, "ETH - L1"), make_pending(2, "ETH - L1")
+    waiting.state = SimpleNamespace(
+        receipt_found=True, block_number=199, next_check_block=204, reason="too_young",
+    )
+
+    verdicts = run_engine(monkeypatch, chain, [waiting, unknown], batch_size=10)
+
+    assert verdicts[waiting.transaction_hash].reason == "too_young"
+    assert verdicts[unknown.transaction_hash].reason == "confirmed"
+    assert chain.methods == ["eth_getTransactionReceipt", "eth_getTransactionByHash"]
+
+
+@pytest.mark.django_db
+def test_finalized_receipts_and_transactions_are_only_looked_up_once(monkeypatch, make_pending):
+    pending_transfers = [make_pending(i, "ETH - L1") for i in range(4)]
+
+    first = run_engine(monkeypatch, FakeChain(), pending_transfers, finality_depth=64)
+    chain = FakeChain()
+    second = run_engine(monkeypatch, chain, pending_transfers, finality_depth=64)
+
+    assert second == first
+    assert FinalizedTransaction.objects.filter(transaction__isnull=False).count() == 2
+    # only the transactions that weren't found are looked up again
+    assert chain.methods == ["eth_blockNumber"] + ["eth_getTransactionReceipt"] * 2
+
+
+@pytest.mark.django_db
+def test_receipts_within_the_finality_depth_are_not_cached(monkeypatch, make_pending):
+    pending_transfers = [make_pending(i, "ETH - L1") for i in range(4)]
+
+    run_engine(monkeypatch, FakeChain(), pending_transfers, finality_depth=101)
+
+    assert not FinalizedTransaction.objects.exists()
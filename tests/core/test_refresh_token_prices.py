@@ -0,0 +1,106 @@
+import pytest
+from django.core.management import CommandError, call_command
+
+from pretix.base.models import Event
+
+from pretix_eth.management.commands import refresh_token_prices
+from pretix_eth.models import PriceSample
+from pretix_eth.network import helpers
+from pretix_eth.payment import Ethereum
+
+
+@pytest.fixture
+def refreshed(monkeypatch):
+    refreshed = []
+
+    def get_quotes_from_oracles(pairs, deadline, timeout):
+        refreshed.extend(sorted(pairs))
+        return {pair: [1990.0, 2000.0, 2010.0] for pair in pairs}
+
+    monkeypatch.setattr(
+        refresh_token_prices, "get_quotes_from_oracles", get_quotes_from_oracles
+    )
+    return refreshed
+
+
+def enable(provider, currency="EUR", rates=None, networks=("L1",)):
+    provider.event.currency = currency
+    provider.event.save()
+    provider.settings.set("_enabled", True)
+    provider.settings.set("TOKEN_RATES", rates or {"ETH_RATE": 1000, "DAI_RATE": 1})
+    provider.settings.set("_NETWORKS", list(networks))
+
+
+@pytest.mark.django_db
+def test_prices_of_enabled_events_are_refreshed(provider, refreshed):
+    enable(provider, currency="USD")
+
+    call_command("refresh_token_prices")
+
+    assert refreshed == [("DAI", "USD"), ("ETH", "USD")]
+    sample = PriceSample.objects.get(token_symbol="ETH", fiat_currency="USD")
+    assert (sample.price, sample.quote_count) == (2000, 3)
+    assert (sample.lowest_quote, sample.highest_quote) == (1990, 2010)
+
+
+@pytest.mark.django_db
+def test_pairs_without_market_prices_and_disabled_events_are_left_out(
+    provider, organizer, refreshed
+):
+    # CHF prices only ever come from TOKEN_RATES
+    enable(provider, currency="CHF")
+    other_provider = Ethereum(Event.objects.create(
+        organizer=organizer, name="Other", slug="other", plugins="pretix_eth",
+        date_from=provider.event.date_from,
+    ))
+    enable(other_provider, currency="USD", rates={"ETH_RATE": 1000}, networks=())
+    disabled_provider = Ethereum(Event.objects.create(
+        organizer=organizer, name="Disabled", slug="disabled", plugins="pretix_eth",
+        date_from=provider.event.date_from,
+    ))
+    enable(disabled_provider, currency="USD")
+    disabled_provider.settings.set("_enabled", False)
+
+    call_command("refresh_token_prices")
+
+    assert refreshed == []
+
+
+@pytest.mark.django_db
+def test_oracles_get_more_time_than_at_checkout(provider, monkeypatch):
+    enable(provider, currency="USD")
+    budgets = []
+
+    def get_quotes_from_oracles(pairs, deadline, timeout):
+        budgets.append((deadline, timeout))
+        return {pair: [2000.0] for pair in pairs}
+
+    monkeypatch.setattr(
+        refresh_token_prices, "get_quotes_from_oracles", get_quotes_from_oracles
+    )
+
+    call_command("refresh_token_prices")
+
+    assert budgets == [(helpers.REFRESH_PRICE_DEADLINE, helpers.REFRESH_PRICE_REQUEST_TIMEOUT)]
+    assert helpers.REFRESH_PRICE_DEADLINE > helpers.PRICE_DEADLINE
+
+
+@pytest.mark.django_db
+def test_failed_refreshes_make_the_command_fail(provider, monkeypatch):
+    enable(provider)
+    monkeypatch.setattr(
+        refresh_token_prices, "get_quotes_from_oracles",
+        lambda pairs, deadline, timeout: {("DAI", "EUR"): [1.0], ("ETH", "EUR"): []},
+    )
+
+    with pytest.raises(CommandError, match="ETH/EUR"):
+        call_command("refresh_token_prices")
+
+
+@pytest.mark.django_db
+def test_a_missing_shared_cache_is_reported(provider, refreshed, caplog):
+    enable(provider, currency="USD")
+
+    call_command("refresh_token_prices")
+
+    assert "no shared cache" in caplog.text
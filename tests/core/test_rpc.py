@@ -0,0 +1,180 @@
+import json
+import time
+from types import SimpleNamespace
+
+import pytest
+import requests
+from web3 import Web3, HTTPProvider
+
+from pretix_eth.exceptions import TransactionProviderError
+from pretix_eth.metrics import Metrics
+from pretix_eth.network import rpc
+
+
+def test_batch_request_maps_results_back_in_order(monkeypatch):
+    sent = []
+
+    def fake_post(endpoint_uri, data, **kwargs):
+        payload = json.loads(data)
+        sent.append(payload)
+        # answer out of order and leave one receipt unknown
+        responses = []
+        for call in reversed(payload):
+            if call["method"] == "eth_blockNumber":
+                responses.append({"id": call["id"], "result": "0x10"})
+            elif call["params"] == ["0x01"]:
+                responses.append({"id": call["id"], "error": {"message": "nope"}})
+            else:
+                responses.append({"id": call["id"], "result": None})
+        return json.dumps(responses).encode()
+
+    monkeypatch.setattr(rpc, "make_post_request", fake_post)
+    monkeypatch.setattr(rpc, "metrics", Metrics())
+    w3 = Web3(HTTPProvider('http://localhost:8545'))
+
+    results = rpc.batch_request(
+        w3,
+        [("eth_blockNumber", []),
+         ("eth_getTransactionReceipt", ["0x01"]),
+         ("eth_getTransactionReceipt", ["0x02"])],
+        batch_size=2,
+        network="L1",
+    )
+
+    assert [len(batch) for batch in sent] == [2, 1]
+    assert results[0] == 16
+    assert isinstance(results[1], TransactionProviderError)
+    assert results[2] is None
+    assert rpc.metrics.value(
+        "pretix_eth_rpc_calls_total", network="L1", method="eth_getTransactionReceipt"
+    ) == 2
+    assert rpc.metrics.value(
+        "pretix_eth_rpc_request_seconds", network="L1", method="eth_getTransactionReceipt"
+    ) == 1
+
+
+def test_get_web3_reuses_clients_per_rpc_url():
+    rpc.clear_clients()
+    try:
+        w3 = rpc.get_web3('https://rpc.example.org')
+
+        assert rpc.get_web3('https://rpc.example.org') is w3
+        assert rpc.get_web3('https://other.example.org') is not w3
+        assert isinstance(w3.provider, rpc.PooledHTTPProvider)
+        assert w3.provider.get_request_kwargs()['timeout'] == rpc.DEFAULT_TIMEOUT
+    finally:
+        rpc.clear_clients()
+
+
+def test_chain_head_cache_refreshes_stale_heights(monkeypatch):
+    now = [0]
+    lookups = []
+
+    def fake_get_web3(rpc_url):
+        lookups.append(rpc_url)
+        return SimpleNamespace(eth=SimpleNamespace(block_number=100 + len(lookups)))
+
+    monkeypatch.setattr(rpc, "get_web3", fake_get_web3)
+    heads = rpc.ChainHeadCache(max_age=5, clock=lambda: now[0])
+
+    assert heads.get('https://a.example.org') == 101
+    now[0] = 5
+    assert heads.get('https://a.example.org') == 101
+    assert heads.peek('https://b.example.org') is None
+    now[0] = 6
+    assert heads.peek('https://a.example.org') is None
+    assert heads.get('https://a.example.org') == 102
+    assert lookups == ['https://a.example.org'] * 2
+
+
+class FakeSession(object):
+    """Answers from each endpoint after its ``delays`` entry, or fails for ``failing`` ones."""
+
+    def __init__(self, delays, failing=()):
+        self.delays = delays
+        self.failing = set(failing)
+        self.calls = []
+
+    def post(self, endpoint_uri, data, **kwargs):
+        self.calls.append(endpoint_uri)
+        time.sleep(self.delays.get(endpoint_uri, 0))
+
+        def raise_for_status():
+            if endpoint_uri in self.failing:
+                raise requests.HTTPError(f"429 from {endpoint_uri}")
+
+        return SimpleNamespace(content=endpoint_uri.encode(), raise_for_status=raise_for_status)
+
+
+FAST = 'https://fast.example.org'
+SLOW = 'https://slow.example.org'
+
+
+@pytest.fixture
+def endpoints():
+    rpc.clear_clients()
+    yield
+    rpc.clear_clients()
+
+
+def test_requests_go_to_the_fastest_healthy_endpoint(endpoints):
+    for _ in range(5):
+        rpc.get_endpoint_health(SLOW).record_success(0.5)
+        rpc.get_endpoint_health(FAST).record_success(0.01)
+    session = FakeSession({})
+    provider = rpc.FailoverHTTPProvider((SLOW, FAST), session)
+
+    assert provider.post(b'{}') == FAST.encode()
+    assert session.calls == [FAST]
+
+
+def test_failing_endpoints_are_failed_over_and_skipped_while_their_circuit_is_open(
+    endpoints, monkeypatch
+):
+    monkeypatch.setattr(rpc, "metrics", Metrics())
+    now = [0]
+    fast = rpc.get_endpoint_health(FAST)
+    fast.clock = lambda: now[0]
+    session = FakeSession({}, failing=[FAST])
+    provider = rpc.FailoverHTTPProvider((FAST, SLOW), session)
+
+    assert provider.post(b'{}') == SLOW.encode()
+    assert session.calls == [FAST, SLOW]
+    assert rpc.metrics.value("pretix_eth_rpc_failovers_total") == 1
+
+    for _ in range(rpc.DEFAULT_CIRCUIT_FAILURES - 1):
+        fast.record_failure()
+    assert not fast.available
+    session.calls.clear()
+    provider.post(b'{}')
+    assert session.calls == [SLOW]
+
+    # the endpoint is tried again once the circuit cools down
+    now[0] = rpc.DEFAULT_CIRCUIT_COOLDOWN
+    assert fast.available
+    assert FAST in [health.endpoint_uri for health in rpc.rank_endpoints((FAST, SLOW))]
+
+
+def test_slow_requests_are_hedged_on_the_next_endpoint(endpoints, monkeypatch):
+    monkeypatch.setattr(rpc, "metrics", Metrics())
+    for _ in range(rpc.MIN_HEDGE_SAMPLES):
+        rpc.get_endpoint_health(SLOW).record_success(0.01)
+        rpc.get_endpoint_health(FAST).record_success(0.02)
+    # the usually fastest endpoint stalls
+    session = FakeSession({SLOW: 1})
+    provider = rpc.FailoverHTTPProvider((SLOW, FAST), session)
+
+    started_at = time.perf_counter()
+    assert provider.post(b'{}') == FAST.encode()
+
+    assert time.perf_counter() - started_at < 0.5
+    assert session.calls == [SLOW, FAST]
+    assert rpc.metrics.value("pretix_eth_rpc_hedged_requests_total") == 1
+
+
+def test_a_list_of_rpc_urls_gets_a_failover_client(endpoints):
+    w3 = rpc.get_web3((FAST, SLOW))
+
+    assert isinstance(w3.provider, rpc.FailoverHTTPProvider)
+    assert w3.provider.endpoint_uris == (FAST, SLOW)
+    assert isinstance(rpc.get_web3((FAST,)).provider, rpc.PooledHTTPProvider)
@@ -0,0 +1,103 @@
+import datetime
+from types import SimpleNamespace
+
+from django.utils import timezone
+
+from pretix_eth.confirmation import budget as budget_module
+from pretix_eth.confirmation.budget import RunBudget, prioritize
+from pretix_eth.management.commands.confirm_payments import Command
+from pretix_eth.metrics import Metrics
+from pretix_eth.verification import SKIP, Verdict
+
+NOW = timezone.now()
+
+
+def expiring(expires_in):
+    """A payment on an order that expires in ``expires_in`` seconds."""
+    return SimpleNamespace(
+        order=SimpleNamespace(expires=NOW + datetime.timedelta(seconds=expires_in))
+    )
+
+
+def test_fresh_submissions_on_orders_expiring_soon_come_first(make_pending):
+    pending_transfers = [
+        make_pending(transaction_hash="stale", age=3600, order_payment=expiring(3600)),
+        make_pending(transaction_hash="expired_order", age=10, order_payment=expiring(-60)),
+        make_pending(transaction_hash="expires_later", age=10, order_payment=expiring(7200)),
+        make_pending(transaction_hash="expires_soon_old", age=600, order_payment=expiring(300)),
+        make_pending(transaction_hash="expires_soon_young", age=60, order_payment=expiring(300)),
+        make_pending(transaction_hash="stale_young", age=1900, order_payment=expiring(3600)),
+    ]
+
+    ordered = prioritize(pending_transfers, now=NOW)
+
+    assert [pending.transaction_hash for pending in ordered] == [
+        "expires_soon_young",
+        "expires_soon_old",
+        "expires_later",
+        "expired_order",
+        "stale_young",
+        "stale",
+    ]
+
+
+def test_budget_is_spent_by_time_or_rpc_calls(monkeypatch):
+    monkeypatch.setattr(budget_module, "metrics", Metrics())
+    now = [0]
+
+    assert not RunBudget(clock=lambda: now[0]).is_limited
+
+    budget = RunBudget(max_runtime=10, max_rpc_calls=5, clock=lambda: now[0])
+    budget_module.metrics.inc("pretix_eth_rpc_calls_total", 3, method="eth_blockNumber")
+    assert budget.remaining_rpc_calls == 2
+    assert not budget.exhausted
+
+    now[0] = 10
+    assert budget.exhausted
+
+    budget = RunBudget(max_rpc_calls=5, clock=lambda: now[0])
+    budget_module.metrics.inc("pretix_eth_rpc_calls_total", 5, method="eth_blockNumber")
+    assert budget.exhausted
+
+
+class CountingEngine(object):
+    """Makes two RPC calls per transfer and skips it."""
+
+    def __init__(self):
+        self.slices = []
+
+    def verify(self, pending_transfers):
+        self.slices.append([pending.transaction_hash for pending in pending_transfers])
+        for pending in pending_transfers:
+            budget_module.metrics.inc("pretix_eth_rpc_calls_total", 2, method="eth_call")
+            yield pending, Verdict(SKIP, "not_found")
+
+
+def test_runs_stop_when_the_budget_is_spent_and_report_the_backlog(monkeypatch, make_pending):
+    monkeypatch.setattr(budget_module, "metrics", Metrics())
+    command = Command()
+    monkeypatch.setattr(command, "apply_verdicts", lambda verdicts, *args: list(verdicts))
+    monkeypatch.setattr(
+        "pretix_eth.management.commands.confirm_payments.metrics", budget_module.metrics
+    )
+    engine = CountingEngine()
+    pending_transfers = [
+        make_pending(transaction_hash=f"{index}", age=index, order_payment=expiring(3600),
+                     currency_type=("ETH - L1", "ETH - Optimism")[index % 2])
+        for index in range(10)
+    ]
+
+    left = command.verify_within_budget(
+        engine, pending_transfers, RunBudget(max_rpc_calls=9), no_dry_run=False,
+        slice_size=3,
+    )
+
+    # the youngest first, and no more slices than the budget covers
+    assert engine.slices == [["0", "1", "2"], ["3"], ["4"]]
+    assert [pending.transaction_hash for pending in left] == ["5", "6", "7", "8", "9"]
+    assert budget_module.metrics.value(
+        "pretix_eth_deferred_transfers_total", network="L1"
+    ) == 2
+    assert budget_module.metrics.value(
+        "pretix_eth_deferred_transfers_total", network="Optimism"
+    ) == 3
@@ -0,0 +1,103 @@
+import threading
+import time
+
+import pytest
+from django.core.cache import cache
+
+from pretix_eth.network.safe import SafeTransactionService
+
+EXECUTED = {
+    'isExecuted': True,
+    'isSuccessful': True,
+    'safe': '0x1111111111111111111111111111111111111111',
+    'to': '0x47ABC45600bFb8069f53E55638Da593313e352C3',
+    'value': '1000',
+    'transactionHash': '0xabc',
+}
+
+
+class FakeResponse(object):
+    def __init__(self, json_data):
+        self.json_data = json_data
+
+    def raise_for_status(self):
+        if self.json_data is None:
+            raise ValueError("500 Server Error")
+
+    def json(self):
+        return self.json_data
+
+
+class FakeSession(object):
+    def __init__(self, responses, delay=0):
+        self.responses = responses
+        self.delay = delay
+        self.requests = []
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def get(self, url, timeout):
+        with self.lock:
+            self.requests.append((url, timeout))
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(self.delay)
+        with self.lock:
+            self.in_flight -= 1
+        return FakeResponse(self.responses[url])
+
+
+@pytest.fixture(autouse=True)
+def locmem_cache(settings):
+    settings.CACHES = {
+        'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+    }
+    cache.clear()
+    yield
+    cache.clear()
+
+
+def test_executed_transactions_are_cached_for_good():
+    session = FakeSession({
+        'https://safe/executed': EXECUTED,
+        'https://safe/pending': {'isExecuted': False},
+        'https://safe/broken': None,
+    })
+    service = SafeTransactionService(session=session, pending_ttl=30)
+    urls = ['https://safe/executed', 'https://safe/pending', 'https://safe/broken']
+
+    results = service.get_many(urls)
+    assert results['https://safe/executed']['transaction_hash'] == '0xabc'
+    assert results['https://safe/pending'] is None
+    assert isinstance(results['https://safe/broken'], Exception)
+
+    session.requests.clear()
+    cached = service.get_many(urls)
+    assert cached['https://safe/executed'] == results['https://safe/executed']
+    assert cached['https://safe/pending'] is None
+    # only the failed lookup is repeated
+    assert [url for url, _ in session.requests] == ['https://safe/broken']
+    assert session.requests[0][1] == service.timeout
+
+
+def test_without_a_shared_cache_transactions_are_cached_per_process(settings):
+    settings.CACHES = {
+        'default': {'BACKEND': 'pretix.helpers.cache.CustomDummyCache'},
+    }
+    session = FakeSession({'https://safe/executed': EXECUTED})
+    service = SafeTransactionService(session=session)
+
+    service.get('https://safe/executed')
+    assert service.get('https://safe/executed')['transaction_hash'] == '0xabc'
+    assert len(session.requests) == 1
+
+
+def test_lookups_are_bounded():
+    urls = [f'https://safe/{i}' for i in range(12)]
+    session = FakeSession({url: {'isExecuted': False} for url in urls}, delay=0.02)
+
+    SafeTransactionService(session=session, max_workers=3).get_many(urls)
+
+    assert len(session.requests) == 12
+    assert session.max_in_flight <= 3
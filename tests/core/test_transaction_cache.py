@@ -0,0 +1,116 @@
+import pytest
+
+from pretix_eth.confirmation.transaction_cache import TransactionCache
+from pretix_eth.exceptions import TransactionProviderError
+from pretix_eth.models import FinalizedTransaction
+from pretix_eth.network import rpc
+from pretix_eth.network.rpc import _format_result
+from pretix_eth.network.tokens import EthL1
+
+TRANSACTION_HASH = '0x' + '44' * 32
+SENDER = '0x' + '11' * 20
+TOKEN_ADDRESS = '0x' + '22' * 20
+
+
+def make_receipt(block_number, status=1):
+    return _format_result("eth_getTransactionReceipt", {"result": {
+        "blockHash": '0x' + 'ab' * 32,
+        "blockNumber": hex(block_number),
+        "contractAddress": None,
+        "cumulativeGasUsed": "0x5208",
+        "effectiveGasPrice": "0x1",
+        "from": SENDER,
+        "gasUsed": "0x5208",
+        "logs": [{
+            "address": TOKEN_ADDRESS,
+            "topics": ['0x' + '33' * 32],
+            "data": '0x' + '00' * 32,
+            "blockNumber": hex(block_number),
+            "transactionHash": TRANSACTION_HASH,
+            "transactionIndex": "0x0",
+            "blockHash": '0x' + 'ab' * 32,
+            "logIndex": "0x0",
+            "removed": False,
+        }],
+        "logsBloom": '0x' + '00' * 256,
+        "status": hex(status),
+        "to": TOKEN_ADDRESS,
+        "transactionHash": TRANSACTION_HASH,
+        "transactionIndex": "0x0",
+        "type": "0x2",
+    }})
+
+
+def make_transaction(block_number):
+    return _format_result("eth_getTransactionByHash", {"result": {
+        "blockHash": '0x' + 'ab' * 32,
+        "blockNumber": hex(block_number),
+        "from": SENDER,
+        "gas": "0x5208",
+        "gasPrice": "0x1",
+        "hash": TRANSACTION_HASH,
+        "input": "0x",
+        "nonce": "0x0",
+        "to": TOKEN_ADDRESS,
+        "transactionIndex": "0x0",
+        "value": hex(10 ** 18),
+        "type": "0x0",
+        "v": "0x1b",
+        "r": "0x1",
+        "s": "0x2",
+    }})
+
+
+@pytest.mark.django_db
+def test_finalized_entries_survive_a_round_trip():
+    receipt, transaction = make_receipt(100), make_transaction(100)
+    cache = TransactionCache(finality_depth=10)
+    cache.add(1, TRANSACTION_HASH, receipt, None, head=110)
+    cache.save()
+    # transactions may be added to an entry later on
+    cache.add(1, TRANSACTION_HASH, receipt, transaction, head=110)
+    cache.save()
+
+    loaded = TransactionCache(finality_depth=10)
+    loaded.load([(1, TRANSACTION_HASH)])
+
+    assert loaded.receipt(1, TRANSACTION_HASH) == receipt
+    assert loaded.transaction(1, TRANSACTION_HASH) == transaction
+    assert loaded.receipt(10, TRANSACTION_HASH) is None
+
+
+@pytest.mark.django_db
+def test_only_final_receipts_are_cached():
+    cache = TransactionCache(finality_depth=10)
+    cache.add(1, '0x01', make_receipt(100), None, head=109)
+    cache.add(1, '0x02', None, None, head=200)
+    cache.add(1, '0x03', TransactionProviderError("timeout"), None, head=200)
+    cache.save()
+
+    assert not FinalizedTransaction.objects.exists()
+
+
+def test_signed_messages_without_a_hash_are_never_cached():
+    cache = TransactionCache(finality_depth=10)
+    cache.add(1, None, make_receipt(100), None, head=200)
+
+    assert len(cache) == 0
+    assert cache.receipt(1, None) is None
+    assert cache.transaction(1, None) is None
+
+
+@pytest.mark.django_db
+def test_control_view_receipts_only_come_from_the_cache(provider, monkeypatch):
+    def get_web3(rpc_url):
+        raise AssertionError("the control view must not make RPC calls")
+
+    monkeypatch.setattr(rpc, "get_web3", get_web3)
+    token = EthL1()
+
+    assert provider.get_transaction_receipt(token, TRANSACTION_HASH) is None
+
+    cache = TransactionCache(finality_depth=10)
+    cache.add(token.CHAIN_ID, TRANSACTION_HASH, make_receipt(100, status=0), None, head=200)
+    cache.save()
+
+    assert provider.get_transaction_receipt(token, TRANSACTION_HASH).status == 0
@@ -0,0 +1,117 @@
+import time
+from types import SimpleNamespace
+
+from web3.datastructures import AttributeDict
+
+from pretix_eth.exceptions import TransactionProviderError
+from pretix_eth.network import rpc
+from pretix_eth import verification
+from pretix_eth.verification import verdict_from_state, verify_transfer
+from addresses import RECEIVER, SENDER
+
+
+def make_receipt(block_number=100, status=1, to=RECEIVER):
+    return AttributeDict({
+        'status': status,
+        'blockNumber': block_number,
+        'to': to,
+        'from': SENDER,
+        'logs': [],
+    })
+
+
+def test_missing_receipt_is_skipped_until_retry_timeout(make_pending):
+    assert verify_transfer(make_pending(), None, None, 200).action == verification.SKIP
+    assert verify_transfer(
+        make_pending(age=time.time()), None, None, 200
+    ).action == verification.INVALIDATE
+
+
+def test_failed_transaction_is_invalidated(make_pending):
+    verdict = verify_transfer(make_pending(), make_receipt(status=0), None, 200)
+    assert verdict.action == verification.INVALIDATE
+    assert verdict.reason == "failed"
+
+
+def test_young_transaction_waits_for_safety_blocks(make_pending):
+    verdict = verify_transfer(make_pending(), make_receipt(block_number=198), None, 200)
+    assert verdict.reason == "too_young"
+
+
+def test_native_transfer_confirms_with_enough_value(make_pending):
+    pending = make_pending()
+    receipt = make_receipt()
+
+    assert verify_transfer(
+        pending, receipt, AttributeDict({'value': 1000}), 200
+    ).action == verification.CONFIRM
+    assert verify_transfer(
+        pending, receipt, AttributeDict({'value': 999}), 200
+    ).reason == "underpaid"
+    assert verify_transfer(
+        pending, make_receipt(to=SENDER), AttributeDict({'value': 1000}), 200
+    ).reason == "mismatch"
+
+
+def test_rpc_errors_never_invalidate(make_pending):
+    pending = make_pending(age=time.time())
+    error = TransactionProviderError("boom")
+
+    assert verify_transfer(pending, error, None, 200).action == verification.SKIP
+    assert verify_transfer(pending, make_receipt(), error, 200).action == verification.SKIP
+
+
+def test_batched_json_rpc_receipts_are_verified(make_pending):
+    # what a node answers, before any formatting
+    receipt = rpc._format_result("eth_getTransactionReceipt", {
+        "jsonrpc": "2.0",
+        "id": 1,
+        "result": {
+            "blockNumber": "0x64",
+            "status": "0x1",
+            "to": RECEIVER,
+            "from": SENDER,
+            "logs": [{"logIndex": "0x0", "topics": []}],
+        },
+    })
+    transaction = rpc._format_result("eth_getTransactionByHash", {
+        "jsonrpc": "2.0", "id": 2, "result": {"value": "0x3e8"},
+    })
+
+    assert receipt.blockNumber == 100
+    assert receipt.logs[0].logIndex == 0
+    assert verify_transfer(
+        make_pending(), receipt, transaction, 200
+    ).action == verification.CONFIRM
+
+
+def make_state(reason, block_number=100, next_check_block=None, amount=None):
+    return SimpleNamespace(
+        receipt_found=True,
+        block_number=block_number,
+        verified_sender=SENDER.lower(),
+        verified_amount=amount,
+        reason=reason,
+        next_check_block=next_check_block,
+    )
+
+
+def test_young_transactions_are_not_looked_up_before_the_next_check_block(make_pending):
+    pending = make_pending()
+    pending.state = make_state("too_young", block_number=198, next_check_block=203)
+
+    assert verdict_from_state(pending, 202).reason == "too_young"
+    assert verdict_from_state(pending, 203) is None
+
+
+def test_final_verdicts_are_repeated_without_a_lookup(make_pending):
+    pending = make_pending()
+    pending.state = make_state("underpaid", amount=10)
+
+    verdict = verdict_from_state(pending, 200)
+    assert (verdict.action, verdict.reason, verdict.payment_amount) == (
+        verification.SKIP, "underpaid", 10
+    )
+
+    pending.state = make_state("not_found")
+    assert verdict_from_state(pending, 200) is None
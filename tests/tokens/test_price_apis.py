@@ -0,0 +1,156 @@
+import time
+from types import SimpleNamespace
+
+import pytest
+from django.core.cache import cache
+
+from pretix_eth.cache import local_cache
+from pretix_eth.network import helpers, oracles
+
+RESPONSES = {
+    "kraken.com": {"result": {
+        "XETHZUSD": {"c": ["2000.0", "0.1"]},
+        "DAIUSD": {"c": ["1.0001", "100"]},
+    }},
+    "binance.com": [{"symbol": "ETHUSDC", "bidPrice": "2010.0"}],
+    "gemini.com": [
+        {"pair": "ETHUSD", "price": "1990.0"},
+        {"pair": "DAIUSD", "price": "0.9999"},
+        {"pair": "BTCUSD", "price": "60000"},
+    ],
+    "coingecko.com": {"ethereum": {"usd": 5000.0}, "dai": {"usd": 1.0}},
+}
+
+
+class FakeSession(object):
+    """Answers like the exchanges do, after ``delays[exchange]`` seconds."""
+
+    def __init__(self, delays=None, failing=()):
+        self.delays = delays or {}
+        self.failing = failing
+        self.timeouts = []
+        self.params = {}
+
+    def get(self, url, params=None, timeout=None):
+        self.timeouts.append(timeout)
+        exchange = next(exchange for exchange in RESPONSES if exchange in url)
+        self.params[exchange] = params
+        time.sleep(self.delays.get(exchange, 0))
+        if exchange in self.failing:
+            raise ConnectionError(f"{exchange} is down")
+        return SimpleNamespace(json=lambda: RESPONSES[exchange])
+
+
+@pytest.fixture
+def session(monkeypatch):
+    def _session(**kwargs):
+        fake_session = FakeSession(**kwargs)
+        monkeypatch.setattr(helpers, "_get_session", lambda: fake_session)
+        return fake_session
+
+    return _session
+
+
+def test_prices_of_all_pairs_are_fetched_with_one_request_per_oracle(session):
+    fake_session = session()
+
+    prices = helpers.get_prices_from_oracles({("ETH", "USD"), ("DAI", "USD")})
+
+    # CoinGecko's ETH price is an outlier and is left out
+    assert prices == {("ETH", "USD"): 2000.0, ("DAI", "USD"): 1.0}
+    assert fake_session.timeouts == [helpers.PRICE_REQUEST_TIMEOUT] * 4
+    assert fake_session.params["kraken.com"] == {"pair": "DAIUSD,ETHUSD"}
+    assert fake_session.params["binance.com"] == {"symbols": '["ETHUSDC"]'}
+    assert fake_session.params["coingecko.com"] == {"ids": "dai,ethereum", "vs_currencies": "usd"}
+
+
+def test_oracles_only_ask_for_the_tokens_they_know(session):
+    fake_session = session()
+
+    assert helpers.get_prices_from_oracles({("DAI", "USD")}) == {("DAI", "USD"): 1.0}
+    assert "binance.com" not in fake_session.params
+
+
+@pytest.mark.parametrize("quotes,price", [
+    ([], None),
+    ([2000.0], 2000.0),
+    ([2000.0, 2010.0, 1990.0, 5000.0], 2000.0),
+    ([2000.0, 2010.0], 2005.0),
+    # no way to tell which one is right
+    ([1000.0, 2000.0], None),
+])
+def test_quotes_are_aggregated_without_outliers(quotes, price):
+    assert oracles.aggregate_quotes(quotes) == price
+
+
+def test_hanging_or_failing_exchanges_are_left_out(session):
+    session(delays={"coingecko.com": 2}, failing=["gemini.com"])
+
+    started_at = time.perf_counter()
+    prices = helpers.get_prices_from_oracles({("ETH", "USD")}, deadline=0.2)
+
+    assert time.perf_counter() - started_at < 1
+    assert prices == {("ETH", "USD"): 2005.0}
+
+
+def test_no_price_if_no_exchange_answers_in_time(session):
+    session(delays={exchange: 1 for exchange in RESPONSES})
+
+    assert helpers.get_prices_from_oracles({("ETH", "USD")}, deadline=0.1) == {}
+
+
+@pytest.fixture
+def shared_cache(settings):
+    settings.CACHES = {
+        "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}
+    }
+    cache.clear()
+    yield cache
+    cache.clear()
+
+
+def test_a_cold_cache_is_filled_by_the_first_lookup(session, shared_cache):
+    fake_session = session()
+
+    assert helpers.get_price("ETH", "USD") == 2000.0
+    assert helpers.get_price("ETH", "USD") == 2000.0
+
+    assert len(fake_session.timeouts) == 4
+    assert shared_cache.get(helpers.get_price_cache_key("ETH", "USD"))["price"] == 2000.0
+
+
+def test_without_a_shared_cache_prices_are_cached_per_process(session, settings):
+    settings.CACHES = {
+        "default": {"BACKEND": "pretix.helpers.cache.CustomDummyCache"}
+    }
+    fake_session = session()
+
+    assert helpers.get_price("ETH", "USD") == 2000.0
+    assert helpers.get_price("ETH", "USD") == 2000.0
+
+    assert len(fake_session.timeouts) == 4
+    assert local_cache.get(helpers.get_price_cache_key("ETH", "USD"))["price"] == 2000.0
+
+
+def test_stale_prices_are_served_while_one_process_refreshes_them(
+    session, shared_cache, monkeypatch
+):
+    session(delays={"kraken.com": 0.2})
+    shared_cache.set(
+        helpers.get_price_cache_key("ETH", "USD"),
+        {"price": 1000.0, "timestamp": time.time() - helpers.PRICE_MAX_AGE - 1},
+    )
+    refreshes = []
+    submit = helpers.refresh_price_in_background
+    monkeypatch.setattr(
+        helpers, "refresh_price_in_background",
+        lambda *pair: refreshes.append(submit(*pair)),
+    )
+
+    assert helpers.get_price("ETH", "USD") == 1000.0
+    assert helpers.get_price("ETH", "USD") == 1000.0
+
+    # the second lookup found the refresh in progress
+    assert refreshes[1] is None
+    assert refreshes[0].result() == 2000.0
+    assert helpers.get_price("ETH", "USD") == 2000.0
@@ -1,6 +1,6 @@
 from django.core.exceptions import ImproperlyConfigured
 import pytest
-from pretix_eth.network.tokens import IToken
+from pretix_eth.network.tokens import DaiL1, EthL1, IToken
 from pretix_eth.network import helpers
 
 
@@ -30,6 +30,13 @@ def test_token_get_ticket_price_in_token_is_correct():
     assert price_in_token_weis == 10000000000000000
 
 
+def test_tokens_the_oracles_quote_have_live_prices_in_supported_currencies():
+    assert EthL1().has_live_price("EUR")
+    assert DaiL1().has_live_price("USD")
+    assert not DaiL1().has_live_price("CHF")
+    assert not create_token().has_live_price("USD")
+
+
 def test_token_get_price_in_token_gives_error_if_no_rate_given():
     test_token: IToken = create_token()
     with pytest.raises(ImproperlyConfigured) as execinfo: